@@ -2,6 +2,7 @@
 
 
 import os, subprocess, sys, time, bz2
+import hashlib, json, shutil
 from random import randint
 
 
@@ -54,4 +55,225 @@ def info(s, init_new_line=False, exit=False, exit_value=0):
     sys.stdout.write('{}'.format(s))
     sys.stdout.flush()
     if exit:
-        sys.exit(exit_value)
\ No newline at end of file
+        sys.exit(exit_value)
+
+# ------------------------------------------------------------------------------
+#   COMPILED PANGENOME
+# ------------------------------------------------------------------------------
+PANGENOME_COMPILED_SUFFIX = '.compiled'
+PANGENOME_ARRAYS = ['families', 'genes', 'contigs', 'genomes',
+                    'gene_family', 'gene_contig', 'gene_genome', 'gene_from', 'gene_to',
+                    'genome_family_ptr', 'genome_family_idx']
+
+
+class Pangenome():
+    """Binary form of a pangenome tsv file (FAMILY, GENE, GENOME, CONTIG, FROM, TO).
+    String tables: families (sorted), genes, contigs, genomes (order of appearance)
+    Integer arrays, one value per gene: gene_family, gene_contig, gene_genome, gene_from, gene_to
+    Genome -> families index (CSR): families of genome i are genome_family_idx[genome_family_ptr[i]:genome_family_ptr[i+1]]
+    A gene listed several times keeps its first position and its last values, as when parsed into a dict.
+    """
+
+    def __init__(self, arrays, checksum):
+        for name in PANGENOME_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.checksum = checksum
+
+    def genome_families(self, genome_idx):
+        return self.genome_family_idx[self.genome_family_ptr[genome_idx]:self.genome_family_ptr[genome_idx + 1]]
+
+
+"""MD5 checksum of a file, read in blocks of 1 Mb"""
+def file_checksum(path):
+    md5 = hashlib.md5()
+    with open(path, mode='rb') as IN:
+        for block in iter(lambda: IN.read(1024 * 1024), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+"""Parse the pangenome tsv file into the arrays of the Pangenome class"""
+def parse_pangenome(pangenome_file):
+    import numpy
+    rows = {}
+    genome_family_pairs = set()
+    with open(pangenome_file, mode='r') as IN:
+        for line in IN:
+            words = line.strip().split('\t')
+            if len(words) < 6: continue
+            # words = FAMILY, GENE_NAME, GENOME, CONTIG, FROM, TO
+            rows[words[1]] = (words[0], words[2], words[3], int(words[4]), int(words[5]))
+            genome_family_pairs.add((words[2], words[0]))
+
+    families = sorted(set(r[0] for r in rows.values()) | set(p[1] for p in genome_family_pairs))
+    family2idx = dict((f, i) for i, f in enumerate(families))
+    contig2idx, genome2idx = {}, {}
+    for fml, genome, ctg, fr, to in rows.values():
+        contig2idx.setdefault(ctg, len(contig2idx))
+        genome2idx.setdefault(genome, len(genome2idx))
+    for genome, fml in sorted(genome_family_pairs):
+        genome2idx.setdefault(genome, len(genome2idx))
+
+    genome_families = [[] for g in genome2idx]
+    for genome, fml in genome_family_pairs:
+        genome_families[genome2idx[genome]].append(family2idx[fml])
+    genome_family_ptr = numpy.zeros(len(genome2idx) + 1, dtype=numpy.int64)
+    genome_family_ptr[1:] = numpy.cumsum([len(f) for f in genome_families])
+
+    values = list(rows.values())
+    arrays = {'families' : numpy.array(families, dtype=str),
+              'genes' : numpy.array(list(rows.keys()), dtype=str),
+              'contigs' : numpy.array(list(contig2idx.keys()), dtype=str),
+              'genomes' : numpy.array(list(genome2idx.keys()), dtype=str),
+              'gene_family' : numpy.array([family2idx[r[0]] for r in values], dtype=numpy.int32),
+              'gene_genome' : numpy.array([genome2idx[r[1]] for r in values], dtype=numpy.int32),
+              'gene_contig' : numpy.array([contig2idx[r[2]] for r in values], dtype=numpy.int32),
+              'gene_from' : numpy.array([r[3] for r in values], dtype=numpy.int64),
+              'gene_to' : numpy.array([r[4] for r in values], dtype=numpy.int64),
+              'genome_family_ptr' : genome_family_ptr,
+              'genome_family_idx' : numpy.array([f for fs in genome_families for f in sorted(fs)], dtype=numpy.int32)}
+    return arrays
+
+
+"""Write the memory-mappable binary form of a pangenome next to the tsv file
+(directory PANGENOME.tsv.compiled/ with one .npy file per array and a meta.json).
+If the directory cannot be written, the parsed pangenome is only kept in memory.
+"""
+def compile_pangenome(pangenome_file, verbose=False):
+    import numpy
+    if verbose: print(' [I] Compiling pangenome file ' + pangenome_file + '...')
+    checksum = file_checksum(pangenome_file)
+    arrays = parse_pangenome(pangenome_file)
+    out_dir = pangenome_file + PANGENOME_COMPILED_SUFFIX
+    try:
+        tmp_dir = out_dir + '.tmp' + str(os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name in PANGENOME_ARRAYS:
+            numpy.save(os.path.join(tmp_dir, name + '.npy'), arrays[name])
+        stat = os.stat(pangenome_file)
+        with open(os.path.join(tmp_dir, 'meta.json'), mode='w') as OUT:
+            json.dump({'checksum' : checksum, 'size' : stat.st_size, 'mtime_ns' : stat.st_mtime_ns,
+                       'numof_genes' : len(arrays['genes'])}, OUT)
+        if os.path.isdir(out_dir): shutil.rmtree(out_dir)
+        os.rename(tmp_dir, out_dir)
+    except OSError as err:
+        print(' [W] Cannot write compiled pangenome in ' + out_dir + ' (' + str(err) + '), using it from memory only')
+    return Pangenome(arrays, checksum)
+
+
+"""Load the compiled pangenome (memory-mapped), compiling it first if it is
+missing or if the tsv file checksum changed since it was compiled.
+"""
+def load_pangenome(pangenome_file, verbose=False):
+    import numpy
+    out_dir = pangenome_file + PANGENOME_COMPILED_SUFFIX
+    meta_file = os.path.join(out_dir, 'meta.json')
+    if os.path.exists(meta_file):
+        with open(meta_file, mode='r') as IN:
+            meta = json.load(IN)
+        stat = os.stat(pangenome_file)
+        up_to_date = (meta['size'] == stat.st_size and meta['mtime_ns'] == stat.st_mtime_ns)
+        if not up_to_date and meta['size'] == stat.st_size:
+            # same size but touched: only the checksum tells if the content changed
+            up_to_date = meta['checksum'] == file_checksum(pangenome_file)
+            if up_to_date:
+                meta['mtime_ns'] = stat.st_mtime_ns
+                try:
+                    with open(meta_file, mode='w') as OUT:
+                        json.dump(meta, OUT)
+                except OSError:
+                    pass
+        if up_to_date:
+            arrays = dict((name, numpy.load(os.path.join(out_dir, name + '.npy'), mmap_mode='r')) for name in PANGENOME_ARRAYS)
+            if verbose: print(' [I] Loaded compiled pangenome ' + out_dir)
+            return Pangenome(arrays, meta['checksum'])
+        if verbose: print(' [I] Pangenome file changed since it was compiled')
+    return compile_pangenome(pangenome_file, verbose)
+
+
+# ------------------------------------------------------------------------------
+#   BINARY GENE ABUNDANCES
+# ------------------------------------------------------------------------------
+ABUNDANCE_BINARY_SUFFIX = '.bin'
+ABUNDANCE_MAGIC = b'PPANABD1'
+ABUNDANCE_HEADER_SIZE = 64 # magic (8), number of genes (uint64), pangenome md5 checksum (32 ascii), fraction of the reads mapped (float64, 0 if not recorded), padding
+
+
+"""Write a gene abundance vector (int64, aligned to the genes of the compiled pangenome)"""
+def write_abundance_binary(output_file, abundances, checksum, read_fraction=1.0):
+    import numpy
+    header = (ABUNDANCE_MAGIC + numpy.uint64(len(abundances)).tobytes() + checksum.encode('ascii') +
+              numpy.float64(read_fraction).astype('<f8').tobytes())
+    with open(output_file, mode='wb') as OUT:
+        OUT.write(header.ljust(ABUNDANCE_HEADER_SIZE, b'\0'))
+        numpy.asarray(abundances, dtype='<i8').tofile(OUT)
+
+
+"""Memory-map a gene abundance vector written by write_abundance_binary().
+If checksum is given, the vector must have been computed on the same pangenome.
+"""
+def read_abundance_binary(input_file, checksum=None):
+    import numpy
+    with open(input_file, mode='rb') as IN:
+        header = IN.read(ABUNDANCE_HEADER_SIZE)
+    if not header.startswith(ABUNDANCE_MAGIC):
+        sys.exit('[E] ' + input_file + ' is not a PanPhlAn binary abundance file')
+    numof_genes = int(numpy.frombuffer(header[8:16], dtype='<u8')[0])
+    file_checksum = header[16:48].decode('ascii')
+    if checksum is not None and file_checksum != checksum:
+        sys.exit('[E] ' + input_file + ' was computed on another pangenome (checksum ' + file_checksum + ', expected ' + checksum + ')')
+    return numpy.memmap(input_file, dtype='<i8', mode='r', offset=ABUNDANCE_HEADER_SIZE, shape=(numof_genes,))
+
+# ------------------------------------------------------------------------------
+#   BINARY COVERAGE MATRIX
+# ------------------------------------------------------------------------------
+COVMAT_MAGIC = b'PPANCOV1'
+COVMAT_HEADER_SIZE = 32 # magic (8), number of families, number of samples, length of the labels (uint64 each)
+COVMAT_ALIGNMENT = 64
+
+
+"""Write a families x samples coverage matrix as float32, sample-major (the families of a sample are contiguous),
+after the header and the JSON table of the family and sample labels.
+float32 keeps about 7 significant digits (relative error <= 2**-24): coverages above 16384 lose
+the third decimal of the text matrix, so a text matrix converted to binary and back may differ there
+"""
+def write_coverage_binary(output_file, families, samples, values):
+    import numpy
+    labels = json.dumps({'families' : list(families), 'samples' : list(samples)}).encode('utf-8')
+    offset = COVMAT_HEADER_SIZE + len(labels)
+    padding = (-offset) % COVMAT_ALIGNMENT
+    header = COVMAT_MAGIC + numpy.array([len(families), len(samples), len(labels) + padding], dtype='<u8').tobytes()
+    with open(output_file, mode='wb') as OUT:
+        OUT.write(header)
+        OUT.write(labels + b' ' * padding)
+        numpy.ascontiguousarray(numpy.asarray(values, dtype='<f4').T).tofile(OUT)
+
+
+"""Check the magic bytes of a binary coverage matrix"""
+def is_coverage_binary(input_file):
+    with open(input_file, mode='rb') as IN:
+        return IN.read(len(COVMAT_MAGIC)) == COVMAT_MAGIC
+
+
+"""Memory-map a coverage matrix written by write_coverage_binary(), only the columns of samples are read if given.
+:returns: families, samples, samples x families float32 array
+"""
+def read_coverage_binary(input_file, samples=None):
+    import numpy
+    with open(input_file, mode='rb') as IN:
+        header = IN.read(COVMAT_HEADER_SIZE)
+        if not header.startswith(COVMAT_MAGIC):
+            sys.exit('[E] ' + input_file + ' is not a PanPhlAn binary coverage matrix')
+        numof_families, numof_samples, labels_size = numpy.frombuffer(header[8:32], dtype='<u8').tolist()
+        labels = json.loads(IN.read(labels_size).decode('utf-8'))
+    if numof_samples * numof_families == 0: # nothing to map
+        data = numpy.zeros((numof_samples, numof_families), dtype='<f4')
+    else:
+        data = numpy.memmap(input_file, dtype='<f4', mode='r', offset=COVMAT_HEADER_SIZE + labels_size, shape=(numof_samples, numof_families))
+    if samples is None:
+        return labels['families'], labels['samples'], data
+    sample_idx = dict((s, j) for j, s in enumerate(labels['samples']))
+    missing = [s for s in samples if not s in sample_idx]
+    if missing:
+        sys.exit('[E] Samples not found in ' + input_file + ': ' + ', '.join(missing))
+    return labels['families'], list(samples), data[[sample_idx[s] for s in samples]]
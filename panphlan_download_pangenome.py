@@ -10,7 +10,7 @@ import re
 import argparse as ap
 from urllib.request import urlretrieve, urlcleanup
 
-from misc import info
+from misc import info, compile_pangenome
 
 author__ = 'Leonard Dubois and Nicola Segata (contact on https://forum.biobakery.org/)'
 __version__ = '3.0'
@@ -151,6 +151,12 @@ def main():
     sys.stdout.write('[I] File downloaded ! MD5 checked\n')
     extract_pangenome(filename, args.output)
     sys.stdout.write('[I] Archive extracted !\n')
+    # one-off binary form of the pangenome, loaded by the other PanPhlAn scripts
+    for root, dirs, files in os.walk(args.output):
+        for f in files:
+            if f.endswith('_pangenome.tsv'):
+                compile_pangenome(os.path.join(root, f), args.verbose)
+                sys.stdout.write('[I] Pangenome ' + f + ' compiled\n')
 
 
 if __name__ == '__main__':
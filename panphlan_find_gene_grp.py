@@ -17,6 +17,8 @@ from scipy.spatial.distance import pdist, jaccard
 from scipy import stats
 import argparse as ap
 
+from misc import load_pangenome
+
 author__ = 'Leonard Dubois and Nicola Segata (contact on https://forum.biobakery.org/)'
 __version__ = '3.0'
 __date__ = '20 April 2020'
@@ -208,8 +210,13 @@ def assessment_operon(clust_res, args):
     table_count = {a : list(clust_res.values()).count(a) for a in clust_res.values()}
     table_count = sorted(table_count, key = table_count.get, reverse = True)
 
-    pangenome_df = pd.read_csv(args.pangenome, sep = '\t', header = None)
-    pangenome_df.columns = ["UniRef", "name", "genome", "contig", "start", "stop"]
+    pangenome = load_pangenome(args.pangenome, args.verbose)
+    pangenome_df = pd.DataFrame({"UniRef" : pangenome.families[pangenome.gene_family],
+                                 "name" : pangenome.genes,
+                                 "genome" : pangenome.genomes[pangenome.gene_genome],
+                                 "contig" : pangenome.contigs[pangenome.gene_contig],
+                                 "start" : pangenome.gene_from,
+                                 "stop" : pangenome.gene_to})
 
     for cluster in table_count:
         if args.verbose : print("Analysing cluster : {} ".format(cluster))
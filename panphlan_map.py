@@ -5,12 +5,16 @@ panphlan_map.py
     Using bowtie2 indexes generated using panphlan_prepare_indexes.py script to map a metagenome sample to a pangenome.
 """
 
-import os, subprocess, sys, time, bz2, tempfile
+import os, subprocess, sys, time, bz2, tempfile, re, threading, copy, zlib, lzma, glob, queue, hashlib, shutil
+import multiprocessing, resource, json, platform
+import numpy
 import argparse as ap
+from array import array
 from collections import defaultdict
-from shutil import copyfileobj
+from contextlib import contextmanager
+from shutil import copyfileobj, which
 
-from misc import check_bowtie2
+from misc import check_bowtie2, load_pangenome, write_abundance_binary, ABUNDANCE_BINARY_SUFFIX
 
 __author__ = 'Leonard Dubois, Matthias Scholz, Thomas Tolio and Nicola Segata (contact on https://forum.biobakery.org/)'
 __version__ = '3.0'
@@ -18,6 +22,23 @@ __date__ = '20 April 2020'
 
 
 DEFAULT_MIN_READ_LENGTH = 70
+CIGAR_OPS = re.compile(rb'(\d+)([MIDNSHP=X])')
+INPUT_HEAD_SIZE = 1024 * 1024 # bytes read to detect the input format (a full bzip2 block is needed to look inside)
+STREAM_BUFFER_SIZE = 4 * 1024 * 1024 # bytes buffered by Python before blocking on a full pipe
+PRESCREEN_K = 21
+PRESCREEN_AUDIT_TAG = b'panphlan_audit:' # read name prefix of the rejected reads mapped to estimate the sensitivity
+TARGET_CHECK_INTERVAL = 10 # seconds between two estimates of the coverage (option --target_coverage)
+MPILEUP_MIN_BASE_QUALITY = 13 # samtools mpileup default, also given to samtools depth
+SAM_BATCH_SIZE = 8 * 1024 * 1024 # bytes of SAM records filtered per batch
+SAMTOOLS_EXPRESSION_VERSION = (1, 12) # first samtools release with 'view -e'
+SAM_SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400 # unmapped, secondary, QC fail, duplicate: ignored by mpileup too
+ALIGNMENT_SUFFIXES = ('.bam', '.sam', '.sam.gz')
+
+# Shared with the --manifest worker processes (inherited through fork)
+MANIFEST_ARGS = None
+MANIFEST_GENE_INDEX = None
+# Shared with the contig group pileup worker processes (inherited through fork)
+PILEUP_GENE_INDEX = None
 
 # ------------------------------------------------------------------------------
 """
@@ -26,28 +47,95 @@ Reads and parses the command line arguments of the script.
 """
 def read_params():
     p = ap.ArgumentParser(description="")
-    p.add_argument('-i', '--input', type = str, default=sys.stdin,
-                   help='Metagenomic sample to map')
-    p.add_argument('--indexes', type = str,
-                   help='Bowtie2 indexes path and file prefix')
-    p.add_argument('-p', '--pangenome', type = str,
-                   help='Path to pangenome tsv file exported from ChocoPhlAn')
+    p.add_argument('-i', '--input', type = str, nargs='+', default=sys.stdin,
+                   help='Metagenomic sample to map. Several files or glob patterns (e.g. lanes of one run, possibly in different compression formats) are mapped together as a single sample')
+    p.add_argument('--i_bam', type=str, nargs='+', default=None,
+                   help='BAM files already aligned to the PanPhlAn bowtie2 indexes: mapping is skipped, the records are filtered and go straight to coverage. '
+                        'With several files (or glob patterns), -o is a directory receiving one NAME_map.tsv output per file')
+    p.add_argument('--i_sam', type=str, nargs='+', default=None,
+                   help='Same as --i_bam for SAM files')
+    p.add_argument('--indexes', type = str, nargs='+',
+                   help='Bowtie2 indexes path and file prefix. With several species, one per --pangenome in the same order')
+    p.add_argument('-p', '--pangenome', type = str, nargs='+',
+                   help='Path to pangenome tsv file exported from ChocoPhlAn. Several pangenomes map the sample once against all the species '
+                        'and write one output per species: OUTPUT_DIR/SPECIES/OUTPUT_NAME, SPECIES being the pangenome file name without _pangenome.tsv')
+    p.add_argument('--combined_index_dir', type=str, default=None,
+                   help='With several species, directory where the bowtie2 index of all the species is built once and kept. '
+                        'Default: directory of the first --indexes (or the temporary directory if it is read-only)')
     p.add_argument('-o', '--output', type = str, default=None,
                    help='Path to output file')
     p.add_argument('--bt2', type=str, default='--very-sensitive',
                    help='Additional bowtie2 mapping options, separated by slash: /-D/20/-R/3/, default: -bt2 /--very-sensitive/')
+    p.add_argument('--out_format', type=str, default='tsv', choices=['tsv', 'bin'],
+                   help='Gene abundance output: bz2 compressed text (OUTPUT.bz2, default) or binary vector aligned to the compiled pangenome genes (OUTPUT' + ABUNDANCE_BINARY_SUFFIX + ')')
+    p.add_argument('--extra_stats', action='store_true',
+                   help='Add covered bases, mean depth and maximum depth of each gene as extra columns of the text output (not with --legacy_coverage). '
+                        'With --max_reads, --subsample or --target_coverage only the mean depth is scaled up to the whole sample, '
+                        'covered bases and maximum depth are those of the mapped reads (header line #unscaled_columns)')
     p.add_argument('-b','--out_bam', type=str, default=None,
                    help='Get BAM output file')
-    p.add_argument('--nproc', type=int, default=12,
-                   help='Maximum number of processors to use. Default is 12 or a lower number of available processors.')
+    p.add_argument('--nproc', type=int, default=None,
+                   help='Maximum number of processors to use, split between the stages running at the same time. Default is the number of processors available to the process (affinity and cgroup CPU quota)')
+    p.add_argument('--max_reads', type=int, default=None,
+                   help='Map at most this number of reads; the rest of the input is only counted and the abundances are scaled up to the whole sample')
+    p.add_argument('--subsample', type=float, default=1.0,
+                   help='Map a random fraction of the reads (each read is kept with this probability); the abundances are scaled up to the whole sample')
+    p.add_argument('--target_coverage', type=float, default=None,
+                   help='Stop mapping once the median depth of the covered genes reaches this value (e.g. 30); the abundances are scaled up to the whole sample. '
+                        'Combine with --subsample to map a random subset of the reads rather than the first ones')
+    p.add_argument('--seed', type=int, default=1,
+                   help='Seed of the random generator of --subsample. Default 1')
+    p.add_argument('--prescreen', action='store_true',
+                   help='Only send to bowtie2 the reads sharing k-mers with the pangenome. The k-mers are kept in a Bloom filter built once '
+                        'from the pangenome sequences and cached next to the indexes (INDEXES.kK.bloom)')
+    p.add_argument('--prescreen_fasta', type=str, default=None,
+                   help='Pangenome sequences for --prescreen. Default: extracted from the bowtie2 indexes with bowtie2-inspect')
+    p.add_argument('--prescreen_k', type=int, default=PRESCREEN_K,
+                   help='k-mer length of --prescreen (at most 32). Default ' + str(PRESCREEN_K))
+    p.add_argument('--prescreen_min_hits', type=int, default=3,
+                   help='Minimum number of read k-mers found in the pangenome for a read to be mapped. Default 3')
+    p.add_argument('--prescreen_audit', type=float, default=0.01,
+                   help='Fraction of the reads rejected by --prescreen that are mapped anyway, to estimate the sensitivity of the pre-screen. Default 0.01')
     p.add_argument('--min_read_length', type=int, default=DEFAULT_MIN_READ_LENGTH,
                    help='Minimum read length, default 70')
+    p.add_argument('--prefilter_length', action='store_true',
+                   help='Drop the reads shorter than --min_read_length before bowtie2 instead of after the alignment (the reads then go through Python)')
     p.add_argument('--th_mismatches', type=int, default=-1,
                    help='Number of mismatches to filter (bam)')
     p.add_argument('-m', '--sam_memory', type=float, default=4.0,
-                   help='Maximum amount of memory for Samtools (in Gb). Default 4')
+                   help='Maximum amount of memory for Samtools (in Gb), split between the samtools sort threads. Default 4, at most half of the memory available to the process (cgroup limit)')
     p.add_argument('--fasta', action='store_true',
                    help='Read are fasta format. By default considered as fastq')
+    p.add_argument('--filter_pushdown', action='store_true',
+                   help='Apply --min_read_length and --th_mismatches with a multi-threaded "samtools view -e" expression instead of the Python filter (samtools >= 1.12)')
+    p.add_argument('--stream', action='store_true',
+                   help='Stream the filtered alignments through a pipe into samtools sort instead of writing a temporary SAM file')
+    p.add_argument('--direct_coverage', action='store_true',
+                   help='Compute gene abundances directly from the filtered bowtie2 alignments, skipping samtools sort (unless --out_bam), index and mpileup. '
+                        'All aligned bases are counted (no mpileup base quality or maximum depth filter)')
+    p.add_argument('--coverage_backend', type=str, default='mpileup', choices=['mpileup', 'bedcov', 'depth'],
+                   help='How gene abundances are computed from the sorted BAM: full samtools mpileup (default), samtools bedcov or samtools depth '
+                        'over a BED of the pangenome genes, run on groups of contigs in parallel')
+    p.add_argument('--coverage_check', action='store_true',
+                   help='With --coverage_backend bedcov or depth, also run the mpileup backend and report the genes whose abundance differs')
+    p.add_argument('--legacy_coverage', action='store_true',
+                   help='Compute gene abundances with the original per-position loop instead of the per-contig depth arrays (slow, for validation only)')
+    p.add_argument('--cache_dir', type=str, default=None,
+                   help='Keep the filtered alignments, sorted BAM and gene abundances of each sample in this directory, '
+                        'keyed by a hash of the reads, indexes and options: re-runs resume from the last completed stage. '
+                        'With --direct_coverage only the gene abundances are cached, as no alignment file is written')
+    p.add_argument('--cache_max_gb', type=float, default=100.0,
+                   help='Maximum size of --cache_dir in Gb, least recently used entries are evicted first. Default 100')
+    p.add_argument('--telemetry', action='store_true',
+                   help='Write wall time, CPU time, peak memory, bytes, reads per second and temporary disk usage of each stage '
+                        'as a one-line JSON file OUTPUT.telemetry.json (concatenated sidecars of many runs are a JSON lines file)')
+    p.add_argument('--manifest', type=str, default=None,
+                   help='Map many samples: tab-separated file with one sample per line, INPUT <tab> OUTPUT [<tab> OUT_BAM]. INPUT can list several comma-separated files or glob patterns, '
+                        'or be an existing alignment (.bam, .sam, .sam.gz)')
+    p.add_argument('--jobs', type=int, default=None,
+                   help='With --manifest, number of samples mapped concurrently; --nproc and --sam_memory are split between them. Default: nproc/4')
+    p.add_argument('--skip_done', action='store_true',
+                   help='With --manifest, skip samples whose output file already exists')
     p.add_argument('-v', '--verbose', action='store_true',
                    help='Show progress information')
     return p.parse_args()
@@ -56,18 +144,270 @@ def read_params():
 """Check arguments consistency"""
 def check_args(args):
 
-    if args.input:
+    args.alignment, args.alignments = None, []
+    if args.i_bam or args.i_sam:
+        if args.manifest or not args.input is sys.stdin:
+            sys.exit('[E] Please provide either reads (-i or --input), alignments (--i_bam or --i_sam) or a manifest (--manifest).\n')
+        args.alignments = expand_inputs((args.i_bam or []) + (args.i_sam or []))
+        for aln_file in args.alignments:
+            if not os.path.exists(aln_file):
+                sys.exit('[E] Alignment file (' + aln_file + ') not found\n')
+        if len(args.alignments) == 1:
+            args.alignment = args.alignments[0]
+        elif args.output == None:
+            sys.exit('[E] Several alignment files need an output directory (argument -o or --output).\n')
+        elif args.out_bam:
+            sys.exit('[E] --out_bam cannot be used with several alignment files.\n')
+        else:
+            os.makedirs(args.output, exist_ok=True)
+    elif args.manifest:
+        if not os.path.exists(args.manifest):
+            sys.exit('[E] Manifest file (' + args.manifest + ') not found\n')
+    elif args.input:
         if not args.input is sys.stdin:
-            if not os.path.exists(args.input):
-                sys.exit('[E] Sample file (' + args.input + ') not found\n')
+            args.input = expand_inputs(args.input)
+            for input_path in args.input:
+                if not os.path.exists(input_path):
+                    sys.exit('[E] Sample file (' + input_path + ') not found\n')
     else:
         sys.exit('[E] Please provide a valid sample file (argument -i or --input).\n')
 
     if args.pangenome:
-        if not os.path.exists(args.pangenome):
-            sys.exit('[E] Pangenome file (' + args.pangenome + ') not found\n')
+        for pangenome_file in args.pangenome:
+            if not os.path.exists(pangenome_file):
+                sys.exit('[E] Pangenome file (' + pangenome_file + ') not found\n')
     else:
         sys.exit('[E] Please provide a valid pangenome file (argument -p or --pangenome).\n')
+    args.species = None
+    if len(args.pangenome) > 1:
+        check_species_args(args)
+    else:
+        args.pangenome = args.pangenome[0]
+        if args.indexes: args.indexes = args.indexes[0]
+
+    if args.telemetry and args.output == None and not args.manifest:
+        sys.exit('[E] --telemetry needs an output file (argument -o or --output).\n')
+    if args.out_format == 'bin' and args.output == None and not args.manifest:
+        sys.exit('[E] Binary output (--out_format bin) needs an output file (argument -o or --output).\n')
+    if args.extra_stats and (args.out_format == 'bin' or args.legacy_coverage or args.coverage_backend == 'bedcov'):
+        print('[W] --extra_stats is only written in the text output of the array based coverage engine (not with --coverage_backend bedcov)')
+    if args.coverage_backend != 'mpileup' and (args.direct_coverage or args.legacy_coverage):
+        sys.exit('[E] --coverage_backend ' + args.coverage_backend + ' cannot be used with --direct_coverage or --legacy_coverage.\n')
+
+    if not 0.0 < args.subsample <= 1.0:
+        sys.exit('[E] --subsample must be in ]0, 1].\n')
+    if (reads_sampling(args) or args.prescreen or args.prefilter_length) and args.alignments:
+        sys.exit('[E] --max_reads, --subsample, --target_coverage, --prescreen and --prefilter_length apply to reads, not to alignments (--i_bam, --i_sam).\n')
+    if args.prescreen and not 0 < args.prescreen_k <= 32:
+        sys.exit('[E] --prescreen_k must be between 1 and 32.\n')
+    if args.prescreen_fasta and not os.path.exists(args.prescreen_fasta):
+        sys.exit('[E] Pangenome fasta file (' + args.prescreen_fasta + ') not found\n')
+
+    cpus, memory = available_cpus(), available_memory()
+    if args.nproc == None:
+        args.nproc = cpus
+    elif args.nproc > cpus:
+        print('[W] Only ' + str(cpus) + ' processors are available, --nproc ' + str(args.nproc) + ' is lowered to ' + str(cpus))
+        args.nproc = cpus
+    if memory and args.sam_memory * 1024*1024*1024 > memory / 2:
+        args.sam_memory = round(memory / 2 / (1024.0*1024*1024), 2)
+        print('[W] --sam_memory is lowered to ' + str(args.sam_memory) + ' Gb, half of the memory available')
+
+"""Check the arguments of a multi-species run, args.species becomes the list of (SPECIES, INDEXES, PANGENOME)"""
+def check_species_args(args):
+    if not args.alignments and (args.indexes == None or len(args.indexes) != len(args.pangenome)):
+        sys.exit('[E] Please provide one bowtie2 index (--indexes) per pangenome (-p or --pangenome).\n')
+    if args.output == None:
+        sys.exit('[E] Several species need an output file (argument -o or --output).\n')
+    if args.legacy_coverage or args.target_coverage is not None:
+        sys.exit('[E] --legacy_coverage and --target_coverage need a single species.\n')
+    if args.cache_dir:
+        print('[W] --cache_dir is not used with several species')
+        args.cache_dir = None
+    names = [species_name(p) for p in args.pangenome]
+    if len(set(names)) < len(names):
+        sys.exit('[E] Several pangenomes have the same species name: ' + ', '.join(names) + '\n')
+    args.species = list(zip(names, args.indexes if args.indexes else [None] * len(names), args.pangenome))
+
+
+"""Species name of a pangenome file: its name without _pangenome.tsv"""
+def species_name(pangenome_file):
+    name = os.path.basename(pangenome_file)
+    for suffix in ['_pangenome.tsv', '.tsv']:
+        if name.endswith(suffix): return name[:-len(suffix)]
+    return name
+
+
+"""Expand glob patterns of the input reads files, keeping the order given on the command line"""
+def expand_inputs(patterns):
+    inputs = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if not os.path.exists(pattern) else [pattern]
+        inputs += matches if matches else [pattern]
+    return inputs
+
+# ------------------------------------------------------------------------------
+#   RESOURCES
+# ------------------------------------------------------------------------------
+SORT_MIN_THREAD_MEMORY = 256 * 1024*1024 # below this samtools sort spills too many temporary files
+
+
+"""Read the first line of a control file of the cgroup filesystem, None if it does not exist"""
+def read_cgroup_value(path):
+    try:
+        with open(path, mode='r') as IN:
+            return IN.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+"""Number of processors the process can use: CPU affinity, lowered by the cgroup CPU quota (containers, batch schedulers)"""
+def available_cpus():
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else multiprocessing.cpu_count()
+    quota, period = None, None
+    cpu_max = read_cgroup_value('/sys/fs/cgroup/cpu.max') # cgroup v2: "<quota> <period>" or "max <period>"
+    if cpu_max and not cpu_max.startswith('max'):
+        quota, period = cpu_max.split()[:2]
+    else: # cgroup v1, quota is -1 when unlimited
+        quota = read_cgroup_value('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        period = read_cgroup_value('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    try:
+        if int(quota) > 0 and int(period) > 0:
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (TypeError, ValueError):
+        pass
+    return cpus
+
+
+"""Memory (in bytes) the process can use: physical memory, lowered by the cgroup memory limit. None if unknown"""
+def available_memory():
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        memory = None
+    for path in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']: # cgroup v2, v1
+        limit = read_cgroup_value(path)
+        if limit and limit.isdigit() and int(limit) < (1 << 60): # v1 reports unlimited as a huge number
+            memory = min(memory, int(limit)) if memory else int(limit)
+    return memory
+
+
+"""Split the --nproc processors between the stages of a sample.
+Stages running at the same time share the processors:
+    mapping     reads decompression, bowtie2 and the samtools view -e filter (--filter_pushdown)
+    decoding    samtools view decoding existing alignments (--i_bam) while Python filters the records
+Dependent stages start once the previous one is over and get all the processors:
+    sorting     samtools sort, with --sam_memory split between its threads
+    indexing    samtools index, waited for before samtools mpileup starts
+    coverage    samtools mpileup workers or bedcov/depth processes on groups of contigs
+:returns: dictionary stage -> number of threads
+"""
+def stage_threads(args):
+    nproc = max(1, int(args.nproc))
+    helpers = max(1, nproc // 8)
+    # parallel decompressors keep at least 2 threads: they mostly wait on bowtie2,
+    # so only the helpers share of them is taken from the bowtie2 threads
+    threads = {'decompress' : max(2, nproc // 4),
+               'filter'     : helpers if args.filter_pushdown else 0,
+               'decode'     : max(1, nproc - 1),
+               'index'      : nproc,
+               'coverage'   : nproc}
+    threads['bowtie2'] = max(1, nproc - helpers - threads['filter'])
+    threads['bowtie2_plain'] = max(1, nproc - threads['filter']) # no decompressor running
+    # each samtools sort thread keeps up to -m bytes in memory
+    sort_memory = int(args.sam_memory * 1024*1024*1024)
+    threads['sort'] = max(1, min(nproc, sort_memory // SORT_MIN_THREAD_MEMORY))
+    threads['sort_memory'] = sort_memory // threads['sort']
+    return threads
+
+
+"""samtools sort options of the thread and memory budget"""
+def sort_options(args):
+    threads = stage_threads(args)
+    return ['-@', str(threads['sort']), '-m', str(threads['sort_memory'])]
+
+# ------------------------------------------------------------------------------
+#   TELEMETRY
+# ------------------------------------------------------------------------------
+TELEMETRY_SUFFIX = '.telemetry.json'
+TELEMETRY_VERSION = 1
+
+
+class Telemetry():
+    """Per-stage measures of a sample (option --telemetry), written as a JSON sidecar of the output.
+    Each stage records:
+        wall_s                  elapsed time
+        cpu_self_s              CPU time (user + system) of panphlan_map itself
+        cpu_children_s          CPU time of the bowtie2/samtools/decompressor processes waited for in the stage
+        maxrss_self_kb          peak resident memory of panphlan_map so far
+        maxrss_children_kb      peak resident memory of the largest child process so far
+        tmp_bytes               size of the temporary files alive at the end of the stage
+    plus the counters of the stage (bytes through the pipes, reads seen and accepted, reads_per_sec).
+    """
+
+    def __init__(self, args):
+        self.enabled = args.telemetry
+        self.start = time.time()
+        self.stages = []
+        self.current = None
+        self.tmp_files = set()
+
+    @contextmanager
+    def stage(self, name):
+        record = {'stage' : name}
+        self.stages.append(record)
+        self.current = record
+        wall = time.time()
+        usage_self, usage_children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield record
+        finally:
+            end_self, end_children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+            record['wall_s'] = round(time.time() - wall, 3)
+            record['cpu_self_s'] = max(0.0, round(end_self.ru_utime + end_self.ru_stime - usage_self.ru_utime - usage_self.ru_stime, 3))
+            record['cpu_children_s'] = max(0.0, round(end_children.ru_utime + end_children.ru_stime - usage_children.ru_utime - usage_children.ru_stime, 3))
+            record['maxrss_self_kb'] = end_self.ru_maxrss
+            record['maxrss_children_kb'] = end_children.ru_maxrss
+            record['tmp_bytes'] = self.tmp_bytes()
+            if 'reads_seen' in record and record['wall_s'] > 0:
+                record['reads_per_sec'] = int(record['reads_seen'] / record['wall_s'])
+            self.current = None
+
+    def count(self, key, value):
+        """Add value to a counter of the current stage"""
+        if self.current is not None:
+            self.current[key] = self.current.get(key, 0) + value
+
+    def file_size(self, key, path):
+        """Record the size of a file produced by the current stage"""
+        if self.current is not None and path and os.path.exists(path):
+            self.current[key] = os.path.getsize(path)
+
+    def tmp_file(self, path):
+        """Register a temporary file in the temporary disk usage"""
+        self.tmp_files.add(path)
+
+    def tmp_bytes(self):
+        return sum(os.path.getsize(f) for f in self.tmp_files if os.path.exists(f))
+
+    def write(self, args, status):
+        if not self.enabled or args.output == None: return
+        inputs = [args.alignment] if args.alignment else ([] if args.input is sys.stdin else args.input)
+        report = {'version' : TELEMETRY_VERSION,
+                  'output' : output_file(args.output, args),
+                  'inputs' : inputs,
+                  'status' : status,
+                  'host' : platform.node(),
+                  'nproc' : int(args.nproc),
+                  'sam_memory_gb' : args.sam_memory,
+                  'options' : {'stream' : args.stream, 'direct_coverage' : args.direct_coverage,
+                               'filter_pushdown' : args.filter_pushdown, 'cache' : args.cache_dir is not None},
+                  'start' : round(self.start, 3),
+                  'wall_s' : round(time.time() - self.start, 3),
+                  'peak_tmp_bytes' : max([s.get('tmp_bytes', 0) for s in self.stages] + [0]),
+                  'stages' : self.stages}
+        with open(args.output + TELEMETRY_SUFFIX, mode='w') as OUT:
+            OUT.write(json.dumps(report, sort_keys=True) + '\n')
 
 # ------------------------------------------------------------------------------
 #   STEP 1
@@ -95,26 +435,593 @@ def check_samtools():
 # ------------------------------------------------------------------------------
 #   STEP 2
 # ------------------------------------------------------------------------------
-"""Get sample file name and extension"""
-def check_input(input_path):
-    if not input_path is sys.stdin :
-        decompress_cmd = {}
-        decompress_cmd['tar.bz2']  = ['tar', '-jxOf']
-        decompress_cmd['tar.gz']   = ['tar', '-zxOf']
-        decompress_cmd['gz']       = ['gunzip', '-c']
-        decompress_cmd['bz2']      = ['bzcat']
-        decompress_cmd['sra']      = ['fastq-dump', '-Z', '--split-spot', '--minReadLen', str(DEFAULT_MIN_READ_LENGTH)]
-        for extension in decompress_cmd.keys():
-            if input_path.endswith(extension):
-                to_do = decompress_cmd[extension]
-                to_do.append(input_path)
-                print('[I] ' + 'input_path')
-                return to_do
+# Compression formats recognized from the first bytes of the input
+MAGIC_BYTES = [(b'\x1f\x8b', 'gz'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz'), (b'\x28\xb5\x2f\xfd', 'zst'), (b'NCBI.sra', 'sra')]
+# Parallel block decompressors, preferred in this order when installed ({} is the number of threads)
+PARALLEL_DECOMPRESSORS = {'gz' : [('pigz', ['-p', '{}'])],
+                          'bz2' : [('lbzip2', ['-n', '{}']), ('pbzip2', ['-p{}'])],
+                          'xz' : [('xz', ['-T', '{}'])]}
+SERIAL_DECOMPRESSORS = {'gz' : ['gunzip', '-c'], 'bz2' : ['bzcat'], 'xz' : ['xz', '-dc'], 'zst' : ['zstd', '-dc']}
+TAR_OPTIONS = {'gz' : '-z', 'bz2' : '-j', 'xz' : '-J', 'zst' : '--zstd'}
+
+
+"""Read the first bytes of a stream, waiting for a slow pipe if needed"""
+def read_head(stream, size=INPUT_HEAD_SIZE):
+    head = b''
+    while len(head) < size:
+        data = stream.read(size - len(head))
+        if not data: break
+        head += data
+    return head
+
+
+"""Detect the input format from its first bytes.
+:returns: (compression, is_tar) with compression in gz, bz2, xz, zst, sra or None for plain reads
+"""
+def detect_format(head):
+    compression = None
+    for magic, fmt in MAGIC_BYTES:
+        if head.startswith(magic):
+            compression = fmt
+            break
+    content = head
+    try:
+        if compression == 'gz':
+            content = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(head, 512)
+        elif compression == 'bz2':
+            content = bz2.BZ2Decompressor().decompress(head, 512)
+        elif compression == 'xz':
+            content = lzma.LZMADecompressor().decompress(head, 512)
+        elif compression is not None:
+            content = b''
+    except (zlib.error, OSError, EOFError, lzma.LZMAError):
+        content = b''
+    return compression, content[257:262] == b'ustar'
+
+
+"""Command of the fastest installed decompressor for a format, None if no parallel tool is available"""
+def parallel_decompressor(compression, threads):
+    for tool, options in PARALLEL_DECOMPRESSORS.get(compression, []):
+        if which(tool):
+            return [tool] + [o.format(threads) for o in options]
     return None
 
 
+"""Get the command writing the decompressed reads on stdout, None if the reads are not compressed.
+The format is detected from the magic bytes of the file, or of head for stdin (input_path is None)
+"""
+def check_input(input_path, threads=1, head=None):
+    if head is None:
+        with open(input_path, mode='rb') as IN:
+            head = read_head(IN)
+    compression, is_tar = detect_format(head)
+    if not is_tar and input_path and re.search(r'\.tar(\.\w+)?$', input_path):
+        is_tar = True # when the tar header is beyond the detection window, trust the extension
+    if compression == 'sra':
+        if input_path is None:
+            sys.exit('[E] SRA input cannot be read from stdin\n')
+        to_do = ['fastq-dump', '-Z', '--split-spot', '--minReadLen', str(DEFAULT_MIN_READ_LENGTH), input_path]
+    else:
+        parallel = parallel_decompressor(compression, threads)
+        if is_tar:
+            if parallel: to_do = ['tar', '-I', ' '.join(parallel), '-xOf']
+            elif compression: to_do = ['tar', TAR_OPTIONS[compression], '-xOf']
+            else: to_do = ['tar', '-xOf']
+            to_do.append(input_path if input_path else '-')
+        elif parallel:
+            to_do = parallel + ['-dc'] + ([input_path] if input_path else [])
+        elif compression:
+            to_do = SERIAL_DECOMPRESSORS[compression] + ([input_path] if input_path else [])
+        else:
+            return None
+    print('[I] ' + ' '.join(to_do))
+    return to_do
+
+
+"""Write head then the rest of src into dst (used when Python has already consumed the start of stdin)"""
+def feed_stream(head, src, dst):
+    try:
+        dst.write(head)
+        copyfileobj(src, dst, STREAM_BUFFER_SIZE)
+    except BrokenPipeError: # the reader died, its error code is reported by the caller
+        pass
+    finally:
+        try:
+            dst.close()
+        except BrokenPipeError:
+            pass
+
+
+"""Split a reads stream into chunks ending on a record boundary, so that chunks of several files can be interleaved"""
+def record_chunks(stream, fasta, size=STREAM_BUFFER_SIZE):
+    pending = []
+    while True:
+        lines = stream.readlines(size)
+        if not lines: break
+        if not lines[-1].endswith(b'\n'): lines[-1] += b'\n' # last line of a file without final newline
+        lines = pending + lines
+        if fasta: # records start with a '>' line, sequences may span several lines
+            cut = len(lines) - 1
+            while cut > 0 and not lines[cut].startswith(b'>'): cut -= 1
+        else: # 4 lines per FASTQ record
+            cut = len(lines) - len(lines) % 4
+        pending = lines[cut:]
+        if cut > 0: yield b''.join(lines[:cut])
+    if pending: yield b''.join(pending)
+
+
+"""Number of reads in a chunk cut by record_chunks()"""
+def count_records(chunk, fasta):
+    if fasta:
+        return chunk.count(b'\n>') + (1 if chunk.startswith(b'>') else 0)
+    return chunk.count(b'\n') // 4
+
+
+"""Reads of a chunk cut by record_chunks(), each one with its lines"""
+def split_records(chunk, fasta):
+    if fasta:
+        parts = chunk[1:].split(b'\n>')
+        return [b'>' + part + b'\n' for part in parts[:-1]] + [b'>' + parts[-1]]
+    lines = chunk.splitlines(True)
+    return [b''.join(lines[i:i+4]) for i in range(0, len(lines), 4)]
+
+
+class ReadsLengthFilter():
+    """Drop the reads shorter than --min_read_length before bowtie2 (option --prefilter_length).
+    Whole chunks are processed with NumPy: the read lengths come from the newline
+    positions, and the bytes of the kept reads are selected with a mask.
+    """
+
+    def __init__(self, args):
+        self.fasta = args.fasta
+        self.min_length = args.min_read_length
+        self.seen, self.kept = 0, 0
+
+    def filter(self, chunk):
+        """:returns: the reads of chunk long enough to be mapped"""
+        data = numpy.frombuffer(chunk, dtype=numpy.uint8)
+        newlines = numpy.flatnonzero(data == ord('\n'))
+        if self.fasta:
+            line_starts = numpy.concatenate(([True], data[:-1] == ord('\n')))
+            starts = numpy.flatnonzero((data == ord('>')) & line_starts)
+            if len(starts) == 0 or starts[0] != 0: return chunk # not cut by record_chunks(), left to bowtie2
+            ends = numpy.append(starts[1:], len(data))
+            header_ends = newlines[numpy.searchsorted(newlines, starts)]
+            # sequence bytes, minus the newlines of multi-line sequences
+            lengths = (ends - header_ends - 1) - (numpy.searchsorted(newlines, ends) - numpy.searchsorted(newlines, header_ends + 1))
+        else:
+            if len(newlines) % 4 != 0: return chunk # truncated record, left to bowtie2
+            line_ends = newlines.reshape(-1, 4)
+            ends = line_ends[:, 3] + 1
+            starts = numpy.concatenate(([0], ends[:-1]))
+            lengths = line_ends[:, 1] - line_ends[:, 0] - 1
+        keep = lengths >= self.min_length
+        self.seen += len(keep)
+        self.kept += int(keep.sum())
+        if keep.all(): return chunk
+        return data[numpy.repeat(keep, ends - starts)].tobytes()
+
+    def report(self, args):
+        args.telemetry_recorder.count('prefilter_reads', self.seen)
+        args.telemetry_recorder.count('prefilter_dropped', self.seen - self.kept)
+        print('[I] Pre-alignment length filter: ' + str(self.seen - self.kept) + ' reads shorter than ' + str(self.min_length) +
+              ' dropped over ' + str(self.seen) + ' total')
+
+
+"""True when only part of the reads is mapped (options --max_reads, --subsample, --target_coverage)"""
+def reads_sampling(args):
+    return args.max_reads is not None or args.subsample < 1.0 or args.target_coverage is not None
+
+
+class ReadsSampler():
+    """Subsampling of the reads fed to bowtie2 (options --max_reads, --subsample, --target_coverage).
+    Reads are kept with probability --subsample until --max_reads reads have been fed or
+    stop() is called (--target_coverage reached). The rest of the input is still read to
+    count the reads, so that fraction() = fed reads / input reads scales the abundances
+    back to the whole sample.
+    """
+
+    def __init__(self, args):
+        self.fasta = args.fasta
+        self.max_reads = args.max_reads
+        self.probability = args.subsample
+        self.random = numpy.random.RandomState(args.seed)
+        self.seen, self.fed = 0, 0
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def sample(self, chunk):
+        """:returns: the part of chunk to feed to bowtie2"""
+        if self.stopped.is_set():
+            self.seen += count_records(chunk, self.fasta)
+            return b''
+        if self.probability >= 1.0 and self.max_reads is None: # --target_coverage alone
+            numof_reads = count_records(chunk, self.fasta)
+            self.seen += numof_reads
+            self.fed += numof_reads
+            return chunk
+        records = split_records(chunk, self.fasta)
+        self.seen += len(records)
+        if self.probability < 1.0:
+            keep = self.random.random_sample(len(records)) < self.probability
+            records = [r for r, k in zip(records, keep) if k]
+        if self.max_reads is not None and self.fed + len(records) >= self.max_reads:
+            records = records[:self.max_reads - self.fed]
+            self.stopped.set()
+        self.fed += len(records)
+        return b''.join(records)
+
+    def fraction(self):
+        return self.fed / float(self.seen) if self.seen > 0 else 1.0
+
+
+class ReadsInput():
+    """Decompression front-end of bowtie2.
+    Compressed reads go through a decompressor (parallel one when installed),
+    stdin is sniffed for compression and re-fed from Python.
+    Several input files are decompressed concurrently: one thread per file
+    cuts the reads into record-aligned chunks, and a writer thread merges them
+    into the stdin of a single bowtie2 run.
+    When the reads are filtered on length, subsampled or pre-screened (in this order),
+    every input goes through that Python path.
+    """
+
+    def __init__(self, args):
+        self.input = args.input
+        self.fasta = args.fasta
+        # the decompression budget is shared by the files decompressed at the same time
+        self.threads = max(2, stage_threads(args)['decompress'] // (1 if self.input is sys.stdin else len(self.input)))
+        self.processes = []
+        self.feeders = []
+        self.stopped = threading.Event() # set by kill(): the feeders stop reading the inputs
+        self.head = None
+        self.sources = []
+        self.chunks = None
+        self.sampler = ReadsSampler(args) if reads_sampling(args) else None
+        self.prescreen = ReadsPrescreen(args) if args.prescreen else None
+        self.length_filter = ReadsLengthFilter(args) if args.prefilter_length else None
+        self.processing = self.sampler or self.prescreen or self.length_filter # the reads go through Python
+
+    def start(self):
+        """Start the decompression. :returns: (bowtie2 -U argument, stdin for bowtie2)"""
+        if self.input is sys.stdin:
+            self.head = read_head(sys.stdin.buffer)
+            preprocess_cmd = check_input(None, self.threads, self.head)
+            if self.processing:
+                self.chunks = queue.Queue(maxsize=4)
+                if preprocess_cmd:
+                    p0 = subprocess.Popen(preprocess_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                    self.processes.append((p0, preprocess_cmd[0]))
+                    self.start_feeder(feed_stream, (self.head, sys.stdin.buffer, p0.stdin))
+                    self.sources.append(p0.stdout)
+                else:
+                    r, w = os.pipe()
+                    self.start_feeder(feed_stream, (self.head, sys.stdin.buffer, os.fdopen(w, mode='wb')))
+                    self.sources.append(os.fdopen(r, mode='rb'))
+                return '-', subprocess.PIPE
+            if preprocess_cmd:
+                p0 = subprocess.Popen(preprocess_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                self.processes.append((p0, preprocess_cmd[0]))
+                self.start_feeder(feed_stream, (self.head, sys.stdin.buffer, p0.stdin))
+                return '-', p0.stdout
+            return '-', subprocess.PIPE
+
+        preprocess_cmds = [check_input(path, self.threads) for path in self.input]
+        if not any(preprocess_cmds) and not self.processing: # plain files are read by bowtie2 itself
+            return ','.join(self.input), None
+        if len(self.input) == 1 and not self.processing:
+            p0 = subprocess.Popen(preprocess_cmds[0], stdout=subprocess.PIPE)
+            self.processes.append((p0, preprocess_cmds[0][0]))
+            return '-', p0.stdout
+
+        # several files (or reads processed by Python): decompress all of them at once into record-aligned chunks
+        self.chunks = queue.Queue(maxsize=4 * len(self.input))
+        for path, preprocess_cmd in zip(self.input, preprocess_cmds):
+            if preprocess_cmd:
+                p = subprocess.Popen(preprocess_cmd, stdout=subprocess.PIPE)
+                self.processes.append((p, preprocess_cmd[0]))
+                self.sources.append(p.stdout)
+            else:
+                self.sources.append(open(path, mode='rb'))
+        return '-', subprocess.PIPE
+
+    def start_feeder(self, target, arguments):
+        feeder = threading.Thread(target=target, args=arguments)
+        feeder.daemon = True # never keep the program alive once bowtie2 is gone
+        feeder.start()
+        self.feeders.append(feeder)
+
+    def read_source(self, source):
+        try:
+            for chunk in record_chunks(source, self.fasta):
+                if self.stopped.is_set(): break
+                self.chunks.put(chunk)
+        finally:
+            source.close()
+            self.chunks.put(None)
+
+    def write_chunks(self, dst):
+        remaining = len(self.sources)
+        closed = False
+        while remaining > 0:
+            chunk = self.chunks.get()
+            if chunk is None:
+                remaining -= 1
+                continue
+            if self.stopped.is_set(): # keep draining so that readers end
+                closed = True
+                continue
+            if self.length_filter:
+                chunk = self.length_filter.filter(chunk)
+            if self.sampler and chunk:
+                chunk = self.sampler.sample(chunk)
+            if self.prescreen and chunk:
+                chunk = self.prescreen.screen(chunk)
+            if not closed and chunk:
+                try:
+                    dst.write(chunk)
+                except BrokenPipeError: # bowtie2 died, keep draining so that readers end
+                    closed = True
+            if not closed and self.sampler and self.sampler.stopped.is_set():
+                # bowtie2 finishes the reads fed so far, the rest is only counted
+                closed = True
+                try:
+                    dst.close()
+                except BrokenPipeError:
+                    pass
+        try:
+            dst.close()
+        except BrokenPipeError:
+            pass
+
+    def started(self, p_bowtie2):
+        """Called once bowtie2 runs: hand the pipes over to it"""
+        if self.sources:
+            for source in self.sources:
+                self.start_feeder(self.read_source, (source,))
+            self.start_feeder(self.write_chunks, (p_bowtie2.stdin,))
+            return
+        for p, name in self.processes:
+            p.stdout.close() # bowtie2 owns the pipe now, so the decompressor gets SIGPIPE if bowtie2 dies
+        if self.input is sys.stdin and not self.processes:
+            self.start_feeder(feed_stream, (self.head, sys.stdin.buffer, p_bowtie2.stdin))
+
+    def kill(self):
+        self.stopped.set()
+        for p, name in self.processes:
+            p.kill()
+
+    def wait(self):
+        for feeder in self.feeders:
+            feeder.join()
+        for p, name in self.processes:
+            check_returncode(p, name)
+
+
+# ------------------------------------------------------------------------------
+#   K-MER PRE-SCREEN
+# ------------------------------------------------------------------------------
+BLOOM_MAGIC = b'PPANBLM1'
+BLOOM_HEADER_SIZE = 64 # magic (8), k (uint64), number of hashes (uint64), number of bits (uint64), md5 of the source sequences identity (32 ascii)
+BLOOM_BITS_PER_KMER = 16
+BLOOM_HASHES = 4 # about 0.25% false positive k-mers with 16 bits per k-mer
+BLOOM_BATCH_SIZE = 16 * 1024 * 1024 # bases of reference encoded at once
+
+# A C G T (either case) -> 0..3, anything else -> 4 (k-mers containing it are skipped)
+BASE_CODES = numpy.full(256, 4, dtype=numpy.uint8)
+for i, base in enumerate(b'ACGT'):
+    BASE_CODES[base] = BASE_CODES[base + 32] = i
+
+
+"""Canonical (minimum of both strands) 2-bit encoded k-mers of a sequence of BASE_CODES.
+:returns: array of k-mers, and boolean array of the k-mers without invalid base
+"""
+def canonical_kmers(codes, k):
+    n = len(codes) - k + 1
+    if n <= 0:
+        return numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=bool)
+    bases = (codes & 3).astype(numpy.uint64)
+    forward = numpy.zeros(n, dtype=numpy.uint64)
+    reverse = numpy.zeros(n, dtype=numpy.uint64)
+    two, three = numpy.uint64(2), numpy.uint64(3)
+    for j in range(k):
+        window = bases[j:j + n]
+        forward = (forward << two) | window
+        reverse |= (three - window) << numpy.uint64(2 * j) # complement of base j is base k-1-j of the reverse strand
+    invalid = numpy.zeros(len(codes) + 1, dtype=numpy.int64)
+    numpy.cumsum(codes > 3, out=invalid[1:])
+    valid = invalid[k:] - invalid[:n] == 0
+    return numpy.minimum(forward, reverse), valid
+
+
+"""Bit positions of k-mers in a Bloom filter of mask + 1 bits (double hashing)"""
+def bloom_positions(kmers, numof_hashes, mask):
+    h1 = kmers * numpy.uint64(0x9E3779B97F4A7C15)
+    h1 ^= h1 >> numpy.uint64(29)
+    h2 = kmers * numpy.uint64(0xC2B2AE3D27D4EB4F)
+    h2 ^= h2 >> numpy.uint64(31)
+    h2 |= numpy.uint64(1)
+    return [(h1 + numpy.uint64(i) * h2) & mask for i in range(numof_hashes)]
+
+
+"""Sequences of a FASTA file, in batches of about BLOOM_BATCH_SIZE bases separated by an invalid base"""
+def fasta_batches(fasta_file):
+    batch, size = [], 0
+    with open(fasta_file, mode='rb') as IN:
+        for line in IN:
+            if line.startswith(b'>'):
+                if size >= BLOOM_BATCH_SIZE:
+                    yield b''.join(batch)
+                    batch, size = [], 0
+                batch.append(b'N')
+            else:
+                line = line.rstrip()
+                batch.append(line)
+                size += len(line)
+    if batch: yield b''.join(batch)
+
+
+class KmerBloomFilter():
+    """Membership of the k-mers of the pangenome sequences (option --prescreen).
+    Built from the pangenome fasta (or bowtie2-inspect of the indexes) and kept in
+    INDEXES.kK.bloom, rebuilt when the sequences change.
+    """
+
+    def __init__(self, bloom_file):
+        with open(bloom_file, mode='rb') as IN:
+            header = IN.read(BLOOM_HEADER_SIZE)
+        if not header.startswith(BLOOM_MAGIC):
+            sys.exit('[E] ' + bloom_file + ' is not a PanPhlAn k-mer Bloom filter')
+        self.k, self.numof_hashes, numof_bits = (int(v) for v in numpy.frombuffer(header[8:32], dtype='<u8'))
+        self.checksum = header[32:64].decode('ascii')
+        self.mask = numpy.uint64(numof_bits - 1)
+        self.bits = numpy.memmap(bloom_file, dtype=numpy.uint8, mode='r', offset=BLOOM_HEADER_SIZE, shape=(numof_bits // 8,))
+
+    def contains(self, kmers):
+        found = numpy.ones(len(kmers), dtype=bool)
+        for positions in bloom_positions(kmers, self.numof_hashes, self.mask):
+            found &= ((self.bits[positions >> numpy.uint64(3)] >> (positions & numpy.uint64(7)).astype(numpy.uint8)) & 1).astype(bool)
+        return found
+
+
+"""Build the Bloom filter of the canonical k-mers of a fasta file"""
+def build_bloom_filter(fasta_file, k, bloom_file, checksum):
+    numof_bits = 1 << max(13, int(os.path.getsize(fasta_file) * BLOOM_BITS_PER_KMER - 1).bit_length())
+    mask = numpy.uint64(numof_bits - 1)
+    bits = numpy.zeros(numof_bits // 8, dtype=numpy.uint8)
+    numof_kmers = 0
+    for sequences in fasta_batches(fasta_file):
+        kmers, valid = canonical_kmers(BASE_CODES[numpy.frombuffer(sequences, dtype=numpy.uint8)], k)
+        kmers = kmers[valid]
+        numof_kmers += len(kmers)
+        for positions in bloom_positions(kmers, BLOOM_HASHES, mask):
+            numpy.bitwise_or.at(bits, positions >> numpy.uint64(3),
+                                numpy.left_shift(numpy.uint8(1), (positions & numpy.uint64(7)).astype(numpy.uint8)))
+    header = BLOOM_MAGIC + numpy.array([k, BLOOM_HASHES, numof_bits], dtype='<u8').tobytes() + checksum.encode('ascii')
+    with open(bloom_file + '.tmp', mode='wb') as OUT:
+        OUT.write(header.ljust(BLOOM_HEADER_SIZE, b'\0'))
+        bits.tofile(OUT)
+    os.replace(bloom_file + '.tmp', bloom_file)
+    print('[I] k-mer Bloom filter of ' + str(numof_kmers) + ' k-mers (' + str(numof_bits // 8 // (1024*1024)) + ' Mb) written in ' + bloom_file)
+
+
+"""Load the Bloom filter of the pangenome k-mers, building it first if needed.
+It is cached next to the indexes (or in the temporary directory when the indexes directory is read-only)
+"""
+def load_bloom_filter(args):
+    if args.prescreen_fasta:
+        source_files = [args.prescreen_fasta]
+    else:
+        source_files = sorted(glob.glob(args.indexes + '.*bt2*'))
+    identity = '|'.join(os.path.abspath(p) + ':' + str(os.path.getsize(p)) + ':' + str(os.stat(p).st_mtime_ns) for p in source_files)
+    checksum = hashlib.md5(identity.encode('utf-8')).hexdigest()
+
+    candidates = [args.indexes + '.k' + str(args.prescreen_k) + '.bloom',
+                  os.path.join(tempfile.gettempdir(), 'panphlan_' + checksum + '.k' + str(args.prescreen_k) + '.bloom')]
+    for bloom_file in candidates:
+        if os.path.exists(bloom_file):
+            bloom = KmerBloomFilter(bloom_file)
+            if bloom.checksum == checksum and bloom.k == args.prescreen_k:
+                return bloom
+
+    fasta_file = args.prescreen_fasta
+    if fasta_file is None: # reference sequences of the bowtie2 indexes
+        tmp_fasta = tempfile.NamedTemporaryFile(delete=False, prefix='panphlan_', suffix='.fna')
+        inspect_cmd = ['bowtie2-inspect', args.indexes]
+        print('[I] ' + ' '.join(inspect_cmd))
+        check_returncode(subprocess.Popen(inspect_cmd, stdout=tmp_fasta), 'bowtie2-inspect')
+        tmp_fasta.close()
+        fasta_file = tmp_fasta.name
+    try:
+        for bloom_file in candidates:
+            try:
+                build_bloom_filter(fasta_file, args.prescreen_k, bloom_file, checksum)
+                return KmerBloomFilter(bloom_file)
+            except (IOError, OSError) as err:
+                print('[W] Cannot write the k-mer Bloom filter in ' + bloom_file + ': ' + str(err))
+    finally:
+        if args.prescreen_fasta is None: os.unlink(fasta_file)
+    sys.exit('[E] Cannot build the k-mer Bloom filter of --prescreen\n')
+
+
+class ReadsPrescreen():
+    """k-mer pre-screen of the reads fed to bowtie2 (option --prescreen).
+    A read is mapped when at least --prescreen_min_hits of its k-mers are in the pangenome.
+    A random --prescreen_audit fraction of the rejected reads is mapped anyway under
+    a tagged name: their alignments are dropped from the results and only counted,
+    to estimate how many aligned reads the pre-screen loses.
+    """
+
+    def __init__(self, args):
+        self.bloom = load_bloom_filter(args)
+        self.fasta = args.fasta
+        self.min_hits = args.prescreen_min_hits
+        self.audit = args.prescreen_audit
+        self.random = numpy.random.RandomState(args.seed)
+        self.seen, self.passed, self.audited = 0, 0, 0
+        self.aligned, self.audit_aligned = 0, 0
+
+    def sequence(self, record):
+        lines = record.split(b'\n')
+        return b''.join(lines[1:]) if self.fasta else lines[1]
+
+    def screen(self, chunk):
+        """:returns: the reads of chunk to feed to bowtie2"""
+        records = split_records(chunk, self.fasta)
+        sequences = [self.sequence(r) for r in records]
+        # all the reads at once, separated by an invalid base
+        codes = BASE_CODES[numpy.frombuffer(b'N'.join(sequences), dtype=numpy.uint8)]
+        starts = numpy.zeros(len(sequences), dtype=numpy.int64)
+        numpy.cumsum([len(seq) + 1 for seq in sequences[:-1]], out=starts[1:])
+        kmers, valid = canonical_kmers(codes, self.bloom.k)
+        hits = numpy.zeros(len(codes) + 1, dtype=numpy.int64)
+        hits[:len(kmers)][valid] = self.bloom.contains(kmers[valid])
+        read_hits = numpy.add.reduceat(hits, starts)
+        passed = read_hits >= self.min_hits
+        audited = ~passed & (self.random.random_sample(len(records)) < self.audit)
+        self.seen += len(records)
+        self.passed += int(passed.sum())
+        self.audited += int(audited.sum())
+        out = []
+        for record, p, a in zip(records, passed, audited):
+            if p:
+                out.append(record)
+            elif a:
+                out.append(record[:1] + PRESCREEN_AUDIT_TAG + record[1:])
+        return b''.join(out)
+
+    def drop_audit_records(self, batches):
+        """Remove the alignments of the audit reads from the filtered records, counting them"""
+        for batch in batches:
+            kept = []
+            for line in batch:
+                if line.startswith(PRESCREEN_AUDIT_TAG):
+                    self.audit_aligned += 1
+                    continue
+                if not line.startswith(b'@'): self.aligned += 1
+                kept.append(line)
+            yield kept
+
+    def report(self, args):
+        rejected = self.seen - self.passed
+        print('[I] Pre-screen: ' + str(self.passed) + ' reads over ' + str(self.seen) + ' sent to bowtie2, ' +
+              str(rejected) + ' rejected')
+        args.telemetry_recorder.count('prescreen_reads', self.seen)
+        args.telemetry_recorder.count('prescreen_passed', self.passed)
+        if self.audited == 0:
+            print('[W] Pre-screen: no rejected read audited, sensitivity not estimated')
+            return
+        missed = self.audit_aligned * rejected / float(self.audited)
+        sensitivity = self.aligned / (self.aligned + missed) if self.aligned + missed > 0 else 1.0
+        args.telemetry_recorder.count('prescreen_sensitivity', sensitivity)
+        print('[I] Pre-screen: ' + str(self.audit_aligned) + ' aligned among ' + str(self.audited) + ' audited rejected reads, '
+              'estimated sensitivity ' + format(sensitivity, '.4f') + ' (' + str(int(round(missed))) + ' aligned reads lost)')
+
+
 """Convert a SAM file into BAM file, then sort the BAM"""
-def samtools_sam2bam(in_sam, args):
+def samtools_sam2bam(sam_file, args, keep_sam=False):
     """samtools sort
           samtools version 1.2
             samtools sort <in.bam> <out.prefix>
@@ -123,24 +1030,26 @@ def samtools_sam2bam(in_sam, args):
             samtools sort <in.bam> -o <out.bam>
             cat sample.bam | samtools sort - -o tmp_sorted.bam
         About Samtools commands:
-            -bS             Input is in SAM format, output is in BAM format
-            -m              Amount of memory it will be used
+            -u              Input is in SAM format, output is in uncompressed BAM format
+            -@              Number of sorting and compression threads
+            -m              Amount of memory it will be used per thread
     """
     outcome = (None, None)
     try:
         samtools_version = check_samtools()
-        # 1st command: samtools view -bS <INPUT SAM FILE>
-        view_cmd = ['samtools', 'view', '-bS', in_sam.name]
+        # 1st command: samtools view -u <INPUT SAM FILE>, uncompressed BAM as sort decodes it right away
+        view_cmd = ['samtools', 'view', '-u', sam_file]
         print('[I] ' + ' '.join(view_cmd))
         p2 = subprocess.Popen(view_cmd, stdout=subprocess.PIPE)
         if args.verbose: print('[I] Temporary .bam file has been generated')
 
         try:
-            # 2nd command: samtools sort -m <AMOUNT OF MEMORY> - <OUTPUT BAM FILE>
-            sort_cmd = ['samtools', 'sort', '-m', str(int(args.sam_memory * 1024*1024*1024))]
+            # 2nd command: samtools sort -@ <THREADS> -m <AMOUNT OF MEMORY PER THREAD> - <OUTPUT BAM FILE>
+            sort_cmd = ['samtools', 'sort'] + sort_options(args)
 
             if args.out_bam == None: # .bam file is not saved, only temporary bam file
                 tmp_bam = tempfile.NamedTemporaryFile(delete=False, prefix='panphlan_', suffix='.bam')
+                args.telemetry_recorder.tmp_file(tmp_bam.name)
                 is_tmp = True
                 out_bam = tmp_bam.name
             else:
@@ -169,12 +1078,49 @@ def samtools_sam2bam(in_sam, args):
         sys.stderr.write('\r')
         sys.exit('[E] Execution has been manually halted.\n')
     finally:
-        os.unlink(in_sam.name)
+        if not keep_sam: os.unlink(sam_file)
     return outcome
 
 
+"""Stops the program if a stage of the pipeline exited with an error"""
+def check_returncode(process, name):
+    returncode = process.wait()
+    if returncode != 0:
+        sys.exit('[E] ' + name + ' exited with error code ' + str(returncode) + '\n')
+
+
+"""Start samtools sort reading the filtered SAM records from a pipe (option --stream)"""
+def samtools_sort_stream(args):
+    """samtools sort reads SAM from stdin and only writes the final BAM
+    (plus its own spill files if --sam_memory is exceeded).
+    Backpressure comes from the pipe: the filter blocks once STREAM_BUFFER_SIZE
+    bytes are pending, which in turn blocks bowtie2 on its stdout.
+    """
+    if args.out_bam == None: # .bam file is not saved, only temporary bam file
+        tmp_bam = tempfile.NamedTemporaryFile(delete=False, prefix='panphlan_', suffix='.bam')
+        tmp_bam.close()
+        args.telemetry_recorder.tmp_file(tmp_bam.name)
+        out_bam, is_tmp = tmp_bam.name, True
+    else:
+        out_bam, is_tmp = args.out_bam, False
+    sort_cmd = ['samtools', 'sort'] + sort_options(args) + ['-o', out_bam, '-']
+    print('[I] ' + ' '.join(sort_cmd))
+    p_sort = subprocess.Popen(sort_cmd, stdin=subprocess.PIPE, bufsize=STREAM_BUFFER_SIZE)
+    return p_sort, is_tmp, out_bam
+
+
+"""Wait for the streamed samtools sort to write the BAM"""
+def samtools_sort_wait(p_sort, out_bam, args):
+    try:
+        p_sort.stdin.close()
+    except BrokenPipeError:
+        pass
+    check_returncode(p_sort, 'samtools sort')
+    if args.verbose: print('[I] .bam file ' + out_bam + ' has been sorted')
+
+
 """Maps the input sample file (.fastq) into a .sam file using BowTie2 """
-def mapping(args):
+def mapping(args, coverage=None, sam_out=None):
     """Pipeline:
     1.  bowtie2 --very-sensitive --no-unal -x <SPECIE> -U <INPUT PATH> -p <NUMBER OF PROCESSORS>
     2.  samtools view -bS <INPUT SAM FILE>
@@ -194,62 +1140,303 @@ def mapping(args):
     """
 
     bt2_options = args.bt2
+    threads = stage_threads(args)
+    if not args.input is sys.stdin:
+        args.telemetry_recorder.count('input_bytes', sum(os.path.getsize(path) for path in args.input))
+    # the --prescreen Bloom filter is loaded and checked here, its errors stop the run before any process starts
+    reads_input = ReadsInput(args)
+    p1, p_view, completed = None, None, False
     try:
-        preprocess_cmd = check_input(args.input)
-        if preprocess_cmd:
-            p0 = subprocess.Popen(preprocess_cmd, stdout=subprocess.PIPE)
+        bowtie2_input, bowtie2_stdin = reads_input.start()
+        nproc = threads['bowtie2'] if reads_input.processes or reads_input.feeders else threads['bowtie2_plain']
         # bowtie2 --very-sensitive --no-unal -x <SPECIE> -U <INPUT PATH> -p <NUMBER OF PROCESSORS>
         # default: bt2_options = '--very-sensitive'
         bowtie2_cmd = ([ 'bowtie2' ] +
                     list(filter(None, bt2_options.split('/'))) +
-                    [ '--no-unal', '-x', args.indexes, '-U', '-' if preprocess_cmd else args.input] +
-                    ([] if int(args.nproc) < 2 else ['-p', str(args.nproc)]))
+                    [ '--no-unal', '-x', args.indexes, '-U', bowtie2_input] +
+                    ([] if nproc < 2 else ['-p', str(nproc)]))
         if not args.verbose: bowtie2_cmd.append('--quiet')
         if args.fasta: bowtie2_cmd.append('-f') #bowtie2 default is fastq (-q)
         print('[I] ' + ' '.join(bowtie2_cmd))
-        if preprocess_cmd:
-            p1 = subprocess.Popen(bowtie2_cmd, stdin=p0.stdout, stdout=subprocess.PIPE)
-        else:
-            p1 = subprocess.Popen(bowtie2_cmd, stdout=subprocess.PIPE)
-        tmp_sam = tempfile.NamedTemporaryFile(delete=False, prefix='panphlan_', suffix='.sam')
+        p1 = subprocess.Popen(bowtie2_cmd, stdin=bowtie2_stdin, stdout=subprocess.PIPE)
+        reads_input.started(p1)
+        tmp_sam, sam_out = sam_output(args, coverage, sam_out)
         if args.verbose:
-            print('[I] Created temporary file ' + tmp_sam.name)
             print('[W] Please wait. The computation may take several minutes...')
             print('[I] SAM records filtering: mismatches threshold is at ' +
                   str(args.th_mismatches) + ', length threshold is at ' + str(args.min_read_length))
-        # Now, filter SAM
-        total = 0
-        rejected = 0
-        with tmp_sam:
-            for line in p1.stdout:
-                total += 1
-                l = line.decode('utf-8')
-                if l.startswith('@'): tmp_sam.write(line)
-                elif line == '':
-                    tmp_sam.write(line)
-                    break
-                else:
-                    words = l.strip().split('\t')
-                    read_length, numof_snp = len(words[9]), int(words[14].split(':')[-1])
-                    if read_length < args.min_read_length: # Too short
-                        rejected += 1
-                        if args.verbose: print('Filter out read #' + str(total) + ': length is ' + str(read_length))
-                    elif args.th_mismatches > -1: # Too many mismatches
-                        if numof_snp > args.th_mismatches:
-                            rejected += 1
-                            if args.verbose: print('Filter out read #' + str(total) + ': found ' + str(numof_snp) + ' mismatches')
-                    else: # Accept the read
-                        tmp_sam.write(line)
-        print('[I] Rejected ' + str(rejected) + ' reads over ' + str(total) + ' total')
-        print('Bowtie2 mapping and SAM filtering completed.')
+        if args.filter_pushdown and samtools_has_expressions():
+            # bowtie2 -> pump (counts records) -> samtools view -e -> Python sinks
+            view_cmd = ['samtools', 'view', '-h', '-@', str(threads['filter']),
+                        '-e', samtools_filter_expression(args), '-']
+            print('[I] ' + ' '.join(view_cmd))
+            p_view = subprocess.Popen(view_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            counter = {'records' : 0, 'bytes' : 0}
+            pump = threading.Thread(target=pump_sam, args=(p1.stdout, p_view.stdin, counter))
+            pump.start()
+            batches = read_sam_batches(p_view.stdout, args, counter)
+        else:
+            if args.filter_pushdown:
+                print('[W] samtools view -e needs samtools >= 1.12, using the Python SAM filter')
+            batches = filter_sam(p1.stdout, args)
+        if reads_input.prescreen:
+            batches = reads_input.prescreen.drop_audit_records(batches)
+        if args.target_coverage is not None:
+            batches = watch_coverage(batches, args, coverage, reads_input.sampler)
+        broken_pipe = write_batches(batches, sam_out, coverage)
+        if tmp_sam: tmp_sam.close()
+        if broken_pipe:
+            return tmp_sam
+        if p_view:
+            pump.join()
+            p_view.stdout.close()
         p1.stdout.close()
+        completed = True
+    except (KeyboardInterrupt, SystemExit) as err:
+        if isinstance(err, SystemExit) and err.code not in (None, 0):
+            raise # keep the message of the error, e.g. an unreadable input
+        sys.stderr.flush()
+        sys.stderr.write('\r')
+        sys.exit('[E] Execution has been manually halted.\n')
+    finally:
+        if not completed:
+            # any error or early return: stop bowtie2, samtools view and the reads feeders
+            # (the decompressors and bowtie2 may not have been started yet)
+            if p1: p1.kill()
+            if p_view: p_view.kill()
+            reads_input.kill()
+    check_returncode(p1, 'bowtie2')
+    reads_input.wait()
+    if p_view: check_returncode(p_view, 'samtools view')
+    if reads_input.length_filter:
+        reads_input.length_filter.report(args)
+    if reads_input.prescreen:
+        reads_input.prescreen.report(args)
+    if reads_input.sampler:
+        sampler = reads_input.sampler
+        args.read_fraction = sampler.fraction()
+        args.telemetry_recorder.count('reads_input', sampler.seen)
+        args.telemetry_recorder.count('reads_mapped', sampler.fed)
+        print('[I] Mapped ' + str(sampler.fed) + ' reads over ' + str(sampler.seen) + ' (fraction ' +
+              format(args.read_fraction, '.6g') + '), abundances are scaled up to the whole sample')
+    print('Bowtie2 mapping and SAM filtering completed.')
+    return tmp_sam
+
+
+"""Pass the batches of filtered records through, and stop feeding reads to bowtie2 once
+the median depth of the covered genes reaches --target_coverage. The depth is estimated
+every TARGET_CHECK_INTERVAL seconds on the coverage accumulated so far
+"""
+def watch_coverage(batches, args, coverage, sampler):
+    estimate = coverage if coverage is not None else AlignmentCoverage(build_gene_index(load_pangenome(args.pangenome)))
+    last_check = time.time()
+    for batch in batches:
+        if coverage is None: estimate.add_records(batch)
+        yield batch
+        if not sampler.stopped.is_set() and time.time() - last_check > TARGET_CHECK_INTERVAL:
+            depth = median_gene_depth(estimate)
+            if args.verbose: print('[I] Median depth of the covered genes: ' + format(depth, '.2f'))
+            if depth >= args.target_coverage:
+                print('[I] Target coverage reached (median depth ' + format(depth, '.2f') + '), no more reads are mapped')
+                sampler.stop()
+            last_check = time.time()
+
+
+"""Median of the mean depth of the genes covered so far"""
+def median_gene_depth(coverage):
+    genes_stats = {}
+    abundances = coverage.gene_abundances(genes_stats)
+    if not abundances: return 0.0
+    return float(numpy.median([abundances[g] / float(genes_stats[g][2]) for g in abundances]))
+
+
+"""Open the SAM output of the filtered records: sam_out when streaming, a temporary
+file otherwise, nothing at all in direct coverage mode without --out_bam.
+:returns: the temporary SAM file (or None) and the SAM output
+"""
+def sam_output(args, coverage, sam_out):
+    tmp_sam = None
+    if sam_out is None and (coverage is None or args.out_bam):
+        tmp_sam = tempfile.NamedTemporaryFile(delete=False, prefix='panphlan_', suffix='.sam')
+        args.telemetry_recorder.tmp_file(tmp_sam.name)
+        sam_out = tmp_sam
+        if args.verbose: print('[I] Created temporary file ' + tmp_sam.name)
+    return tmp_sam, sam_out
+
+
+"""Send the batches of filtered records to the SAM output and to the direct coverage.
+:returns: True if the SAM output pipe has been broken
+"""
+def write_batches(batches, sam_out, coverage):
+    for batch in batches:
+        if sam_out:
+            try:
+                sam_out.write(b''.join(batch))
+            except BrokenPipeError: # downstream samtools died, its error code is reported by the caller
+                return True
+        if coverage is not None:
+            coverage.add_records(batch)
+    return False
+
+
+"""Read existing alignments (options --i_bam, --i_sam) instead of mapping the reads.
+samtools view decodes the file with several threads and drops the records skipped by
+mpileup (unmapped, secondary, QC fail, duplicate); the accepted records go through
+the same read length and mismatches filters as the bowtie2 output.
+"""
+def read_alignments(args, coverage=None, sam_out=None):
+    pushdown = args.filter_pushdown and samtools_has_expressions()
+    view_cmd = ['samtools', 'view', '-h', '-F', str(SAM_SKIP_FLAGS), '-@', str(stage_threads(args)['decode'])]
+    if pushdown: view_cmd += ['-e', samtools_filter_expression(args)]
+    view_cmd.append(args.alignment)
+    print('[I] ' + ' '.join(view_cmd))
+    try:
+        p_view = subprocess.Popen(view_cmd, stdout=subprocess.PIPE)
+        tmp_sam, sam_out = sam_output(args, coverage, sam_out)
+        if pushdown:
+            batches = read_sam_batches(p_view.stdout, args)
+        else:
+            if args.filter_pushdown:
+                print('[W] samtools view -e needs samtools >= 1.12, using the Python SAM filter')
+            batches = filter_sam(p_view.stdout, args)
+        broken_pipe = write_batches(batches, sam_out, coverage)
+        if tmp_sam: tmp_sam.close()
+        if broken_pipe:
+            p_view.kill()
+            return tmp_sam
+        p_view.stdout.close()
     except (KeyboardInterrupt, SystemExit):
-        p1.kill()
+        p_view.kill()
         sys.stderr.flush()
         sys.stderr.write('\r')
         sys.exit('[E] Execution has been manually halted.\n')
+    check_returncode(p_view, 'samtools view')
+    print('Reading and filtering of ' + args.alignment + ' completed.')
     return tmp_sam
 
+
+"""Filter the SAM records produced by bowtie2 on read length and number of mismatches.
+Records are read as raw bytes in batches of SAM_BATCH_SIZE; yields lists of header lines and accepted records
+"""
+def filter_sam(sam_stream, args):
+    min_length, th_mismatches = args.min_read_length, args.th_mismatches
+    total, too_short, too_many_snp, nbytes, accepted_bytes = 0, 0, 0, 0, 0
+    start = time.time()
+    while True:
+        batch = sam_stream.readlines(SAM_BATCH_SIZE)
+        if not batch: break
+        nbytes += sum(len(line) for line in batch)
+        accepted = []
+        for line in batch:
+            if line.startswith(b'@'):
+                accepted.append(line)
+                continue
+            total += 1
+            # words = QNAME, FLAG, RNAME, POS, MAPQ, CIGAR, RNEXT, PNEXT, TLEN, SEQ, QUAL, TAGS
+            words = line.split(b'\t', 11)
+            if len(words[9]) < min_length: # Too short
+                too_short += 1
+                continue
+            # a record without XM:i: (or without any tag) counts as 0 mismatches, as in samtools_filter_expression()
+            if th_mismatches > -1 and len(words) > 11 and sam_tag_value(words[11], b'XM:i:') > th_mismatches: # Too many mismatches
+                too_many_snp += 1
+                continue
+            accepted.append(line)
+        accepted_bytes += sum(len(line) for line in accepted)
+        yield accepted
+    args.telemetry_recorder.count('reads_seen', total)
+    args.telemetry_recorder.count('reads_accepted', total - too_short - too_many_snp)
+    args.telemetry_recorder.count('sam_bytes', nbytes)
+    args.telemetry_recorder.count('accepted_sam_bytes', accepted_bytes)
+    print('[I] Rejected ' + str(too_short + too_many_snp) + ' reads over ' + str(total) + ' total (' +
+          str(too_short) + ' too short, ' + str(too_many_snp) + ' too many mismatches)')
+    report_rate('Python SAM filter', total, time.time() - start)
+
+
+"""Get the integer value of a SAM optional field looked up by name (e.g. b'XM:i:'), 0 if absent"""
+def sam_tag_value(tags, tag):
+    if tags.startswith(tag):
+        i = len(tag)
+    else:
+        i = tags.find(b'\t' + tag)
+        if i < 0: return 0
+        i += len(tag) + 1
+    j = i
+    while j < len(tags) and tags[j] not in b'\t\r\n': j += 1
+    return int(tags[i:j])
+
+
+def report_rate(name, numof_reads, seconds):
+    rate = numof_reads / seconds if seconds > 0 else 0.0
+    print('[I] ' + name + ': ' + str(numof_reads) + ' reads in ' + str(round(seconds, 1)) +
+          ' s (' + str(int(rate)) + ' reads/sec)')
+
+
+"""Build the samtools view expression equivalent to the Python filter (option --filter_pushdown)"""
+def samtools_filter_expression(args):
+    expression = 'length(seq) >= ' + str(args.min_read_length)
+    if args.th_mismatches > -1:
+        # same rule as filter_sam(): a record without XM:i: is kept
+        expression += ' && (![XM] || [XM] <= ' + str(args.th_mismatches) + ')'
+    return expression
+
+
+"""Check that the installed samtools can evaluate filter expressions (samtools view -e)"""
+def samtools_has_expressions():
+    try:
+        version = tuple(int(v) for v in check_samtools().split('.')[:2])
+    except ValueError:
+        return False
+    return version >= SAMTOOLS_EXPRESSION_VERSION
+
+
+"""Copy a SAM stream into a pipe in large chunks, counting the records going through"""
+def pump_sam(src, dst, counter):
+    at_line_start = True
+    try:
+        while True:
+            chunk = src.read1(SAM_BATCH_SIZE)
+            if not chunk: break
+            # records are all lines but the @ header lines
+            headers = chunk.count(b'\n@') + (1 if at_line_start and chunk.startswith(b'@') else 0)
+            counter['records'] += chunk.count(b'\n') - headers
+            counter['bytes'] += len(chunk)
+            at_line_start = chunk.endswith(b'\n')
+            dst.write(chunk)
+    except BrokenPipeError: # samtools died, its error code is reported by the caller
+        pass
+    finally:
+        try:
+            dst.close()
+        except BrokenPipeError:
+            pass
+
+
+"""Read the records accepted by samtools view -e in batches (option --filter_pushdown).
+counter holds the number of records before filtering, when known
+"""
+def read_sam_batches(sam_stream, args, counter=None):
+    accepted, accepted_bytes = 0, 0
+    start = time.time()
+    while True:
+        batch = sam_stream.readlines(SAM_BATCH_SIZE)
+        if not batch: break
+        accepted += sum(1 for line in batch if not line.startswith(b'@'))
+        accepted_bytes += sum(len(line) for line in batch)
+        yield batch
+    args.telemetry_recorder.count('reads_accepted', accepted)
+    args.telemetry_recorder.count('accepted_sam_bytes', accepted_bytes)
+    if counter is None:
+        args.telemetry_recorder.count('reads_seen', accepted)
+        print('[I] Accepted ' + str(accepted) + ' reads')
+        report_rate('samtools view -e filter', accepted, time.time() - start)
+        return
+    total = counter['records']
+    args.telemetry_recorder.count('reads_seen', total)
+    args.telemetry_recorder.count('sam_bytes', counter['bytes'])
+    print('[I] Rejected ' + str(total - accepted) + ' reads over ' + str(total) + ' total')
+    report_rate('samtools view -e filter', total, time.time() - start)
+
 # ------------------------------------------------------------------------------
 #   STEP 3
 # ------------------------------------------------------------------------------
@@ -276,87 +1463,516 @@ def piling_up(bam_file, is_tmp, csv_file, args):
                 * (asterisk)            is a placeholder for a deleted base in a multiple basepair deletion that was mentioned in a previous line by the -[0-9]+[ACGTNacgtn]+ notation
             (See also at http://samtools.sourceforge.net/pileup.shtml)
     """
+    index_bam(bam_file, is_tmp, args)
+    p5 = None
     try:
-        # command: samtools index <INPUT BAM FILE>
-        index_cmd = ['samtools', 'index', bam_file]
-        print('[I] ' + ' '.join(index_cmd))
-        p4 = subprocess.Popen(index_cmd)
-        if args.verbose: print('[I] BAM file ' + bam_file + ' has been indexed')
-        try:
-            with open(csv_file, mode='w') as ocsv:
-                # command: samtools mpileup <INPUT BAM FILE> > <OUTPUT CSV FILE>
-                mpileup_cmd = ['samtools', 'mpileup', bam_file]
-                print('[I] ' + ' '.join(mpileup_cmd) + ' > ' + csv_file)
-                try:
-                    p5 = subprocess.Popen(mpileup_cmd, stdout=ocsv)
-                    p5.wait()
-                except Exception as err:
-                    show_error_message(err)
-                    sys.stderr.flush()
-                    sys.stderr.write('\r')
-                    sys.exit('[E] Samtools encountered some error.\n')
-            # delete tmp file
-            if is_tmp: os.unlink(bam_file)
+        with open(csv_file, mode='w') as ocsv:
+            # command: samtools mpileup <INPUT BAM FILE> > <OUTPUT CSV FILE>
+            mpileup_cmd = ['samtools', 'mpileup', bam_file]
+            print('[I] ' + ' '.join(mpileup_cmd) + ' > ' + csv_file)
+            try:
+                p5 = subprocess.Popen(mpileup_cmd, stdout=ocsv)
+                p5.wait()
+            except Exception as err:
+                show_error_message(err)
+                sys.stderr.flush()
+                sys.stderr.write('\r')
+                sys.exit('[E] Samtools encountered some error.\n')
+        # delete tmp file
+        if is_tmp:
+            os.unlink(bam_file)
             os.unlink(bam_file + '.bai')
-            if args.verbose: print('Samtools piling up (view+mpileup) completed.')
-        except (KeyboardInterrupt, SystemExit):
-            p5.kill()
-            if isTemp: os.unlink(bam_file)
-            sys.stderr.flush()
-            sys.stderr.write('\r')
-            sys.exit('[E] Execution has been manually halted.\n')
+        if args.verbose: print('Samtools piling up (view+mpileup) completed.')
     except (KeyboardInterrupt, SystemExit):
+        if p5: p5.kill()
+        if is_tmp: os.unlink(bam_file)
+        sys.stderr.flush()
+        sys.stderr.write('\r')
+        sys.exit('[E] Execution has been manually halted.\n')
+
+"""Index the BAM file, mpileup and the region backends need the complete index.
+The index of a BAM that is not temporary is kept, and reused while it is not older than the BAM (e.g. in --cache_dir)
+"""
+def index_bam(bam_file, is_tmp, args):
+    index_file = bam_file + '.bai'
+    if not is_tmp and os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(bam_file):
+        if args.verbose: print('[I] BAM file ' + bam_file + ' is already indexed')
+        return
+    # command: samtools index -@ <THREADS> <INPUT BAM FILE>
+    index_cmd = ['samtools', 'index', '-@', str(stage_threads(args)['index']), bam_file]
+    print('[I] ' + ' '.join(index_cmd))
+    p4 = subprocess.Popen(index_cmd)
+    try:
+        p4.wait()
+    except KeyboardInterrupt:
         p4.kill()
-        if isTemp: os.unlink(bam_file)
+        if is_tmp: os.unlink(bam_file)
         sys.stderr.flush()
         sys.stderr.write('\r')
         sys.exit('[E] Execution has been manually halted.\n')
+    check_returncode(p4, 'samtools index')
+    if args.verbose: print('[I] BAM file ' + bam_file + ' has been indexed')
+
+# ------------------------------------------------------------------------------
+#   STEP 3 (GENE REGIONS BACKENDS)
+# ------------------------------------------------------------------------------
+"""Write the genes as BED regions (0-based start, end excluded), in parts of whole contigs with
+balanced total gene length. Region names are the positions of the genes in keys.
+:returns: list of BED files, list of gene keys
+"""
+def write_gene_beds(gene_index, numof_parts):
+    lengths = dict((c, int((gene_index[c][2] - gene_index[c][1] + 1).sum())) for c in gene_index)
+    parts, loads = [[] for i in range(numof_parts)], [0] * numof_parts
+    for contig in sorted(gene_index, key=lambda c: (-lengths[c], c)): # largest first to the least loaded part
+        i = loads.index(min(loads))
+        parts[i].append(contig)
+        loads[i] += lengths[contig]
+    bed_files, keys = [], []
+    for part in parts:
+        if not part: continue
+        with tempfile.NamedTemporaryFile(mode='w', delete=False, prefix='panphlan_', suffix='.bed') as BED:
+            for contig in sorted(part):
+                names, starts, ends = gene_index[contig]
+                for name, start, end in zip(names, starts.tolist(), ends.tolist()):
+                    BED.write(contig + '\t' + str(start - 1) + '\t' + str(end) + '\t' + str(len(keys)) + '\n')
+                    keys.append(name)
+        bed_files.append(BED.name)
+    return bed_files, keys
+
+
+"""Run one samtools command per BED part at the same time, each one writing into a temporary file
+:returns: the list of output files
+"""
+def run_region_commands(commands):
+    outputs, processes = [], []
+    try:
+        for cmd in commands:
+            with tempfile.NamedTemporaryFile(delete=False, prefix='panphlan_', suffix='.cov') as OUT:
+                print('[I] ' + ' '.join(cmd) + ' > ' + OUT.name)
+                processes.append((subprocess.Popen(cmd, stdout=OUT), cmd[1]))
+            outputs.append(OUT.name)
+        for p, name in processes:
+            check_returncode(p, 'samtools ' + name)
+    except (KeyboardInterrupt, SystemExit):
+        for p, name in processes: p.kill()
+        for output in outputs: os.unlink(output)
+        raise
+    return outputs
+
+
+"""Gene abundances of the sorted and indexed BAM with samtools bedcov (summed depth of each BED region)
+or samtools depth (depth of each position of the BED regions, summed over the genes like the mpileup depth)
+"""
+def region_abundances(bam_file, gene_index, args, genes_stats=None):
+    bed_files, keys = write_gene_beds(gene_index, stage_threads(args)['coverage'])
+    if args.coverage_backend == 'bedcov':
+        commands = [['samtools', 'bedcov', bed, bam_file] for bed in bed_files]
+    else:
+        commands = [['samtools', 'depth', '-J', '-q', str(MPILEUP_MIN_BASE_QUALITY), '-b', bed, bam_file] for bed in bed_files]
+    try:
+        outputs = run_region_commands(commands)
+    finally:
+        for bed in bed_files: os.unlink(bed)
+    genes_abundances = defaultdict(int)
+    for output in outputs:
+        if args.coverage_backend == 'bedcov':
+            with open(output, mode='rb') as IN:
+                for line in IN:
+                    # words = CONTIG, START, END, GENE KEY, SUMMED DEPTH
+                    words = line.rstrip().split(b'\t')
+                    if len(words) < 5 or int(words[4]) == 0: continue
+                    genes_abundances[keys[int(words[3])]] += int(words[4])
+        else: # parts hold different contigs, so their genes do not overlap
+            genes_abundances.update(pileup_abundances(output, gene_index, genes_stats, depth_column=2))
+        os.unlink(output)
+    return genes_abundances
+
+
+"""Compare the abundances of a region backend with the mpileup backend (option --coverage_check)"""
+def check_region_abundances(genes_abundances, bam_file, gene_index, args):
+    tmp_csv = tempfile.NamedTemporaryFile(delete=False, prefix='panphlan_', suffix='.csv')
+    mpileup_cmd = ['samtools', 'mpileup', bam_file]
+    print('[I] ' + ' '.join(mpileup_cmd) + ' > ' + tmp_csv.name)
+    check_returncode(subprocess.Popen(mpileup_cmd, stdout=tmp_csv), 'samtools mpileup')
+    tmp_csv.close()
+    reference = pileup_abundances(tmp_csv.name, gene_index)
+    os.unlink(tmp_csv.name)
+    genes = set(reference) | set(g for g in genes_abundances if genes_abundances[g] > 0)
+    different = [g for g in genes if reference.get(g, 0) != genes_abundances.get(g, 0)]
+    max_difference = max([abs(genes_abundances.get(g, 0) - reference.get(g, 0)) / float(max(reference.get(g, 0), 1)) for g in different] + [0.0])
+    args.telemetry_recorder.count('check_genes_different', len(different))
+    print('[I] Coverage check of ' + args.coverage_backend + ' against mpileup: ' + str(len(genes) - len(different)) + ' genes identical, ' +
+          str(len(different)) + ' different (maximum relative difference ' + format(100 * max_difference, '.2f') + '%)')
+
+
+"""Compute and write the gene abundances with --coverage_backend bedcov or depth"""
+def regions_coverage(bam_file, is_tmp, gene_index, args):
+    index_bam(bam_file, is_tmp, args)
+    genes_stats = {} if args.extra_stats and args.coverage_backend == 'depth' else None
+    try:
+        genes_abundances = region_abundances(bam_file, gene_index, args, genes_stats)
+        if args.coverage_check:
+            check_region_abundances(genes_abundances, bam_file, gene_index, args)
+    finally:
+        if is_tmp:
+            os.unlink(bam_file)
+            os.unlink(bam_file + '.bai')
+    write_genes_abundances(genes_abundances, args, genes_stats)
+
+# ------------------------------------------------------------------------------
+#   STEP 3 (CONTIG GROUPS PILEUP)
+# ------------------------------------------------------------------------------
+"""Length and number of mapped reads of each contig of the indexed BAM file (samtools idxstats)
+:returns: list of (CONTIG, LENGTH, MAPPED READS) in the order of the BAM header
+"""
+def mapped_contigs(bam_file):
+    p = subprocess.Popen(['samtools', 'idxstats', bam_file], stdout=subprocess.PIPE)
+    contigs = []
+    for line in p.stdout:
+        # words = CONTIG, LENGTH, MAPPED READS, UNMAPPED READS
+        words = line.decode('utf-8').rstrip('\n').split('\t')
+        if len(words) >= 4 and words[0] != '*':
+            contigs.append((words[0], int(words[1]), int(words[2])))
+    check_returncode(p, 'samtools idxstats')
+    return contigs
+
+
+"""Split the contigs with genes and mapped reads in groups with a balanced number of reads
+:returns: list of contig groups, each one in the order of the BAM header
+"""
+def pileup_parts(contigs, gene_index, numof_parts):
+    order = dict((c[0], i) for i, c in enumerate(contigs))
+    parts, loads = [[] for i in range(numof_parts)], [0] * numof_parts
+    covered = [c for c in contigs if c[2] > 0 and c[0] in gene_index]
+    for contig in sorted(covered, key=lambda c: (-c[2], order[c[0]])): # largest first to the least loaded group
+        i = loads.index(min(loads))
+        parts[i].append(contig)
+        loads[i] += contig[2]
+    return [sorted(part, key=lambda c: order[c[0]]) for part in parts if part]
+
+
+"""Write the whole contigs of a group as BED regions (0-based start, end excluded)"""
+def write_contigs_bed(part):
+    with tempfile.NamedTemporaryFile(mode='w', delete=False, prefix='panphlan_', suffix='.bed') as BED:
+        for contig, length, reads in part:
+            BED.write(contig + '\t0\t' + str(length) + '\n')
+    return BED.name
+
+
+"""Worker: one samtools mpileup on the BED regions of a group of contigs and sum of the depth over their genes
+:returns: (GENE ABUNDANCES, GENE STATISTICS)
+"""
+def pileup_part(task):
+    bam_file, bed_file, with_stats = task
+    genes_stats = {} if with_stats else None
+    cmd = ['samtools', 'mpileup', '-l', bed_file, bam_file]
+    # stderr in a file: a full pipe of warnings would block samtools while its stdout is read
+    with tempfile.TemporaryFile(prefix='panphlan_') as ERR:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=ERR)
+        try:
+            abundances = stream_abundances(p.stdout, PILEUP_GENE_INDEX, genes_stats)
+        finally:
+            p.stdout.close()
+            p.wait()
+        ERR.seek(0)
+        errors = ERR.read().decode('utf-8', 'replace')
+    if p.returncode != 0:
+        raise RuntimeError(' '.join(cmd) + ' failed (return code ' + str(p.returncode) + '): ' + errors.strip())
+    return dict(abundances), genes_stats
+
+
+"""Gene abundances of the sorted and indexed BAM, piled up by about --nproc groups of contigs in a pool of processes.
+Contigs hold disjoint genes, so the results are merged in the BAM header order as the whole file mpileup.
+"""
+def parallel_pileup(bam_file, gene_index, args, genes_stats=None):
+    global PILEUP_GENE_INDEX
+    contigs = mapped_contigs(bam_file)
+    parts = pileup_parts(contigs, gene_index, stage_threads(args)['coverage'])
+    print('[I] samtools mpileup on ' + str(sum(len(part) for part in parts)) + ' covered contigs in ' + str(len(parts)) + ' groups')
+    PILEUP_GENE_INDEX = gene_index
+    bed_files = [write_contigs_bed(part) for part in parts]
+    tasks = [(bam_file, bed, genes_stats is not None) for bed in bed_files]
+    try:
+        if len(tasks) <= 1:
+            results = [pileup_part(task) for task in tasks]
+        else:
+            with multiprocessing.get_context('fork').Pool(len(tasks)) as pool:
+                results = pool.map(pileup_part, tasks)
+    finally:
+        for bed in bed_files: os.unlink(bed)
+    contig2part = dict((c[0], i) for i, part in enumerate(parts) for c in part)
+    genes_abundances = defaultdict(int)
+    for contig, length, reads in contigs:
+        if not contig in contig2part: continue
+        abundances, stats = results[contig2part[contig]]
+        for g in gene_index[contig][0]:
+            if g in abundances:
+                genes_abundances[g] = abundances[g]
+                if genes_stats is not None: genes_stats[g] = stats[g]
+    return genes_abundances
+
+
+"""Compute and write the gene abundances of the mpileup backend with more than one processor"""
+def pileup_coverage(bam_file, is_tmp, gene_index, args):
+    index_bam(bam_file, is_tmp, args)
+    genes_stats = {} if args.extra_stats else None
+    try:
+        genes_abundances = parallel_pileup(bam_file, gene_index, args, genes_stats)
+    except RuntimeError as err:
+        sys.exit('[E] ' + str(err) + '\n')
+    finally:
+        if is_tmp:
+            os.unlink(bam_file)
+            os.unlink(bam_file + '.bai')
+    write_genes_abundances(genes_abundances, args, genes_stats)
+    if args.verbose: print('Gene abundances computing has just been completed.')
 
 # ------------------------------------------------------------------------------
 #   STEP 4
 # ------------------------------------------------------------------------------
 """Build the dictionary for contig -> included gene -> location of the gene in the DNA"""
-def build_pangenome_dicts(args):
+def build_pangenome_dicts(pangenome, verbose=False):
     contig2gene = {}
-    with open(args.pangenome, mode='r') as IN:
+    starts = numpy.minimum(pangenome.gene_from, pangenome.gene_to).tolist()
+    ends = numpy.maximum(pangenome.gene_from, pangenome.gene_to).tolist()
+    contigs = pangenome.contigs[pangenome.gene_contig].tolist()
+    for gen, ctg, fr, to in zip(pangenome.genes.tolist(), contigs, starts, ends):
+        if not ctg in contig2gene:
+            contig2gene[ctg] = {}
+        contig2gene[ctg][gen] = (fr, to)
+    if verbose: print('Dictionary for {contig:{gene:(from,to)}} has been created.')
+    return contig2gene
+
+
+"""Build the per-contig gene arrays used by the coverage engine from the compiled pangenome
+    { CONTIG : ( [GENE NAMES], FROM array, TO array ) }
+"""
+def build_gene_index(pangenome):
+    gene_index = {}
+    order = numpy.argsort(pangenome.gene_contig, kind='stable')
+    gene_contig = numpy.asarray(pangenome.gene_contig)[order]
+    starts = numpy.minimum(pangenome.gene_from, pangenome.gene_to)[order]
+    ends = numpy.maximum(pangenome.gene_from, pangenome.gene_to)[order]
+    names = pangenome.genes[order].tolist()
+    bounds = [0] + (numpy.flatnonzero(numpy.diff(gene_contig)) + 1).tolist() + [len(order)]
+    for i, j in zip(bounds[:-1], bounds[1:]):
+        if i == j: continue
+        gene_index[str(pangenome.contigs[gene_contig[i]])] = (names[i:j], starts[i:j], ends[i:j])
+    return gene_index
+
+
+"""Reduce a contig depth array (indexed by 1-based position) to the summed depth of each of its genes.
+If genes_stats is given, also fill it with { GENE : [COVERED BASES, MAX DEPTH, LENGTH] } in the same pass
+"""
+def depth_to_genes(depth, gene_entry, genes_abundances, genes_stats=None):
+    names, starts, ends = gene_entry
+    # prefix sums: summed depth over [fr, to] is cumsum[to+1] - cumsum[fr]
+    cumsum = numpy.zeros(len(depth) + 1, dtype=numpy.int64)
+    numpy.cumsum(depth, out=cumsum[1:])
+    sums = cumsum[ends + 1] - cumsum[starts]
+    for i in numpy.flatnonzero(sums):
+        genes_abundances[names[i]] += int(sums[i])
+    if genes_stats is None: return
+
+    numpy.cumsum(depth > 0, out=cumsum[1:])
+    covered = cumsum[ends + 1] - cumsum[starts]
+    # maximum over [fr, to]: reduceat on the (fr, to+1) boundaries, every second value is between genes
+    padded = numpy.append(depth, 0)
+    maxima = numpy.maximum.reduceat(padded, numpy.column_stack((starts, ends + 1)).ravel())[::2]
+    for i in numpy.flatnonzero(sums):
+        stats = genes_stats.setdefault(names[i], [0, 0, int(ends[i] - starts[i] + 1)])
+        stats[0] += int(covered[i])
+        stats[1] = max(stats[1], int(maxima[i]))
+
+
+class AlignmentCoverage():
+    """Accumulate the depth of the contigs from SAM records (option --direct_coverage).
+    Each aligned block of a read CIGAR is kept as a (start, end) pair, the
+    per-contig depth arrays are only expanded when abundances are computed.
+    As in the mpileup depth, deletions (D) and skipped regions (N) count, insertions
+    and clips do not. Genes come in the order of the @SQ header lines, as from the sorted BAM
+    (in the pangenome order without header).
+    """
+
+    def __init__(self, gene_index):
+        self.gene_index = gene_index
+        # depth is only needed up to the last gene position of each contig
+        self.limits = dict((ctg.encode('utf-8'), int(entry[2].max()) + 1) for ctg, entry in gene_index.items())
+        self.starts = defaultdict(lambda: array('i'))
+        self.ends = defaultdict(lambda: array('i'))
+        self.header_contigs = []
+
+    def add_block(self, contig, start, end):
+        limit = self.limits[contig]
+        if start < limit:
+            self.starts[contig].append(start)
+            self.ends[contig].append(min(end, limit))
+
+    def add_record(self, line):
+        # words = QNAME, FLAG, RNAME, POS, MAPQ, CIGAR, ...
+        words = line.split(b'\t', 6)
+        contig = words[2]
+        if int(words[1]) & SAM_SKIP_FLAGS or not contig in self.limits:
+            return
+        start = ref = int(words[3])
+        for length, op in CIGAR_OPS.findall(words[5]):
+            if op in b'MDN=X': # consume the reference and count in the depth
+                ref += int(length)
+        if ref > start: self.add_block(contig, start, ref)
+
+    def add_records(self, lines):
+        for line in lines:
+            if not line.startswith(b'@'):
+                self.add_record(line)
+            elif line.startswith(b'@SQ\t'):
+                # words = @SQ, SN:CONTIG, LN:LENGTH, ...
+                names = [w[3:] for w in line.rstrip(b'\r\n').split(b'\t') if w.startswith(b'SN:')]
+                self.header_contigs.extend(names)
+
+    def gene_abundances(self, genes_stats=None):
+        genes_abundances = defaultdict(int)
+        in_header = set(self.header_contigs)
+        # contigs missing from the header (no @SQ lines) in the pangenome order
+        others = [c for c in (ctg.encode('utf-8') for ctg in self.gene_index) if c in self.starts and not c in in_header]
+        for contig in [c for c in self.header_contigs if c in self.starts] + others:
+            limit = self.limits[contig]
+            starts = numpy.frombuffer(self.starts[contig], dtype=numpy.int32)
+            ends = numpy.frombuffer(self.ends[contig], dtype=numpy.int32)
+            diff = numpy.bincount(starts, minlength=limit + 1) - numpy.bincount(ends, minlength=limit + 1)
+            depth = numpy.cumsum(diff)[:limit]
+            depth_to_genes(depth, self.gene_index[contig.decode('utf-8')], genes_abundances, genes_stats)
+        return genes_abundances
+
+
+"""Load the mpileup depth column contig by contig into NumPy arrays and sum it over the genes
+(also used for the samtools depth output, where depth is the third column)
+"""
+def pileup_abundances(reads_file, gene_index, genes_stats=None, depth_column=3):
+    with open(reads_file, mode='rb') as IN:
+        return stream_abundances(IN, gene_index, genes_stats, depth_column)
+
+
+"""Sum the depth column of the pileup lines of a binary stream over the genes"""
+def stream_abundances(IN, gene_index, genes_stats=None, depth_column=3):
+    genes_abundances = defaultdict(int)
+    contig, positions, depths = None, [], []
+
+    def flush():
+        if contig in gene_index and len(positions) > 0:
+            gene_entry = gene_index[contig]
+            depth = numpy.zeros(int(gene_entry[2].max()) + 1, dtype=numpy.int64)
+            pos = numpy.array(positions, dtype=numpy.int64)
+            keep = pos < len(depth)
+            depth[pos[keep]] = numpy.array(depths, dtype=numpy.int64)[keep]
+            depth_to_genes(depth, gene_entry, genes_abundances, genes_stats)
+
+    for line in IN:
+        # words = CONTIG, POSITION, REFERENCE BASE, COVERAGE, READ BASE, QUALITY
+        words = line.split(b'\t', 4)
+        if len(words) <= depth_column: continue
+        if contig is None or words[0] != contig_raw:
+            flush()
+            contig_raw = words[0]
+            contig = contig_raw.decode('utf-8')
+            positions, depths = [], []
+        positions.append(int(words[1]))
+        depths.append(int(words[depth_column]))
+    flush()
+    return genes_abundances
+
+
+"""Original per-position loop, kept to validate the array based engine (option --legacy_coverage)"""
+def legacy_abundances(reads_file, contig2gene):
+    genes_abundances = defaultdict(int)
+    with open(reads_file, mode='r') as IN:
         for line in IN:
-            # line = FAMILY, GENE_NAME, GENE_UID, CONTIG, FROM, TO
             words = line.strip().split('\t')
-            fml, gen, ctg, fr, to = words[0], words[1], words[3], int(words[4]), int(words[5])
-            if not ctg in contig2gene:
-                contig2gene[ctg] = {}
-            contig2gene[ctg][gen] = (min(to, fr), max(to, fr))
-    if args.verbose: print('Dictionary for {contig:{gene:(from,to)}} has been created.')
-    return contig2gene
+            # words = CONTIG, POSITION, REFERENCE BASE, COVERAGE, READ BASE, QUALITY
+            contig, position, abundance = words[0], int(words[1]), int(words[3])
+            # For each gene in the contig, if position in range of gene, increase its abundance
+            if contig in contig2gene.keys():
+                for gene, (fr,to) in contig2gene[contig].items():
+                    if position in range(fr, to+1):
+                        genes_abundances[gene] += abundance
+    return genes_abundances
+
+
+"""Path of the gene abundance file written for an output prefix"""
+def output_file(output, args):
+    return output + (ABUNDANCE_BINARY_SUFFIX if args.out_format == 'bin' else '.bz2')
+
+
+"""Text line of a gene: GENE, ABUNDANCE and with --extra_stats COVERED BASES, MEAN DEPTH, MAX DEPTH"""
+def gene_line(g, abundance, genes_stats):
+    line = str(g) + '\t' + str(abundance)
+    if genes_stats is not None:
+        covered, max_depth, length = genes_stats[g]
+        line += '\t' + str(covered) + '\t' + format(abundance / length, '.3f') + '\t' + str(max_depth)
+    return line + '\n'
+
+
+"""Write the gene abundances to stdout, to the bz2 compressed output file or to the binary output file"""
+def write_genes_abundances(genes_abundances, args, genes_stats=None):
+    if args.species: # several species: genes are (SPECIES NUMBER, GENE) pairs of the combined gene index
+        write_species_abundances(genes_abundances, args, genes_stats)
+        return
+    read_fraction = getattr(args, 'read_fraction', None)
+    if read_fraction: # only part of the reads has been mapped
+        genes_abundances = dict((g, int(round(genes_abundances[g] / read_fraction))) for g in genes_abundances)
+    header = '#read_fraction\t' + repr(read_fraction) + '\n' if read_fraction else ''
+    if read_fraction and genes_stats is not None: # not meaningful to scale up
+        header += '#unscaled_columns\tcovered_bases,max_depth\n'
+    if args.output == None:
+        sys.stdout.write(header)
+        for g in genes_abundances:
+            if genes_abundances[g] > 0:
+                sys.stdout.write(gene_line(g, genes_abundances[g], genes_stats))
+        return
+    # written under a temporary name first so that an existing output is always complete (see --skip_done)
+    out_file = output_file(args.output, args)
+    if args.out_format == 'bin':
+        pangenome = load_pangenome(args.pangenome)
+        vector = numpy.zeros(len(pangenome.genes), dtype=numpy.int64)
+        gene2idx = dict((g, i) for i, g in enumerate(pangenome.genes.tolist()))
+        for g in genes_abundances:
+            vector[gene2idx[g]] = genes_abundances[g]
+        write_abundance_binary(out_file + '.tmp', vector, pangenome.checksum, read_fraction or 1.0)
+    else:
+        # WRITE AND THEN COMPRESS WITH copyobj()
+        with bz2.open(out_file + '.tmp', 'wt', compresslevel=9) as OUT:
+            OUT.write(header)
+            for g in genes_abundances:
+                if genes_abundances[g] > 0:
+                    OUT.write(gene_line(g, genes_abundances[g], genes_stats))
+    os.replace(out_file + '.tmp', out_file)
+
+
+"""Split the abundances of a multi-species run and write one output per species"""
+def write_species_abundances(genes_abundances, args, genes_stats=None):
+    species_abundances = [{} for species in args.species]
+    species_stats = [({} if genes_stats is not None else None) for species in args.species]
+    for (i, g), abundance in genes_abundances.items():
+        species_abundances[i][g] = abundance
+        if genes_stats is not None: species_stats[i][g] = genes_stats[(i, g)]
+    for i, (name, indexes, pangenome_file) in enumerate(args.species):
+        species_args = copy.copy(args)
+        species_args.species, species_args.pangenome = None, pangenome_file
+        species_args.output = species_output(args.output, name)
+        write_genes_abundances(species_abundances[i], species_args, species_stats[i])
+        print('[I] ' + name + ': ' + str(len(species_abundances[i])) + ' genes covered, written in ' + output_file(species_args.output, args))
 
 
 """Compute the abundance for each gene"""
-def genes_abundances(reads_file, contig2gene, args):
+def genes_abundances(reads_file, gene_index, args):
     try:
-        genes_abundances = defaultdict(int)
         if args.verbose: print('[W] Please wait. The computation may take several minutes...')
-        # READ
-        with open(reads_file, mode='r') as IN:
-            for line in IN:
-                words = line.strip().split('\t')
-                # words = CONTIG, POSITION, REFERENCE BASE, COVERAGE, READ BASE, QUALITY
-                contig, position, abundance = words[0], int(words[1]), int(words[3])
-                # For each gene in the contig, if position in range of gene, increase its abundance
-                if contig in contig2gene.keys():
-                    for gene, (fr,to) in contig2gene[contig].items():
-                        if position in range(fr, to+1):
-                            genes_abundances[gene] += abundance
-        # WRITE
-        if args.output == None:
-            for g in genes_abundances:
-                if genes_abundances[g] > 0:
-                    sys.stdout.write(str(g) + '\t' + str(genes_abundances[g]) + '\n')
+        genes_stats = {} if args.extra_stats else None
+        if args.legacy_coverage:
+            abundances = legacy_abundances(reads_file, build_pangenome_dicts(load_pangenome(args.pangenome), args.verbose))
+            genes_stats = None
         else:
-            # WRITE AND THEN COMPRESS WITH copyobj()
-            with bz2.open(args.output + '.bz2', 'wt', compresslevel=9) as OUT:
-                for g in genes_abundances:
-                    if genes_abundances[g] > 0:
-                        OUT.write(str(g) + '\t' + str(genes_abundances[g]) + '\n')
+            abundances = pileup_abundances(reads_file, gene_index, genes_stats)
+        write_genes_abundances(abundances, args, genes_stats)
     except (KeyboardInterrupt, SystemExit):
         os.unlink(reads_file)
         sys.stderr.flush()
@@ -364,9 +1980,396 @@ def genes_abundances(reads_file, contig2gene, args):
         sys.exit('[E] Execution has been manually halted.\n')
     if args.verbose: print('Gene abundances computing has just been completed.')
 
+# ------------------------------------------------------------------------------
+#   STAGE CACHE
+# ------------------------------------------------------------------------------
+CACHE_SAMPLED_BYTES = 4 * 1024 * 1024 # bytes hashed at the start and end of each reads file
+
+
+"""Identity of a file for the cache keys: name, size, modification time and a hash of its first and last bytes"""
+def file_identity(path):
+    stat = os.stat(path)
+    md5 = hashlib.md5()
+    with open(path, mode='rb') as IN:
+        md5.update(IN.read(CACHE_SAMPLED_BYTES))
+        if stat.st_size > 2 * CACHE_SAMPLED_BYTES:
+            IN.seek(-CACHE_SAMPLED_BYTES, os.SEEK_END)
+            md5.update(IN.read(CACHE_SAMPLED_BYTES))
+    return '|'.join([os.path.abspath(path), str(stat.st_size), str(stat.st_mtime_ns), md5.hexdigest()])
+
+
+class StageCache():
+    """Content-addressed cache of the stages of a sample (option --cache_dir).
+    Entries are files named KEY.STAGE where KEY hashes everything the stage depends on:
+        .filtered.sam   reads, bowtie2 indexes, bowtie2 options and read filters
+        .sorted.bam     same key as the filtered alignments it comes from, kept with its index (.sorted.bam.bai)
+        .coverage       alignment key plus pangenome checksum and coverage options
+    With --direct_coverage the coverage is computed from the alignment stream, only its .coverage entry is stored.
+    Reading an entry refreshes its modification time, the least recently used
+    entries are evicted when the directory grows over --cache_max_gb.
+    """
+
+    def __init__(self, args, pangenome_checksum):
+        self.args = args
+        self.cache_dir = args.cache_dir
+        self.max_bytes = int(args.cache_max_gb * 1024*1024*1024)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if args.alignment: # existing alignments only go through the filters
+            self.align_key = self.key([file_identity(args.alignment), str(args.min_read_length), str(args.th_mismatches)])
+        else:
+            indexes = sorted(glob.glob(args.indexes + '.*bt2*'))
+            self.align_key = self.key([file_identity(p) for p in args.input] +
+                                      [os.path.basename(p) + ':' + str(os.path.getsize(p)) + ':' + str(os.stat(p).st_mtime_ns) for p in indexes] +
+                                      [args.bt2, str(args.fasta), str(args.min_read_length), str(args.th_mismatches)])
+        if reads_sampling(args):
+            self.align_key = self.key([self.align_key, str(args.max_reads), str(args.subsample),
+                                       str(args.target_coverage), str(args.seed)])
+        if args.prefilter_length:
+            self.align_key = self.key([self.align_key, 'prefilter_length'])
+        if args.prescreen:
+            self.align_key = self.key([self.align_key, 'prescreen', str(args.prescreen_fasta),
+                                       str(args.prescreen_k), str(args.prescreen_min_hits)])
+        self.coverage_key = self.key([self.align_key, pangenome_checksum, args.coverage_backend, str(args.direct_coverage),
+                                      str(args.legacy_coverage), str(args.extra_stats), args.out_format])
+
+    def key(self, parts):
+        return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def path(self, key, stage):
+        return os.path.join(self.cache_dir, key + stage)
+
+    def get(self, key, stage):
+        """Path of a cached stage, None if it is not in the cache"""
+        path = self.path(key, stage)
+        if not os.path.exists(path): return None
+        if stage == '.sorted.bam' and not os.path.exists(path + '.bai'): return None
+        os.utime(path) # least recently used first
+        if stage == '.sorted.bam': os.utime(path + '.bai') # not older than the BAM (see index_bam)
+        return path
+
+    def put(self, src, key, stage, move=True):
+        """Store a completed stage, moving (or copying) src into the cache. :returns: the cached path
+        A sorted BAM is indexed once here, so the runs sharing the entry never write its index
+        """
+        path = self.path(key, stage)
+        tmp = path + '.tmp' + str(os.getpid())
+        if move:
+            shutil.move(src, tmp)
+        else:
+            shutil.copyfile(src, tmp)
+        if stage == '.sorted.bam':
+            index_bam(tmp, True, self.args)
+            os.replace(tmp + '.bai', path + '.bai')
+        os.replace(tmp, path)
+        self.evict(keep=path)
+        return path
+
+    def drop(self, key, stage):
+        path = self.path(key, stage)
+        if os.path.exists(path): os.unlink(path)
+
+    def evict(self, keep=None):
+        entries, index_sizes = [], {}
+        for f in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, f)
+            if '.tmp' in f or not os.path.isfile(path): continue
+            stat = os.stat(path)
+            if f.endswith('.bai'): # evicted with its BAM
+                index_sizes[path[:-len('.bai')]] = stat.st_size
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries = [(mtime, size + index_sizes.get(path, 0), path) for mtime, size, path in entries]
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes: break
+            if path == keep: continue
+            try:
+                if path in index_sizes: os.unlink(path + '.bai')
+                os.unlink(path)
+                total -= size
+                print('[I] Cache: evicted ' + path)
+            except OSError: # already evicted by a concurrent run
+                pass
+        print('[I] Cache: ' + str(round(total / (1024.0*1024*1024), 2)) + ' Gb used in ' + self.cache_dir)
+
+# ------------------------------------------------------------------------------
+#   SEVERAL SPECIES
+# ------------------------------------------------------------------------------
+"""Output of a species in a multi-species run: OUTPUT_DIR/SPECIES/OUTPUT_NAME"""
+def species_output(output, name):
+    species_dir = os.path.join(os.path.dirname(output), name)
+    os.makedirs(species_dir, exist_ok=True)
+    return os.path.join(species_dir, os.path.basename(output))
+
+
+"""Gene index of all the species, genes are (SPECIES NUMBER, GENE) pairs so that the coverage engines
+demultiplex the alignments by contig ownership in the same pass"""
+def combined_gene_index(species, verbose=False):
+    gene_index = {}
+    for i, (name, indexes, pangenome_file) in enumerate(species):
+        for contig, (names, starts, ends) in build_gene_index(load_pangenome(pangenome_file, verbose)).items():
+            if contig in gene_index:
+                sys.exit('[E] Contig ' + contig + ' is in several pangenomes, the species cannot be mapped together\n')
+            gene_index[contig] = ([(i, g) for g in names], starts, ends)
+    return gene_index
+
+
+"""Build the bowtie2 index of the sequences of all the species, once: it is kept as
+COMBINED_INDEX_DIR/panphlan_combined_<md5 of the species indexes>, completed by a .done file
+"""
+def combined_index(args):
+    identity = '|'.join(os.path.abspath(p) + ':' + str(os.path.getsize(p)) + ':' + str(os.stat(p).st_mtime_ns)
+                        for name, indexes, pangenome_file in args.species for p in sorted(glob.glob(indexes + '.*bt2*')))
+    key = hashlib.md5(identity.encode('utf-8')).hexdigest()
+    index_dirs = [args.combined_index_dir] if args.combined_index_dir else [os.path.dirname(os.path.abspath(args.species[0][1])), tempfile.gettempdir()]
+    for index_dir in index_dirs:
+        prefix = os.path.join(index_dir, 'panphlan_combined_' + key)
+        if os.path.exists(prefix + '.done'):
+            print('[I] Combined bowtie2 index of ' + str(len(args.species)) + ' species: ' + prefix)
+            return prefix
+
+    for index_dir in index_dirs:
+        prefix = os.path.join(index_dir, 'panphlan_combined_' + key)
+        try:
+            os.makedirs(index_dir, exist_ok=True)
+            with open(prefix + '.fna', mode='wb') as OUT:
+                contigs = set()
+                for name, indexes, pangenome_file in args.species:
+                    inspect_cmd = ['bowtie2-inspect', indexes]
+                    print('[I] ' + ' '.join(inspect_cmd))
+                    p_inspect = subprocess.Popen(inspect_cmd, stdout=subprocess.PIPE)
+                    for line in p_inspect.stdout:
+                        if line.startswith(b'>'):
+                            contig = line[1:].split()[0]
+                            if contig in contigs:
+                                sys.exit('[E] Contig ' + contig.decode() + ' is in several indexes, the species cannot be mapped together\n')
+                            contigs.add(contig)
+                        OUT.write(line)
+                    check_returncode(p_inspect, 'bowtie2-inspect')
+        except (IOError, OSError) as err:
+            print('[W] Cannot build the combined index in ' + index_dir + ': ' + str(err))
+            continue
+        build_cmd = ['bowtie2-build', '--threads', str(args.nproc)] + ([] if args.verbose else ['--quiet']) + [prefix + '.fna', prefix]
+        print('[I] ' + ' '.join(build_cmd))
+        check_returncode(subprocess.Popen(build_cmd), 'bowtie2-build')
+        os.unlink(prefix + '.fna')
+        open(prefix + '.done', mode='w').close()
+        print('[I] Combined bowtie2 index of ' + str(len(args.species)) + ' species built: ' + prefix)
+        return prefix
+    sys.exit('[E] Cannot build the combined bowtie2 index\n')
+
+# ------------------------------------------------------------------------------
+#   MANIFEST OF SAMPLES
+# ------------------------------------------------------------------------------
+"""Read the manifest of samples to map: INPUT <tab> OUTPUT [<tab> OUT_BAM], # for comments.
+:returns: list of (INPUT, OUTPUT, OUT_BAM, IS_ALIGNMENT), INPUT being an alignment file when its extension is one of ALIGNMENT_SUFFIXES
+"""
+def read_manifest(manifest_file):
+    samples = []
+    with open(manifest_file, mode='r') as IN:
+        for line in IN:
+            if line.startswith('#') or line.strip() == '': continue
+            words = line.rstrip('\n').split('\t')
+            if len(words) < 2:
+                sys.exit('[E] Manifest line without output path: ' + line.strip() + '\n')
+            out_bam = words[2] if len(words) > 2 and words[2] != '' else None
+            samples.append((words[0], words[1], out_bam, words[0].endswith(ALIGNMENT_SUFFIXES)))
+    return samples
+
+
+"""Samples of several alignment files (options --i_bam, --i_sam): one OUTPUT_DIR/NAME_map.tsv per file"""
+def alignment_samples(args):
+    samples = []
+    for aln_file in args.alignments:
+        name = os.path.basename(aln_file)
+        for suffix in ALIGNMENT_SUFFIXES:
+            if name.endswith(suffix): name = name[:-len(suffix)]
+        samples.append((aln_file, os.path.join(args.output, name + '_map.tsv'), None, True))
+    return samples
+
+
+"""Map a single sample of the manifest in a worker process, reports success or failure instead of stopping"""
+def map_manifest_sample(sample):
+    args, (input_path, output, out_bam, is_alignment) = copy.copy(MANIFEST_ARGS), sample
+    args.output, args.out_bam = output, out_bam
+    if is_alignment:
+        args.alignment = input_path
+    else:
+        args.input = expand_inputs(input_path.split(','))
+    try:
+        for path in ([args.alignment] if is_alignment else args.input):
+            if not os.path.exists(path):
+                sys.exit('[E] Sample file (' + path + ') not found')
+        map_sample(args, MANIFEST_GENE_INDEX)
+    except SystemExit as err: # even a bare sys.exit() stops the sample before its output is written
+        return (output, 'FAILED', str(err.code).strip() if err.code not in (None, 0) else 'exited before completion')
+    except Exception as err:
+        return (output, 'FAILED', repr(err))
+    return (output, 'OK', '')
+
+
+"""Map all samples of the manifest (option --manifest) or of several alignment files (--i_bam, --i_sam).
+The pangenome is parsed once and inherited by the forked workers, which share
+--nproc and --sam_memory; bowtie2 loads the index with --mm so concurrent
+alignments share the same memory-mapped index.
+"""
+def map_manifest(args, gene_index, samples):
+    global MANIFEST_ARGS, MANIFEST_GENE_INDEX
+    status = {}
+    if args.skip_done:
+        for input_path, output, out_bam, is_alignment in samples:
+            if os.path.exists(output_file(output, args)):
+                status[output] = (output, 'SKIPPED', 'output already exists')
+    to_map = [s for s in samples if not s[1] in status]
+
+    jobs = args.jobs if args.jobs else max(1, int(args.nproc) // 4)
+    jobs = max(1, min(jobs, len(to_map)))
+    MANIFEST_ARGS = copy.copy(args)
+    MANIFEST_ARGS.nproc = max(1, int(args.nproc) // jobs)
+    MANIFEST_ARGS.sam_memory = args.sam_memory / jobs
+    if not '--mm' in args.bt2.split('/'):
+        MANIFEST_ARGS.bt2 = args.bt2.rstrip('/') + '/--mm/'
+    MANIFEST_GENE_INDEX = gene_index
+    print('[I] Mapping ' + str(len(to_map)) + ' samples (' + str(len(status)) + ' skipped) with ' + str(jobs) +
+          ' concurrent jobs of ' + str(MANIFEST_ARGS.nproc) + ' processors and ' + str(round(MANIFEST_ARGS.sam_memory, 2)) + ' Gb each')
+
+    with multiprocessing.get_context('fork').Pool(jobs) as pool:
+        for result in pool.imap_unordered(map_manifest_sample, to_map):
+            status[result[0]] = result
+            print('[I] ' + result[0] + ': ' + result[1] + (' - ' + result[2] if result[2] else ''))
+
+    print('[I] Summary of samples:')
+    failed = 0
+    for input_path, output, out_bam, is_alignment in samples:
+        output, outcome, message = status[output]
+        if outcome == 'FAILED': failed += 1
+        print('    ' + outcome + '\t' + output + ('\t' + message if message else ''))
+    if failed > 0:
+        sys.exit('[E] ' + str(failed) + ' samples of ' + str(len(samples)) + ' failed\n')
+
 # ------------------------------------------------------------------------------
 #   MAIN
 # ------------------------------------------------------------------------------
+"""Map one sample (args.input) and write its gene abundances (args.output)"""
+def map_sample(args, gene_index):
+    args.telemetry_recorder = Telemetry(args)
+    try:
+        process_sample(args, gene_index)
+    except (KeyboardInterrupt, SystemExit):
+        args.telemetry_recorder.write(args, 'FAILED')
+        raise
+    args.telemetry_recorder.write(args, 'OK')
+
+
+def process_sample(args, gene_index):
+    telemetry = args.telemetry_recorder
+    args.read_fraction = None
+    cache = None
+    if args.cache_dir and (args.alignment or not args.input is sys.stdin):
+        cache = StageCache(args, load_pangenome(args.pangenome).checksum)
+        cached_output = cache.get(cache.coverage_key, '.coverage')
+        # with --out_bam, the sorted BAM must be in the cache as well
+        cached_bam = cache.get(cache.align_key, '.sorted.bam') if cached_output and args.out_bam else None
+        if cached_output and args.output and (cached_bam or not args.out_bam):
+            print('[I] Gene abundances found in cache: ' + cached_output)
+            with telemetry.stage('cache'):
+                shutil.copyfile(cached_output, output_file(args.output, args))
+                if cached_bam: shutil.copyfile(cached_bam, args.out_bam)
+            return
+
+    if args.direct_coverage:
+        if args.verbose: print('\nSTEP 2.  Mapping the reads and computing coverage...')
+        coverage = AlignmentCoverage(gene_index)
+        if args.stream and args.out_bam:
+            p_sort, is_tmp, out_bam = samtools_sort_stream(args)
+            with telemetry.stage('mapping'):
+                (read_alignments if args.alignment else mapping)(args, coverage, p_sort.stdin)
+            with telemetry.stage('sorting'):
+                samtools_sort_wait(p_sort, out_bam, args)
+                telemetry.file_size('bam_bytes', out_bam)
+        else:
+            with telemetry.stage('mapping'):
+                tmp_sam = (read_alignments if args.alignment else mapping)(args, coverage)
+            if args.out_bam:
+                with telemetry.stage('sorting'):
+                    samtools_sam2bam(tmp_sam.name, args)
+                    telemetry.file_size('bam_bytes', args.out_bam)
+        if args.verbose: print('\nSTEP 3. Exporting results...')
+        with telemetry.stage('coverage'):
+            genes_stats = {} if args.extra_stats else None
+            write_genes_abundances(coverage.gene_abundances(genes_stats), args, genes_stats)
+            if cache and args.output:
+                cache.put(output_file(args.output, args), cache.coverage_key, '.coverage', move=False)
+        return
+
+    if args.verbose: print('\nSTEP 2.  Mapping the reads...')
+    if reads_sampling(args):
+        cache_output, cache = cache, None # the mapped fraction is only recorded in the output
+    else:
+        cache_output = cache
+    cached_bam = cache.get(cache.align_key, '.sorted.bam') if cache else None
+    cached_sam = cache.get(cache.align_key, '.filtered.sam') if cache and not cached_bam else None
+    if cached_bam:
+        print('[I] Sorted BAM found in cache, skipping mapping: ' + cached_bam)
+        is_tmp, out_bam = False, cached_bam
+        if args.out_bam: shutil.copyfile(cached_bam, args.out_bam)
+    elif cached_sam:
+        print('[I] Filtered alignments found in cache, skipping mapping: ' + cached_sam)
+        with telemetry.stage('sorting'):
+            is_tmp, out_bam = samtools_sam2bam(cached_sam, args, keep_sam=True)
+            telemetry.file_size('bam_bytes', out_bam)
+    elif args.stream:
+        p_sort, is_tmp, out_bam = samtools_sort_stream(args)
+        with telemetry.stage('mapping'):
+            (read_alignments if args.alignment else mapping)(args, sam_out=p_sort.stdin)
+        with telemetry.stage('sorting'):
+            samtools_sort_wait(p_sort, out_bam, args)
+            telemetry.file_size('bam_bytes', out_bam)
+    else:
+        with telemetry.stage('mapping'):
+            tmp_sam = (read_alignments if args.alignment else mapping)(args)
+            sam_file = tmp_sam.name
+            telemetry.file_size('tmp_sam_bytes', sam_file)
+        if cache: sam_file = cache.put(sam_file, cache.align_key, '.filtered.sam')
+        with telemetry.stage('sorting'):
+            is_tmp, out_bam = samtools_sam2bam(sam_file, args, keep_sam=cache is not None)
+            telemetry.file_size('bam_bytes', out_bam)
+    if cache and not cached_bam:
+        # the sorted BAM supersedes the filtered alignments
+        out_bam = cache.put(out_bam, cache.align_key, '.sorted.bam', move=is_tmp)
+        is_tmp = False
+        cache.drop(cache.align_key, '.filtered.sam')
+
+    if args.coverage_backend != 'mpileup':
+        if args.verbose: print('\nSTEP 3. Computing gene coverage with samtools ' + args.coverage_backend + '...')
+        with telemetry.stage('coverage'):
+            regions_coverage(out_bam, is_tmp, gene_index, args)
+            if cache_output and args.output:
+                cache_output.put(output_file(args.output, args), cache_output.coverage_key, '.coverage', move=False)
+        return
+
+    # the --manifest workers cannot have children: whole file mpileup
+    if stage_threads(args)['coverage'] > 1 and not args.legacy_coverage and not multiprocessing.current_process().daemon:
+        if args.verbose: print('\nSTEP 3. Piling up groups of contigs in parallel...')
+        with telemetry.stage('coverage'):
+            pileup_coverage(out_bam, is_tmp, gene_index, args)
+            if cache_output and args.output:
+                cache_output.put(output_file(args.output, args), cache_output.coverage_key, '.coverage', move=False)
+        return
+
+    if args.verbose: print('\nSTEP 3. Piling up...')
+    tmp_csv = tempfile.NamedTemporaryFile(delete=False, prefix='panphlan_', suffix='.csv')
+    telemetry.tmp_file(tmp_csv.name)
+    with telemetry.stage('piling_up'):
+        piling_up(out_bam, is_tmp, tmp_csv.name, args)
+        telemetry.file_size('pileup_bytes', tmp_csv.name)
+
+    if args.verbose: print('\nSTEP 4. Exporting results...')
+    with telemetry.stage('coverage'):
+        genes_abundances(tmp_csv.name, gene_index, args)
+        os.unlink(tmp_csv.name)
+        if cache_output and args.output:
+            cache_output.put(output_file(args.output, args), cache_output.coverage_key, '.coverage', move=False)
 
 def main():
     if not sys.version_info.major == 3:
@@ -377,21 +2380,22 @@ def main():
     check_args(args)
 
     if args.verbose: print('\nSTEP 1. Checking software...')
-    check_bowtie2()
-    samtools_version = check_samtools()
-
-    if args.verbose: print('\nSTEP 2.  Mapping the reads...')
-    tmp_sam =  mapping(args)
-    is_tmp, out_bam = samtools_sam2bam(tmp_sam, args)
-
-    if args.verbose: print('\nSTEP 3. Piling up...')
-    tmp_csv = tempfile.NamedTemporaryFile(delete=False, prefix='panphlan_', suffix='.csv')
-    piling_up(out_bam, is_tmp, tmp_csv.name, args)
+    if not args.alignments:
+        check_bowtie2()
+    if not args.direct_coverage or args.out_bam or args.manifest or args.alignments:
+        samtools_version = check_samtools()
 
-    if args.verbose: print('\nSTEP 4. Exporting results...')
-    contig2gene = build_pangenome_dicts(args)
-    genes_abundances(tmp_csv.name, contig2gene, args)
-    os.unlink(tmp_csv.name)
+    if args.species:
+        gene_index = combined_gene_index(args.species, args.verbose)
+        if not args.alignments: args.indexes = combined_index(args)
+    else:
+        gene_index = build_gene_index(load_pangenome(args.pangenome, args.verbose))
+    if args.manifest:
+        map_manifest(args, gene_index, read_manifest(args.manifest))
+    elif len(args.alignments) > 1:
+        map_manifest(args, gene_index, alignment_samples(args))
+    else:
+        map_sample(args, gene_index)
 
 
 if __name__ == '__main__':
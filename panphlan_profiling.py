@@ -6,11 +6,13 @@ panphlan_profiling.py
 """
 
 import os, subprocess, sys, time, bz2
+import multiprocessing, hashlib
 import numpy
 import argparse as ap
 from collections import defaultdict
 from shutil import copyfileobj
-from misc import random_color
+from misc import random_color, load_pangenome, read_abundance_binary, file_checksum, ABUNDANCE_BINARY_SUFFIX
+from misc import write_coverage_binary, read_coverage_binary, is_coverage_binary
 from random import randint
 
 
@@ -21,8 +23,76 @@ __date__ = '20 April 2020'
 
 # FIXED THRESHOLDS
 ZERO_NON_PLATEAU_TH = 0.20 # multistrain detection
+# Shared with the result file reading worker processes (inherited through fork)
+INGEST_GENE_INDEX = None
+INGEST_CHECKSUM = None
 #  + Arguments default values
 
+# ------------------------------------------------------------------------------
+#   FAMILIES x SAMPLES MATRIX
+# ------------------------------------------------------------------------------
+class FamilyMatrix():
+    """Dense families x samples matrix with the label indexes of its rows and columns.
+    values[i, j] is the value of family families[i] in sample samples[j]
+    (coverages, normalized coverages, 1/-1/-2/-3 levels or presences).
+    """
+
+    def __init__(self, families, samples, values):
+        self.families = list(families)
+        self.samples = list(samples)
+        self.values = values
+        self.family_idx = dict((f, i) for i, f in enumerate(self.families))
+        self.sample_idx = dict((s, j) for j, s in enumerate(self.samples))
+
+    def column(self, sample):
+        return self.values[:, self.sample_idx[sample]]
+
+    def select(self, samples):
+        """Matrix of a subset of the samples, in the given order"""
+        return FamilyMatrix(self.families, samples, self.values[:, [self.sample_idx[s] for s in samples]])
+
+    def reindex(self, families, fill=0):
+        """Matrix with the given rows, families missing from this matrix are filled"""
+        values = numpy.full((len(families), len(self.samples)), fill, dtype=self.values.dtype)
+        rows = [(i, self.family_idx[f]) for i, f in enumerate(families) if f in self.family_idx]
+        if rows:
+            dst, src = zip(*rows)
+            values[list(dst)] = self.values[list(src)]
+        return FamilyMatrix(families, self.samples, values)
+
+    def sorted_rows(self):
+        return sorted(range(len(self.families)), key=self.families.__getitem__)
+
+    def sorted_columns(self):
+        return sorted(range(len(self.samples)), key=self.samples.__getitem__)
+
+
+class GeneIndex():
+    """Genes of the pangenome as arrays aligned to the genes of the compiled pangenome:
+    family (position in the sorted families) and length of each gene,
+    number of genes and mean gene length of each family.
+    """
+
+    def __init__(self, pangenome):
+        self.genes = pangenome.genes.tolist()
+        self.gene_idx = dict((g, i) for i, g in enumerate(self.genes))
+        self.family = numpy.asarray(pangenome.gene_family, dtype=numpy.intp)
+        self.length = (numpy.abs(numpy.asarray(pangenome.gene_to) - pangenome.gene_from) + 1).astype(numpy.float64)
+        numof_families = len(pangenome.families)
+        family_genes = numpy.bincount(self.family, minlength=numof_families)
+        family_length = numpy.bincount(self.family, weights=self.length, minlength=numof_families)
+        self.with_genes = family_genes > 0
+        self.mean_length = numpy.zeros(numof_families, dtype=numpy.float64)
+        self.mean_length[self.with_genes] = family_length[self.with_genes] / family_genes[self.with_genes]
+
+    def gene_vector(self, gene2cov):
+        """Coverage vector of a gene -> coverage dictionary, genes missing from the pangenome are ignored"""
+        vector = numpy.zeros(len(self.genes), dtype=numpy.float64)
+        for g, cov in gene2cov.items():
+            i = self.gene_idx.get(g)
+            if i is not None: vector[i] = cov
+        return vector
+
 # ------------------------------------------------------------------------------
 """
 Reads and parses the command line arguments of the script.
@@ -36,13 +106,21 @@ def read_params():
     p.add_argument('-p', '--pangenome', type = str,
                    help='Path to pangenome tsv file exported from ChocoPhlAn')
     p.add_argument('--i_covmat', type=str, default=None,
-                   help='Path to precomputed coverage matrix')
+                   help='Path to precomputed coverage matrix (text or binary, see --covmat_format)')
+    p.add_argument('--samples', type=str, default=None,
+                   help='Only use these samples: comma separated sample IDs or file with one sample ID per line. '
+                        'Only their columns of a binary --i_covmat are read')
 
     # OUTPUT ARGUMENTS
     p.add_argument('--o_matrix', type=str, default=None,
                    help='Path for presence/absence matrix output')
     p.add_argument('--o_covmat', type=str, default=None,
-                   help='Write raw gene-family coverage matrix in provided file')
+                   help='Write raw gene-family coverage matrix in provided file. '
+                        'With --i_covmat and no other output, the matrix is only converted (e.g. from text to binary)')
+    p.add_argument('--covmat_format', type=str, default='tsv', choices=['tsv', 'bin'],
+                   help='Format of --o_covmat: text with 3 decimals (default) or binary float32 matrix with the family and sample labels, '
+                        'memory-mapped column by column when read. float32 keeps about 7 significant digits, '
+                        'so coverages above 16384 are not exact to the third decimal. The format of --i_covmat is detected')
     p.add_argument('--o_covplot_normed', type=str, default=None,
                    help='Filename for normalized gene-family coverage plot.')
     p.add_argument('--o_idx', metavar='DNA_INDEX_FILE', type=str, default= None,
@@ -83,6 +161,11 @@ def read_params():
     # OPTIONAL ARGUMENTS
     p.add_argument('--add_ref', action='store_true',
                    help='Add reference genomes to gene-family presence/absence matrix.')
+    p.add_argument('--store', type=str, default=None,
+                   help='Directory of the profiling store: the gene-family coverages and the profile (median, plateau and presence) '
+                        'of each result file are kept, keyed by its content, and only new or changed files are read on a re-run')
+    p.add_argument('--nproc', type=int, default=1,
+                   help='Number of processes reading and summing the panphlan_map.py result files into gene-family coverages [1]')
     p.add_argument('-v', '--verbose', action='store_true',
                    help='Show progress information')
     # FUNCTIONNAL ANNOTATION ARGUMENTS
@@ -99,36 +182,104 @@ def check_args(args):
     if args.i_dna:
         if not os.path.exists(args.i_dna):
             sys.exit('[E] Sample file directory (' + args.i_dna + ') not found\n')
-    else:
+    elif not args.i_covmat:
         sys.exit('[E] Please provide a valid sample file (argument -i or --i_dna).\n')
+    if args.samples:
+        if os.path.isfile(args.samples):
+            with open(args.samples, mode='r') as IN:
+                args.samples = [l.strip() for l in IN if l.strip() and not l.startswith('#')]
+        else:
+            args.samples = [s for s in args.samples.split(',') if s]
+    if args.nproc < 1:
+        sys.exit('[E] --nproc must be at least 1.\n')
+    if args.store and args.i_covmat:
+        print('[W] --store only keeps the coverages of the result files, the --i_covmat samples are profiled again')
 
 
 
+# ------------------------------------------------------------------------------
+#   PROFILING STORE
+# ------------------------------------------------------------------------------
+class ProfilingStore():
+    """Persistent per-sample profiling results (option --store). Entries are files named by KEY,
+    the md5 of the content of a panphlan_map.py result file and of the pangenome:
+        KEY.cov.npz                 gene-family coverage vector, aligned to the pangenome families
+        KEY.PARAMS.profile.npz      median coverage, plateau statistics and 1,-1,-2,-3 levels of the families,
+                                    PARAMS hashes the plateau and presence thresholds
+    New or changed result files get a new key, so a re-run only reads and profiles those.
+    """
+
+    def __init__(self, store_dir, pangenome_checksum):
+        self.store_dir = store_dir
+        self.pangenome_checksum = pangenome_checksum
+        self.sample_keys = {} # DNA sample -> KEY of its result file
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def key(self, parts):
+        return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def file_key(self, input_file):
+        return self.key([file_checksum(input_file), self.pangenome_checksum])
+
+    def save(self, path, arrays):
+        tmp = path + '.tmp' + str(os.getpid())
+        with open(tmp, mode='wb') as OUT:
+            numpy.savez(OUT, **arrays)
+        os.replace(tmp, path)
+
+    def coverages(self, key):
+        """Cached gene-family coverage vector, None if it is not in the store"""
+        path = os.path.join(self.store_dir, key + '.cov.npz')
+        if not os.path.exists(path): return None
+        with numpy.load(path) as data:
+            return data['coverages']
+
+    def put_coverages(self, key, coverages):
+        self.save(os.path.join(self.store_dir, key + '.cov.npz'), {'coverages' : coverages})
+
+    def profile_path(self, sample, args):
+        params = self.key([repr(v) for v in (args.min_coverage, args.left_max, args.right_min, ZERO_NON_PLATEAU_TH,
+                                             args.th_non_present, args.th_present, args.th_multicopy)])
+        return os.path.join(self.store_dir, self.sample_keys[sample] + '.' + params + '.profile.npz')
+
+    def profile(self, sample, args):
+        """Cached (median coverage, sample stats, levels vector) of a DNA sample, None if it is not in the store"""
+        if not sample in self.sample_keys: return None
+        path = self.profile_path(sample, args)
+        if not os.path.exists(path): return None
+        with numpy.load(path) as data:
+            median, leftcov, rightcov, zerocov = data['coverages'].tolist()
+            accepted, multistrain = data['flags'].tolist()
+            stats = {'strainCoverage' : numpy.float64(median), 'accepted' : accepted, 'Multistrain' : multistrain,
+                     'leftCoverage' : leftcov, 'rightCoverage' : rightcov, 'outPlateauCoverage' : zerocov}
+            return stats['strainCoverage'], stats, data['levels']
+
+    def put_profile(self, sample, args, median, stats, levels):
+        if not sample in self.sample_keys: return
+        self.save(self.profile_path(sample, args),
+                  {'coverages' : numpy.array([median, stats['leftCoverage'], stats['rightCoverage'], stats['outPlateauCoverage']], dtype=numpy.float64),
+                   'flags' : numpy.array([bool(stats['accepted']), bool(stats['Multistrain'])]),
+                   'levels' : levels})
+
 # ------------------------------------------------------------------------------
 #   STEP 1
 # ------------------------------------------------------------------------------
 def read_pangenome(pangenome_file):
     """Build the following data structures:
-     - (dict) length and family for each gene
+     - (GeneIndex) family index and length of each gene
      - (list) sorted list of family
      - (int) families in each genome
     Other informations can be extracted from these
     """
-    genes_info = defaultdict(dict)
-    families = set()
-    genome_lengths = defaultdict(int)
     genome2families = defaultdict(set)
 
-    pangenome_file = pangenome_file
-    with open(pangenome_file, mode='r') as f:
-        for line in f:
-            words = line.strip().split('\t')
-            fml, gene, genome, ctg, fr, to = words[0], words[1], words[2], words[3], int(words[4]), int(words[5])
-            genes_info[gene] = {'length' : abs(to - fr) + 1, 'family' : fml}
-            families.add(fml)
-            if not genome.startswith('REF_'):
-                genome = 'REF_' + genome
-            genome2families[genome].add(fml)
+    pangenome = load_pangenome(pangenome_file)
+    gene_index = GeneIndex(pangenome)
+    families = pangenome.families.tolist()
+    for i, genome in enumerate(pangenome.genomes.tolist()):
+        if not genome.startswith('REF_'):
+            genome = 'REF_' + genome
+        genome2families[genome].update(pangenome.families[pangenome.genome_families(i)].tolist())
 
     # Get expected median genome length (number of gene families)
     genome_lengths    = dict((g, len(genome2families[g])) for g in genome2families)
@@ -137,25 +288,22 @@ def read_pangenome(pangenome_file):
     print('     Number of reference genomes: '                + str(num_ref_genomes))
     print('     Average number of gene-families per genome: ' + str(avg_genome_length))
     print('     Total number of pangenome gene-families '     + str(len(families)))
-    return genes_info, sorted(list(families)), genome2families
+    return gene_index, families, genome2families
 
 # ------------------------------------------------------------------------------
 #   STEP 1 BIS
 # ------------------------------------------------------------------------------
 def build_ref2family2presence(families, genome2families, VERBOSE):
-    """Build the dictionary from ref to gene family to presence
-    { REF : { GENE FAMILY : PRESENCE(True or False) } }
-    """
+    """Build the families x reference genomes presence matrix (True or False)"""
     ref_genomes = sorted(genome2families.keys())
-    ref2family2presence = defaultdict(dict)
+    ref2family2presence = FamilyMatrix(families, ref_genomes, numpy.zeros((len(families), len(ref_genomes)), dtype=bool))
     numof_ref = len(ref_genomes)
     i = 1
-    for s in ref_genomes:
+    for j, s in enumerate(ref_genomes):
         if VERBOSE:
             print('[I] [' + str(i) + '/' + str(numof_ref) + '] Analysing reference genome ' + s + '...')
             i += 1
-        for f in families:
-            ref2family2presence[s][f] = f in genome2families[s]
+        ref2family2presence.values[:, j] = [f in genome2families[s] for f in families]
     if VERBOSE:
         print('Gene families presence/absence in reference genomes computed.')
     return  ref2family2presence
@@ -163,33 +311,25 @@ def build_ref2family2presence(families, genome2families, VERBOSE):
 # ------------------------------------------------------------------------------
 #   MATRIX OUTPUT
 # ------------------------------------------------------------------------------
-def filter_never_present(presences_dict, args):
+def filter_never_present(presences, args):
     """Remove gene families never present.
     Also remove those which are only present in the samples (because some ref strain has been filtered out )
+    :returns: boolean vector of the never present families (rows of the presence matrix)
     """
-    sample_and_strains = sorted(presences_dict.keys())
-    families = sorted(presences_dict[sample_and_strains[0]].keys())
-    never_present_families = []
-    for f in families:
-        always_zero = True
-        for s in presences_dict:
-            if presences_dict[s][f]: # == True == 1
-                always_zero = False
-                break
-        if always_zero:
-            never_present_families.append(f)
+    never_present = ~presences.values.any(axis=1)
     if args.verbose:
-        print(' [I] '+ str(len(never_present_families)) + ' never present gene families filtered out.')
-    return never_present_families
+        print(' [I] '+ str(int(never_present.sum())) + ' never present gene families filtered out.')
+    return never_present
 
-def write_presence_absence_matrix(presences_dict, args, family2annot):
+def write_presence_absence_matrix(presences, args, family2annot):
     """Function writing the presence/absence matrix in csv file from
-    a dict variable containing data about samples, strains or both.
+    a presence matrix of samples, strains or both.
     It can also add a annotation collumn
     """
-    sample_and_strains = sorted(presences_dict.keys())
-    families = sorted(presences_dict[sample_and_strains[0]].keys())
-    never_present_families = filter_never_present(presences_dict, args)
+    columns = presences.sorted_columns()
+    sample_and_strains = [presences.samples[j] for j in columns]
+    never_present = filter_never_present(presences, args)
+    cells = numpy.where(presences.values[:, columns], '1', '0')
 
     if len(sample_and_strains) > 0:
         if args.verbose: print(' [I] Print gene-family presence/absence matrix to: ' + args.o_matrix)
@@ -201,30 +341,25 @@ def write_presence_absence_matrix(presences_dict, args, family2annot):
             header = '\t' + header
         OUT.write(header)
 
-        for f in families:
-            if f not in never_present_families:
+        for i in presences.sorted_rows():
+            if not never_present[i]:
+                f = presences.families[i]
                 line = f
                 if not family2annot == None:
                     if not str(family2annot[f]) == "" :
                         line = line + '\t' + str(family2annot[f])
                     else :
                         line = line + '\t' + "NA" + '\t'
-                for s in sample_and_strains:
-                    if presences_dict[s][f]:
-                        line = line + '\t1'
-                    else:
-                        line = line + '\t0'
-                OUT.write(line + '\n')
+                OUT.write(line + '\t' + '\t'.join(cells[i]) + '\n')
         OUT.close()
 
 # ------------------------------------------------------------------------------
 #  FUNCTIONNAL ANNOTATION
 # ------------------------------------------------------------------------------
-def create_annot_dict(presences_dict, args):
+def create_annot_dict(presences, args):
     """Build dict mapping families to annotation before writing presence/abscence matrix
     """
-    sample_and_strains = sorted(presences_dict.keys())
-    families = sorted(presences_dict[sample_and_strains[0]].keys())
+    families = set(presences.families)
 
     # if annot file provided is the same as pangenome file
     if args.func_annot == args.pangenome:
@@ -275,89 +410,177 @@ def create_annot_dict(presences_dict, args):
 def get_sampleID_from_path(sample_path):
     # example: "path/to/mapping/result/ERR54632_ecoli14.csv.bz2" -> "ERR54632_ecoli14"
     sampleID = os.path.basename(sample_path)
-    sampleID = sampleID.replace('_map.tsv.bz2','')
+    sampleID = sampleID.replace('_map.tsv.bz2','').replace('_map.tsv' + ABUNDANCE_BINARY_SUFFIX,'')
     return sampleID
 
-def read_gene_cov_file(input_file):
-    """Convert coverage mapping file into a dictionary data structure"""
+# Suffixes of the panphlan_map.py results (text: OUTPUT.bz2, binary: OUTPUT.bin)
+MAP_RESULT_SUFFIXES = ('.bz2', ABUNDANCE_BINARY_SUFFIX)
+
+def read_gene_cov_file(input_file, checksum=None):
+    """Convert coverage mapping file into a dictionary data structure.
+    Only the first two columns (gene, summed depth) are used, the optional columns
+    of panphlan_map.py --extra_stats (covered bases, mean depth, max depth) are ignored.
+    Binary files (panphlan_map.py --out_format bin) are memory-mapped as a vector aligned to the pangenome genes
+    """
+    if input_file.endswith(ABUNDANCE_BINARY_SUFFIX):
+        return read_abundance_binary(input_file, checksum)
     d = {}
     f = bz2.open(input_file, mode='rt')
     for line in f:
+        if line.startswith('#'): continue # header lines, e.g. the fraction of the reads mapped (--max_reads, --subsample)
         words = line.strip().split('\t')
         gene, coverage = words[0], int(words[1])
         d[gene] = coverage
     f.close()
     return d
 
-def read_map_results(i_dna, VERBOSE):
-    """Read results from panphlan_map.py"""
-    dna_samples_covs = {}
-    dna_files_list =  os.listdir(i_dna)
-    for dna_covs_file in dna_files_list: # i_dna: path2id
+def read_family_coverages(input_file):
+    """Worker: gene-family coverage vector (aligned to the families) of a panphlan_map.py result file
+    :returns: (vector, None) or (None, error message)
+    """
+    try:
+        gene2cov = read_gene_cov_file(input_file, INGEST_CHECKSUM)
+        return get_genefamily_coverages(gene2cov, INGEST_GENE_INDEX, False), None
+    except SystemExit as err:
+        return None, str(err.code)
+    except Exception as err:
+        return None, '[E] Could not read ' + input_file + ': ' + repr(err)
+
+def read_map_results(i_dna, gene_index, families, args, checksum=None, kind='DNA', store=None):
+    """Read results from panphlan_map.py into the families x samples coverage matrix, samples in sorted order.
+    The files are read and summed into gene-family coverages by --nproc worker processes,
+    the files already in the --store are not read again.
+    """
+    global INGEST_GENE_INDEX, INGEST_CHECKSUM
+    sample2file = {}
+    for dna_covs_file in sorted(os.listdir(i_dna)): # i_dna: path2id
+        if not dna_covs_file.endswith(MAP_RESULT_SUFFIXES):
+            # e.g. the OUTPUT.telemetry.json sidecar of panphlan_map.py --telemetry
+            if args.verbose: print('[W] ' + dna_covs_file + ' in ' + i_dna + ' is not a panphlan_map.py result, skipped')
+            continue
         dna_sample_id = get_sampleID_from_path(dna_covs_file)
-        if VERBOSE: print(' [I] Reading mapping result file: ' + dna_covs_file )
-        dna_samples_covs[dna_sample_id] = read_gene_cov_file(os.path.join(i_dna, dna_covs_file))
-    return dna_samples_covs
-
-def get_genefamily_coverages(gene2cov, genes_info, VERBOSE):
-    """Sum single gene coverage to gene-families coverages based on pangenome clustering"""
-    # family2gene_info = { GENE FAMILY : ( SUM OF FAMILY'S GENE UNNORMALIZED COVERAGES , [ GENE'S LENGTH ] ) }
-    family2gene_info = defaultdict(list)
-    family2cov = defaultdict(float)
-    for g in genes_info.keys():
-        if g in gene2cov:
-            family2gene_info[genes_info[g]['family']].append((gene2cov[g], genes_info[g]['length']))
-        else:
-            family2gene_info[genes_info[g]['family']].append((0, genes_info[g]['length']))
-    for f in family2gene_info:
-        # family2gene_info[f] := [(cov1, len1), (cov2, len2), ...]
-        sum_of_covs = float(sum(e[0] for e in family2gene_info[f]))
-        sum_of_lens = float(sum(e[1] for e in family2gene_info[f]))
-        cov = sum_of_covs / (sum_of_lens / len(family2gene_info[f]))
-        family2cov[f] = cov
-    return family2cov
-
-def print_coverage_matrix(dna_samples_covs, out_channel, families, VERBOSE):
+        if dna_sample_id in sample2file:
+            print('[W] ' + sample2file[dna_sample_id] + ' and ' + dna_covs_file + ' are both results of sample ' + dna_sample_id + ', the last one is used')
+        sample2file[dna_sample_id] = dna_covs_file
+    if args.samples and kind == 'DNA':
+        missing = [s for s in args.samples if not s in sample2file]
+        if missing:
+            sys.exit('[E] Samples not found in ' + i_dna + ': ' + ', '.join(missing))
+        sample2file = dict((s, sample2file[s]) for s in args.samples)
+    samples = sorted(sample2file.keys())
+    matrix = FamilyMatrix(families, samples, numpy.zeros((len(families), len(samples)), dtype=numpy.float64))
+
+    INGEST_GENE_INDEX, INGEST_CHECKSUM = gene_index, checksum
+    to_read = samples
+    if store:
+        keys = dict((s, store.file_key(os.path.join(i_dna, sample2file[s]))) for s in samples)
+        if kind == 'DNA': store.sample_keys.update(keys)
+        to_read = []
+        for j, sample in enumerate(samples):
+            vector = store.coverages(keys[sample])
+            if vector is None or len(vector) != len(families):
+                to_read.append(sample)
+            else:
+                matrix.values[:, j] = vector
+        print('[I] Store: ' + str(len(samples) - len(to_read)) + ' ' + kind + ' samples loaded, ' + str(len(to_read)) + ' result files to read')
+    paths = [os.path.join(i_dna, sample2file[s]) for s in to_read]
+    nproc = min(args.nproc, len(paths))
+    pool = multiprocessing.get_context('fork').Pool(nproc) if nproc > 1 else None
+    try:
+        results = pool.imap(read_family_coverages, paths) if pool else map(read_family_coverages, paths)
+        for sample, (vector, error) in zip(to_read, results):
+            if args.verbose:
+                print(' [I] Reading mapping result file: ' + sample2file[sample])
+                print(' [I] Gene family normalization for ' + kind + ' sample ' + sample + '...')
+            if error is not None:
+                sys.exit(error)
+            matrix.values[:, matrix.sample_idx[sample]] = vector
+            if store: store.put_coverages(keys[sample], vector)
+    finally:
+        if pool: pool.terminate()
+    return matrix
+
+def get_genefamily_coverages(gene2cov, gene_index, VERBOSE):
+    """Sum single gene coverage to gene-families coverages based on pangenome clustering:
+    coverage of a family = sum of its gene coverages / mean length of its genes
+    :returns: vector aligned to the families
+    """
+    if isinstance(gene2cov, numpy.ndarray): # binary map result, aligned to the pangenome genes
+        gene_covs = numpy.asarray(gene2cov, dtype=numpy.float64)
+    else:
+        gene_covs = gene_index.gene_vector(gene2cov)
+    sum_of_covs = numpy.bincount(gene_index.family, weights=gene_covs, minlength=len(gene_index.mean_length))
+    family_covs = numpy.zeros(len(sum_of_covs), dtype=numpy.float64)
+    family_covs[gene_index.with_genes] = sum_of_covs[gene_index.with_genes] / gene_index.mean_length[gene_index.with_genes]
+    return family_covs
+
+def print_coverage_matrix(dna_samples_covs, out_channel, families, VERBOSE, out_format='tsv'):
     """Print merged table of gene-family coverage for all samples (option: --o_cov)"""
-    dna_sample_ids = sorted(dna_samples_covs.keys())
-    with open(out_channel, mode='w') as OUT:
-        OUT.write('\t' + '\t'.join(dna_sample_ids) + '\n')
-        for f in families:
-            tmp = [dna_samples_covs[s][f] for s in dna_samples_covs]
-            if len(tmp) > 0:
-                if sum(tmp) > 0.0:
-                    OUT.write(f)
-                    for s in dna_sample_ids:
-                        OUT.write('\t' + str(format(dna_samples_covs[s][f], '.3f')))
-                    OUT.write('\n')
+    matrix = dna_samples_covs.reindex(families)
+    matrix = matrix.select([matrix.samples[j] for j in matrix.sorted_columns()])
+    if len(matrix.samples) > 0:
+        covered = numpy.flatnonzero(matrix.values.sum(axis=1) > 0.0)
+        matrix = FamilyMatrix([families[i] for i in covered], matrix.samples, matrix.values[covered])
+    else:
+        matrix = FamilyMatrix([], [], matrix.values[:0])
+    write_coverage_matrix(matrix, out_channel, out_format)
     if VERBOSE: print('Gene families coverage matrix has been printed in ' + out_channel)
 
+def write_coverage_matrix(matrix, out_channel, out_format='tsv'):
+    """Write a coverage matrix as text (3 decimals) or as binary float32 matrix (--covmat_format)"""
+    if out_format == 'bin':
+        write_coverage_binary(out_channel, matrix.families, matrix.samples, matrix.values)
+        return
+    with open(out_channel, mode='w') as OUT:
+        OUT.write('\t' + '\t'.join(matrix.samples) + '\n')
+        for f, covs in zip(matrix.families, matrix.values.tolist()):
+            OUT.write(f)
+            for v in covs:
+                OUT.write('\t' + str(format(v, '.3f')))
+            OUT.write('\n')
+
 # Or READ EXISTING COVERAGE MATRIX
 
-def read_coverage_matrix(cov_matrix_file):
-    """Read coverage matrix (option --o_cov) for re-analysis using other thresholds"""
+def read_coverage_matrix(cov_matrix_file, samples=None):
+    """Read coverage matrix (option --o_cov) for re-analysis using other thresholds, only the columns of samples if given.
+    The rows are the families of the file, which may differ from the families of the pangenome.
+    """
 
-    sample2family2cov = defaultdict(dict)
+    family2covs = {}
 
     if not os.path.exists(cov_matrix_file):
         sys.exit('\nERROR: Could not find --i_covmat input file: ' + cov_matrix_file)
+    if is_coverage_binary(cov_matrix_file):
+        families, sample_list, data = read_coverage_binary(cov_matrix_file, samples)
+        return FamilyMatrix(families, sample_list, numpy.asarray(data, dtype=numpy.float64).T)
 
     with open(cov_matrix_file, mode='r') as IN:
         sample_list = IN.readline().strip().split('\t') # get headerline
+        columns = list(range(len(sample_list)))
+        if samples is not None:
+            sample_idx = dict((s, j) for j, s in enumerate(sample_list))
+            missing = [s for s in samples if not s in sample_idx]
+            if missing:
+                sys.exit('[E] Samples not found in ' + cov_matrix_file + ': ' + ', '.join(missing))
+            columns, sample_list = [sample_idx[s] for s in samples], list(samples)
         for i,line in enumerate(IN):
             cols = line.strip().split('\t')
             genefamilyID = cols[0]
             coverage_values = cols[1:]
-            if not len(sample_list)==len(coverage_values):
+            if not len(columns) == len(coverage_values) and samples is None:
                 print('[E] ERROR while reading --i_cov: coverage lines does not fit number of sampleIDs in headerline')
-            for sample, cov_str in zip(sample_list, coverage_values):
+            covs = family2covs.setdefault(genefamilyID, [0.0] * len(sample_list))
+            for j, c in enumerate(columns):
+                if c >= len(coverage_values): break
+                cov_str = coverage_values[c]
                 try:
                     cov = float(cov_str)
                 except ValueError:
                     print('[E] ERROR while reading --i_covmat: Could not convert coverage value "'+ cov_str +'" to number, line:' + str(i))
-                sample2family2cov[sample][genefamilyID] = cov
+                covs[j] = cov
 
-    return sample2family2cov
+    values = numpy.array(list(family2covs.values()), dtype=numpy.float64).reshape(len(family2covs), len(sample_list))
+    return FamilyMatrix(family2covs.keys(), sample_list, values)
 
 # ------------------------------------------------------------------------------
 #  STEP 3 Strain presence/absence filter based on coverage plateau curve
@@ -380,21 +603,20 @@ def adjust_genome_length(genome2families):
     return avg_genome_length
 
 def defining_normalized_coverage(samples_coverages, avg_genome_length, families):
-    norm_samples_coverages = defaultdict(dict)
+    """Divide the coverages of each sample by the median of its avg_genome_length highest family coverages.
+    The median is taken over the rows of the coverage matrix, the normalized matrix has a row per pangenome family.
+    """
     median_cov = defaultdict()
-    for sample in sorted(samples_coverages.keys()):
-        d = samples_coverages[sample]
-        # Take families coverage from sample and sort descendently by value (coverage)
-        # items() turn dict to list of tuples (keys, values)
-        families_covs = sorted(d.items(), key=lambda x: x[1])
-        families_covs = families_covs[::-1] # reverse
-        #del(d)
-        median_cov[sample] = numpy.median([p[1] for p in families_covs][:avg_genome_length])
-        for f in families: # all gene-families of the pangenome
-            normed_cov = 0.0
-            if (not median_cov[sample] == 0) and (f in samples_coverages[sample]):
-                normed_cov = samples_coverages[sample][f] / median_cov[sample]
-            norm_samples_coverages[sample][f] = normed_cov
+    # Sort families coverages of each sample descendently
+    ordered_covs = -numpy.sort(-samples_coverages.values, axis=0)
+    norm_samples_coverages = samples_coverages.reindex(families, fill=0.0)
+    for j in samples_coverages.sorted_columns():
+        sample = samples_coverages.samples[j]
+        median_cov[sample] = numpy.median(ordered_covs[:avg_genome_length, j])
+        if median_cov[sample] == 0:
+            norm_samples_coverages.values[:, j] = 0.0
+        else:
+            norm_samples_coverages.values[:, j] /= median_cov[sample]
     return norm_samples_coverages, median_cov
 
 def strain_presence_plateau_filter(norm_samples_coverages, avg_genome_length, median_cov, args):
@@ -419,14 +641,15 @@ def strain_presence_plateau_filter(norm_samples_coverages, avg_genome_length, me
         print(' [I] Right minimum plateau threshold: '                            + str(args.right_min))
         print(' [I] Maximum zero non-plateau threshold (multistrain detection): ' + str(th_max_zero))
 
-    for sample in sorted(norm_samples_coverages.keys()):
-        ordered_cov = [x[1] for x in norm_samples_coverages[sample].items()] # extract all coverage value from sample
-        ordered_cov = sorted(ordered_cov, reverse = True)
+    ordered_covs = -numpy.sort(-norm_samples_coverages.values, axis=0) # all coverage values of each sample, descending
+    for j in norm_samples_coverages.sorted_columns():
+        sample = norm_samples_coverages.samples[j]
+        ordered_cov = ordered_covs[:, j]
 
-        leftcov = ordered_cov[int(avg_genome_length * 0.3)]
-        rightcov = ordered_cov[int(avg_genome_length * 0.7)]
+        leftcov = float(ordered_cov[int(avg_genome_length * 0.3)])
+        rightcov = float(ordered_cov[int(avg_genome_length * 0.7)])
         loc = int(avg_genome_length * 1.25) # sample may have less gene-families than N*1.25
-        zerocov = ordered_cov[loc] if (len(ordered_cov) > loc) else 0
+        zerocov = float(ordered_cov[loc]) if (len(ordered_cov) > loc) else 0
 
         if VERBOSE:
             print(' [I] ' + sample + ' median coverage: ' + str(round( median_cov[sample],2)) +
@@ -435,6 +658,7 @@ def strain_presence_plateau_filter(norm_samples_coverages, avg_genome_length, me
                   '; out-plateau cov: ' + str(round(zerocov, 2)) )
 
         sample_stats[sample] = {'strainCoverage' :  median_cov[sample]}
+        sample_stats[sample].update({'leftCoverage' : leftcov, 'rightCoverage' : rightcov, 'outPlateauCoverage' : zerocov})
         sample_stats[sample].update({'accepted' : median_cov[sample] >= args.min_coverage})
         if not sample_stats[sample]['accepted']:
             print('\t' + sample + ': no strain detected, sample below MIN COVERAGE threshold')
@@ -457,6 +681,39 @@ def strain_presence_plateau_filter(norm_samples_coverages, avg_genome_length, me
     # accepted_samples_list = sorted([s for s in sample2accepted if sample2accepted[s]])
     return sample_stats
 
+def profile_samples(dna_samples_covs, avg_genome_length, families, args, store=None):
+    """Steps 3 and 4 of each sample, which do not depend on the other samples: median normalization,
+    plateau filter and 1,-1,-2,-3 levels of the gene families.
+    With --store, the samples already profiled with the same thresholds are loaded instead.
+    :returns: normalized coverage matrix, median coverages, sample stats and levels matrix of all the samples
+    """
+    samples = sorted(dna_samples_covs.samples)
+    profiles = dict((s, store.profile(s, args)) for s in samples) if store else {}
+    todo = [s for s in samples if profiles.get(s) is None]
+    if todo:
+        todo_covs = dna_samples_covs if todo == dna_samples_covs.samples else dna_samples_covs.select(todo)
+        norm_samples_coverages, medians = defining_normalized_coverage(todo_covs, avg_genome_length, families)
+        stats = strain_presence_plateau_filter(norm_samples_coverages, avg_genome_length, medians, args)
+        levels = index_of(args.th_non_present, args.th_present, args.th_multicopy, norm_samples_coverages.values)
+        for j, s in enumerate(todo):
+            profiles[s] = (medians[s], stats[s], levels[:, j])
+            if store: store.put_profile(s, args, *profiles[s])
+    if store:
+        print('[I] Store: ' + str(len(samples) - len(todo)) + ' sample profiles loaded, ' + str(len(todo)) + ' computed')
+
+    median_cov, sample_stats = defaultdict(), defaultdict(dict)
+    levels = FamilyMatrix(families, samples, numpy.zeros((len(families), len(samples)), dtype=numpy.int8))
+    for j, s in enumerate(samples):
+        median_cov[s], sample_stats[s], levels.values[:, j] = profiles[s]
+    if not todo or len(todo) < len(samples): # normalize the loaded samples with their stored median (or no sample at all)
+        norm_samples_coverages = dna_samples_covs.reindex(families, fill=0.0).select(samples)
+        for j, s in enumerate(samples):
+            if median_cov[s] == 0:
+                norm_samples_coverages.values[:, j] = 0.0
+            else:
+                norm_samples_coverages.values[:, j] /= median_cov[s]
+    return norm_samples_coverages, median_cov, sample_stats, levels
+
 def plot_dna_coverage(samples_coverages, sample_stats, genome_length, args, normalized ):
     """Plot gene-family coverage plots.
     a) absolute coverage
@@ -471,7 +728,7 @@ def plot_dna_coverage(samples_coverages, sample_stats, genome_length, args, norm
         try:
             from pylab import legend, savefig
 
-            samples = sorted(samples_coverages.keys())
+            samples = sorted(samples_coverages.samples)
             accepted2samples = defaultdict(list)
             num_accepted = 0
             for s in samples:
@@ -502,8 +759,7 @@ def plot_dna_coverage(samples_coverages, sample_stats, genome_length, args, norm
 
                 plt.xlabel('Gene families')
                 for s in samples:
-                    covs = samples_coverages[s].values() # also finc a way to extract covs from here
-                    covs = sorted(list(covs), reverse =True)
+                    covs = sorted(samples_coverages.column(s).tolist(), reverse =True)
                     if accepted2samples[s]:
                         plt.plot(range(1, len(covs) +1), covs, sample2color[s], label=s)
                     #elif not sum(covs) == 0:
@@ -529,44 +785,38 @@ def plot_dna_coverage(samples_coverages, sample_stats, genome_length, args, norm
 #  STEP 4 Define strain-specific gene-families presence/absence
 # ------------------------------------------------------------------------------
 def index_of(th_non_present, th_present, th_multicopy, normalized_coverage):
-    if normalized_coverage < th_non_present:
-        return -3
-    elif normalized_coverage <= th_present:
-        return -2
-    elif normalized_coverage <= th_multicopy:
-        return  1
-    else:
-        return -1
-
-def get_idx123_plateau_definitions(sample_stats, norm_samples_coverages, families, args):
+    """1, -1, -2, -3 levels of an array of normalized coverages"""
+    levels = numpy.full(normalized_coverage.shape, -1, dtype=numpy.int8)
+    levels[normalized_coverage <= th_multicopy] = 1
+    levels[normalized_coverage <= th_present] = -2
+    levels[normalized_coverage < th_non_present] = -3
+    return levels
+
+def get_idx123_plateau_definitions(sample_stats, levels, families, args):
     """-o_idx HMP_saureus_DNAindex.csv
     To use later also in RNA-seq, we need an DNA index matrix containing 4 levels (1, -1, -2, -3)
 
-    Take samples that passed plateau criteria and define index based on coverage level of gene-families
+    Take samples that passed plateau criteria and their index based on coverage level of gene-families (see index_of())
          1 means plateau area of gene-families
         -1 means multicopy core genes (left from plateau), present also in other species
         -2 means undefined gene-families between plateau-level and zero
         -3 means "clearly" non-present gene-families
     """
-    sample2family2dnaidx = defaultdict(dict)
     accepted_samples = []
     for x in sample_stats:
         if sample_stats[x]['accepted']:  accepted_samples.append(x)
     accepted_samples = sorted(accepted_samples)
 
-    for sample in accepted_samples:
-        if args.verbose: print(' [I] Get DNA 1,-1,-2,-3 levels for sample ' + sample)
-        for family in families:
-            sample2family2dnaidx[sample][family] = index_of(args.th_non_present, args.th_present, args.th_multicopy, norm_samples_coverages[sample][family])
+    if args.verbose:
+        for sample in accepted_samples:
+            print(' [I] Get DNA 1,-1,-2,-3 levels for sample ' + sample)
+    sample2family2dnaidx = levels.reindex(families).select(accepted_samples)
 
     if args.o_idx and len(accepted_samples) > 0:
         with open(args.o_idx, mode='w') as OUT:
             OUT.write('\t' + '\t'.join(accepted_samples) + '\n')
-            for family in families:
-                OUT.write(family)
-                for sample in accepted_samples:
-                    OUT.write('\t' + str(sample2family2dnaidx[sample][family]))
-                OUT.write('\n')
+            for family, levels in zip(families, sample2family2dnaidx.values.astype(str)):
+                OUT.write(family + '\t' + '\t'.join(levels) + '\n')
     elif len(accepted_samples) == 0:
         print('[W] No DNA 1,2,3 index file has been written because no strain was detected.')
     return sample2family2dnaidx
@@ -580,21 +830,13 @@ def get_genefamily_presence_absence(sample2family2dnaidx, sample_stats, avg_geno
     gene family in sample has DNA index  1 or -1 ==> present (1)
     gene family in sample has DNA index -2 or -3 ==> NOT present (0)
     """
-    if len(sample2family2dnaidx) == 0:
+    if len(sample2family2dnaidx.samples) == 0:
         sys.exit('[E] No sample passed the coverage threshold. Try more sensitive threhold or check that you are using both forward and reverse reads.')
-    sample2family2presence = defaultdict(dict)
-    dna_samples = sorted(sample2family2dnaidx.keys())
-    # get keys (families names) from the sub dict.
-    # Since information is already here no need to pass further arg to the function
-    families = sample2family2dnaidx[dna_samples[0]].keys()
-
-    for f in families:
-        for sample in dna_samples:
-            sample2family2presence[sample][f] = sample2family2dnaidx[sample][f] >= -1
+    dna_samples = sample2family2dnaidx.samples
+    sample2family2presence = FamilyMatrix(sample2family2dnaidx.families, dna_samples, sample2family2dnaidx.values >= -1)
 
     # get number of gene-families per sample (add to dict sample_stats)
-    for sample in sample2family2presence.keys():
-        numGeneFamilies = sum( sample2family2presence[sample][f] for f in sample2family2presence[sample] )
+    for sample, numGeneFamilies in zip(dna_samples, sample2family2presence.values.sum(axis=0).tolist()):
         sample_stats[sample].update({'numberGeneFamilies' : numGeneFamilies})
 
     if args.verbose:
@@ -655,16 +897,11 @@ def select_related_ref_genomes(genome2families, samples_panfamilies, args):
         print('[I] Selected strains are: ' + ', '.join(selected_strains))
 
 
-def get_samples_panfamilies(families, sample2family2presence):
-    """Get the sorted list of all the families present in the samples
+def get_samples_panfamilies(sample2family2presence):
+    """Get the set of all the families present in the samples
     Can be a subset of the pangenome's set of families"""
-    panfamilies = set()
-    for f in families:
-        for s in sample2family2presence:
-            if sample2family2presence[s][f]:
-                panfamilies.add(f)
-                break
-    return sorted(panfamilies)
+    present = sample2family2presence.values.any(axis=1)
+    return set(f for f, p in zip(sample2family2presence.families, present.tolist()) if p)
 
 
 def merge_samples_strains_presences(sample2family2presence, genome2families, args):
@@ -676,33 +913,25 @@ def merge_samples_strains_presences(sample2family2presence, genome2families, arg
     NB. Some gene-families can be present in samples, but not in the selected (>50%) strains.
         Some gene-families can be present in selected strains, but not in samples (if a strain is selected, we show all of it's gene-families).
     """
-    dna_samples = sorted(sample2family2presence.keys())
-    families = sample2family2presence[dna_samples[0]].keys()
-    ref_genomes = genome2families.keys()
+    families = sample2family2presence.families
     # Get all present (in at least one sample) families
-    samples_panfamilies = get_samples_panfamilies(families, sample2family2presence)
+    samples_panfamilies = get_samples_panfamilies(sample2family2presence)
     select_related_ref_genomes(genome2families, samples_panfamilies, args)
 
-    # ADAPT forone is dict of presence (dict of dict) and other list of families present
-    # Merge the two dictionaries
-    sample_and_strain_presences = {}
-    for s in sample2family2presence:
-        sample_and_strain_presences[s] = sample2family2presence[s]
-    for ref in genome2families:
-        sample_and_strain_presences[ref] = {f : f in genome2families[ref] for f in families}
-    return sample_and_strain_presences
+    # Merge the two matrices: first the samples columns, then the strains columns
+    refs = [ref for ref in genome2families if ref not in sample2family2presence.sample_idx]
+    ref_presences = numpy.zeros((len(families), len(refs)), dtype=bool)
+    for j, ref in enumerate(refs):
+        ref_presences[:, j] = [f in genome2families[ref] for f in families]
+    return FamilyMatrix(families, sample2family2presence.samples + refs,
+                        numpy.concatenate([sample2family2presence.values, ref_presences], axis=1))
 
 # ------------------------------------------------------------------------------
 #  STEP 7 RNA ANALYSIS
 # ------------------------------------------------------------------------------
 
-def read_rna_coverage(input_rna, genes_info, verbose):
-    rna_samples_covs = read_map_results(input_rna, verbose)
-    for sample in sorted(rna_samples_covs.keys()):
-        if verbose: print(' [I] Gene family normalization for RNA sample ' + sample + '...')
-        rna_samples_covs[sample] = get_genefamily_coverages(rna_samples_covs[sample], genes_info, verbose)
-        # dict of samples, for each sample : nested dict with familly and normalized coverage
-    return rna_samples_covs
+def read_rna_coverage(input_rna, gene_index, families, args, checksum=None, store=None):
+    return read_map_results(input_rna, gene_index, families, args, checksum, kind='RNA', store=store)
 
 
 def read_samples_pairs(mapping_file):
@@ -720,68 +949,44 @@ def read_samples_pairs(mapping_file):
 
 
 def create_ratio_matrix(rna_samples_covs, dna_samples_covs, dna2rna, dna_accepted_samples, families):
-    sample2family2rna_div_dna = defaultdict(dict)
-    rna_samples = []
     # Use only DNA samples that passed the strain detection criteria and to which a RNA sample pair is available
     dna_sample_list = sorted([s for s in dna_accepted_samples if s in dna2rna.keys()])
-
-    for dna_sample in dna_sample_list:
-        rna_sample = dna2rna[dna_sample]
-        rna_samples.append(dna_sample)
-        # For each family present in at least one sample, divide RNA coverage for the correlative DNA coverage
-        for f in families:
-            dna_cov = dna_samples_covs[dna_sample][f]
-            if dna_cov == 0.0: # We avoid a division by zero :)
-                sample2family2rna_div_dna[dna_sample][f] = 0.0
-            else:
-                rna_cov = rna_samples_covs[rna_sample][f]
-                sample2family2rna_div_dna[dna_sample][f] = rna_cov / dna_cov
-    return sample2family2rna_div_dna
+    dna_covs = dna_samples_covs.reindex(families).select(dna_sample_list).values
+    rna_covs = rna_samples_covs.reindex(families).select([dna2rna[s] for s in dna_sample_list]).values
+    # For each family, divide RNA coverage for the correlative DNA coverage, we avoid a division by zero :)
+    rna_div_dna = numpy.zeros(dna_covs.shape, dtype=numpy.float64)
+    numpy.divide(rna_covs, dna_covs, out=rna_div_dna, where=dna_covs != 0.0)
+    return FamilyMatrix(families, dna_sample_list, rna_div_dna)
 
 
 def filter_normalize_rna_rate(sample2family2rna_div_dna, sample2family2dnaidx, families, args ):
-
-    sample2family2median_norm = defaultdict(dict)
-    sample2zeroes = defaultdict(tuple)
+    """Normalize the RNA/DNA ratios of the plateau gene families (DNA index 1) by their percentile and log scale them.
+    :returns: matrix of the accepted samples, NaN where the family is not in the plateau
+              (written as NP for the non-present families, DNA index -3)
+    """
     sample2zeroes_ratio = defaultdict(float)
     median = defaultdict(float)
+    rna_div_dna = sample2family2rna_div_dna.values
+    dnaidx = sample2family2dnaidx.reindex(families).select(sample2family2rna_div_dna.samples).values
+    median_norm = numpy.full(rna_div_dna.shape, numpy.nan)
 
     # Percentile (default 50 = median) normalization
-    # plateau_rna_div_dna = []
-    for sample in sample2family2rna_div_dna.keys():
-        sample2zeroes[sample] = (0,0)
+    for j, sample in enumerate(sample2family2rna_div_dna.samples):
         # Take all the gene families belonging to the plateau and calculate the median of their RNA/DNA values
-        # print(sample)
-        # for f in sample2family2rna_div_dna[sample]:
-        #     print("{} : {}".format(f, sample2family2dnaidx[sample][f]))
-        #     if sample2family2dnaidx[sample][f] == 1:
-        #         plateau_rna_div_dna.append(sample2family2rna_div_dna[sample][f])
-        #
-        plateau_rna_div_dna = [sample2family2rna_div_dna[sample][f] for f in sample2family2rna_div_dna[sample] if sample2family2dnaidx[sample][f] == 1]
-        if len(plateau_rna_div_dna) == 0:
+        plateau = dnaidx[:, j] == 1
+        if not plateau.any():
             continue
-        median[sample] = numpy.percentile(plateau_rna_div_dna, args.rna_norm_percentile) # default: 50
+        median[sample] = numpy.percentile(rna_div_dna[plateau, j], args.rna_norm_percentile) # default: 50
         if args.verbose:
             print(' [I] Median of plateau gene families RNA/DNA values: ' + str(median[sample]))
-        for f in families:
-            # If the family is in the plateau, calculate median normalized RNA/DNA value
-            if sample2family2dnaidx[sample][f] == 1:
-                if median[sample] == 0:
-                    sample2family2median_norm[sample][f] = 0.0
-                else:
-                    sample2family2median_norm[sample][f] = sample2family2rna_div_dna[sample][f] / median[sample]
-                # Update the number of zeroes over the total families (belonging to the plateau)
-                numof_zeroes, numof_families = sample2zeroes[sample]
-                numof_families += 1
-                if sample2family2median_norm[sample][f] == 0.0:
-                    numof_zeroes += 1
-                sample2zeroes[sample] = (numof_zeroes, numof_families)
-            # If not in the plateau, set to NaN
-            elif sample2family2dnaidx[sample][f] == -3:
-                sample2family2median_norm[sample][f] = 'NP'
-            else:
-                sample2family2median_norm[sample][f] = 'NaN'
-        sample2zeroes_ratio[sample] = float(sample2zeroes[sample][0]) / sample2zeroes[sample][1]
+        # If the family is in the plateau, calculate median normalized RNA/DNA value
+        if median[sample] == 0:
+            median_norm[plateau, j] = 0.0
+        else:
+            median_norm[plateau, j] = rna_div_dna[plateau, j] / median[sample]
+        # Number of zeroes over the total families (belonging to the plateau)
+        numof_zeroes = int((median_norm[plateau, j] == 0.0).sum())
+        sample2zeroes_ratio[sample] = float(numof_zeroes) / int(plateau.sum())
 
     print(sample2zeroes_ratio)
     # Reject samples with too many zeros
@@ -797,40 +1002,33 @@ def filter_normalize_rna_rate(sample2family2rna_div_dna, sample2family2dnaidx, f
             print('     Sample is rejected.')
 
     # Log nomalization
-    sample2family2log_norm = defaultdict(dict)
-    for sample in rnaseq_accepted_samples:
-        for f in families:
-            v = sample2family2median_norm[sample][f]
-            if type(v) is str:
-                sample2family2log_norm[sample][f] = sample2family2median_norm[sample][f]
-            else:
-                sample2family2log_norm[sample][f] = 0.0 if v == 0.0 else (numpy.log2(v) / 10) + 1.0
-
+    columns = [sample2family2rna_div_dna.sample_idx[s] for s in rnaseq_accepted_samples]
+    log_norm = median_norm[:, columns]
+    non_zero = log_norm != 0.0 # NaN included, log2 keeps it
+    log_norm[non_zero] = (numpy.log2(log_norm[non_zero]) / 10) + 1.0
+    sample2family2log_norm = FamilyMatrix(families, rnaseq_accepted_samples, log_norm)
+    sample2family2log_norm.non_present = dnaidx[:, columns] == -3
     return sample2family2log_norm
 
 
 def write_rna_rate_matrix(sample2family2log_norm, output_path, families):
-    rnaseq_accepted_samples = sample2family2log_norm.keys()
+    rnaseq_accepted_samples = sample2family2log_norm.samples
+    values = sample2family2log_norm.values
+    non_present = sample2family2log_norm.non_present
     if not output_path == '':
         with open(output_path, mode='w') as OUT:
             OUT.write('\t' + '\t'.join(rnaseq_accepted_samples) + '\n')
-            for f in families:
-                # Skip the never present gene families
-                all_null = True
-                for s in rnaseq_accepted_samples:
-                    if not sample2family2log_norm[s][f] == 'NP':
-                        if not sample2family2log_norm[s][f] == 'NaN':
-                            all_null = False
-                            break
-                if not all_null:
-                    OUT.write(f)
-                    for s in rnaseq_accepted_samples:
-                        v = sample2family2log_norm[s][f]
-                        if type(v) is float or type(v) is numpy.float64:
-                            OUT.write('\t' + str(format(v, '.3f')))
-                        else:
-                            OUT.write('\t' + v)
-                    OUT.write('\n')
+            # Skip the never present gene families (NP or NaN in all samples)
+            for i in numpy.flatnonzero(~numpy.isnan(values).all(axis=1)):
+                OUT.write(families[i])
+                for v, np in zip(values[i].tolist(), non_present[i].tolist()):
+                    if np:
+                        OUT.write('\tNP')
+                    elif v != v:
+                        OUT.write('\tNaN')
+                    else:
+                        OUT.write('\t' + str(format(v, '.3f')))
+                OUT.write('\n')
 
 # ------------------------------------------------------------------------------
 #   MAIN
@@ -842,9 +1040,15 @@ def main():
 
     args = read_params()
     check_args(args)
+    if args.i_covmat and args.o_covmat and not (args.o_matrix or args.o_idx or args.o_rna or args.o_covplot_normed):
+        print('\nConverting coverage matrix ' + args.i_covmat + ' to ' + args.o_covmat + ' (' + args.covmat_format + ')')
+        write_coverage_matrix(read_coverage_matrix(args.i_covmat, args.samples), args.o_covmat, args.covmat_format)
+        return
 
     print('\nSTEP 1. Processing genes informations from pangenome file...')
-    genes_info, families, genome2families = read_pangenome(args.pangenome)
+    gene_index, families, genome2families = read_pangenome(args.pangenome)
+    checksum = load_pangenome(args.pangenome).checksum
+    store = ProfilingStore(args.store, checksum) if args.store else None
     if args.add_ref:
         print('\nSTEP 1b. Get genes present in reference genomes...')
         ref2family2presence = build_ref2family2presence(families, genome2families, args.verbose)
@@ -861,24 +1065,20 @@ def main():
     if args.i_covmat == None:
         # no shortcut
         print('\nSTEP 2. Create coverage matrix')
-        dna_samples_covs = read_map_results(args.i_dna, args.verbose)
-        # Merge gene/transcript abundance into family (normalized) coverage
-        for sample in sorted(dna_samples_covs.keys()):
-            if args.verbose: print(' [I] Gene family normalization for DNA sample ' + sample + '...')
-            dna_samples_covs[sample] = get_genefamily_coverages(dna_samples_covs[sample], genes_info, args.verbose)
-            # dict of samples, for each sample : nested dict with familly and normalized coverage
+        # Merge gene/transcript abundance into the families x samples coverage matrix
+        dna_samples_covs = read_map_results(args.i_dna, gene_index, families, args, checksum, store=store)
         if args.o_covmat:
-            print_coverage_matrix(dna_samples_covs, args.o_covmat, families, args.verbose)
+            print_coverage_matrix(dna_samples_covs, args.o_covmat, families, args.verbose, args.covmat_format)
     else:
         # shortcut possible, precomputed coverage matrix available
         print('\nSTEP 2. Read provided coverage matrix')
-        dna_samples_covs = read_coverage_matrix(args.i_covmat)
+        dna_samples_covs = read_coverage_matrix(args.i_covmat, args.samples)
 
 
     print('\nSTEP 3: Strain presence/absence filter based on coverage plateau curve...')
     avg_genome_length = adjust_genome_length(genome2families)
-    norm_samples_coverages, median_cov = defining_normalized_coverage(dna_samples_covs, avg_genome_length, families)
-    sample_stats = strain_presence_plateau_filter(norm_samples_coverages, avg_genome_length, median_cov, args)
+    norm_samples_coverages, median_cov, sample_stats, dna_levels = profile_samples(dna_samples_covs, avg_genome_length, families, args,
+                                                                                   store if args.i_covmat == None else None)
     # if not args.o_covplot is None:
     #     plot_dna_coverage(dna_samples_covs, sample_stats, avg_genome_length, normalized = False, args)
     if args.o_covplot_normed:
@@ -886,7 +1086,7 @@ def main():
 
 
     print('\nSTEP 4: Define strain-specific gene-families presence/absence (1,-1,-2,-3 matrix, option --o_idx)')
-    sample2family2dnaidx = get_idx123_plateau_definitions(sample_stats, norm_samples_coverages, families, args)
+    sample2family2dnaidx = get_idx123_plateau_definitions(sample_stats, dna_levels, families, args)
 
 
     print('\nSTEP 5: Get presence/absence of gene-families (1,-1 matrix, option --o_matrix)')
@@ -895,7 +1095,7 @@ def main():
     # ADD STRAINS PRESENCE ABSCENCE IF NEEDED
     if args.add_ref:
         print('\nSTEP 5b: Add reference genomes in matrix of presence/absence')
-        # ss_presence = { STRAIN or SAMPLE : { GENE FAMILY : PRESENCE T or F } }
+        # ss_presence = families x (SAMPLES then STRAINS) presence matrix
         ss_presence = merge_samples_strains_presences(sample2family2presence, genome2families, args)
 
     if args.func_annot:
@@ -915,11 +1115,11 @@ def main():
     if args.o_rna:
         print('\nSTEP 7: Meta-transcriptomics analysis : Gene family transcription rate')
         # read rna coverage
-        rna_samples_covs = read_rna_coverage(args.i_rna, genes_info, args.verbose)
+        rna_samples_covs = read_rna_coverage(args.i_rna, gene_index, families, args, checksum, store)
         # check samples sample_pairs
         dna2rna = read_samples_pairs(args.sample_pairs)
         # build ratio matrix
-        dna_accepted_samples = sample2family2presence.keys()
+        dna_accepted_samples = sample2family2presence.samples
         sample2family2rna_div_dna = create_ratio_matrix(rna_samples_covs, dna_samples_covs, dna2rna, dna_accepted_samples, families)
         # filter and normalize this MATRIX
         sample2family2rna_div_dna = filter_normalize_rna_rate(sample2family2rna_div_dna, sample2family2dnaidx, families, args )
@@ -0,0 +1,253 @@
+import argparse
+import gzip
+import io
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy
+import pytest
+
+import panphlan_map
+
+
+def threads_of(nproc, filter_pushdown=False):
+    args = argparse.Namespace(nproc=nproc, filter_pushdown=filter_pushdown, sam_memory=4)
+    return panphlan_map.stage_threads(args)
+
+
+@pytest.mark.parametrize('nproc, decompress, bowtie2', [(4, 2, 3), (8, 2, 7), (16, 4, 14)])
+def test_stage_threads_decompress_floor(nproc, decompress, bowtie2):
+    threads = threads_of(nproc)
+    assert threads['decompress'] == decompress
+    assert threads['bowtie2'] == bowtie2
+    assert threads['bowtie2_plain'] == nproc
+    assert threads['index'] == threads['coverage'] == nproc
+
+
+@pytest.mark.parametrize('nproc', [4, 8, 16])
+def test_stage_threads_filter_pushdown(nproc):
+    threads = threads_of(nproc, filter_pushdown=True)
+    assert threads['filter'] == max(1, nproc // 8)
+    assert threads['decompress'] >= 2
+    assert threads['bowtie2'] == nproc - 2 * max(1, nproc // 8)
+
+
+@pytest.mark.parametrize('code', [None, 0, '[E] Samtools is not installed'])
+def test_manifest_sample_exit_is_failed(monkeypatch, code):
+    def exit_sample(args, gene_index):
+        raise SystemExit(code)
+    monkeypatch.setattr(panphlan_map, 'map_sample', exit_sample)
+    monkeypatch.setattr(panphlan_map, 'MANIFEST_ARGS', argparse.Namespace(output=None, out_bam=None, alignment=None))
+    output, outcome, message = panphlan_map.map_manifest_sample((__file__, 'sample_out', None, True))
+    assert (output, outcome) == ('sample_out', 'FAILED')
+    assert message
+
+
+def test_pileup_parts_groups_contigs():
+    contigs = [('c1', 100, 50), ('c2', 100, 0), ('c3', 100, 30), ('c4', 100, 20), ('c5', 100, 10), ('c6', 100, 40)]
+    gene_index = dict((c[0], None) for c in contigs if c[0] != 'c6')
+    parts = panphlan_map.pileup_parts(contigs, gene_index, 2)
+    # c2 has no read and c6 no gene, each group keeps the BAM header order
+    assert [[c[0] for c in part] for part in parts] == [['c1', 'c5'], ['c3', 'c4']]
+    assert len(panphlan_map.pileup_parts(contigs, gene_index, 8)) == 4
+
+
+def test_extra_stats_with_read_fraction(capsys):
+    args = argparse.Namespace(species=None, read_fraction=0.5, output=None, out_format='tsv')
+    panphlan_map.write_genes_abundances({'g1': 30}, args, {'g1': [8, 5, 10]})
+    assert capsys.readouterr().out.splitlines() == ['#read_fraction\t0.5', '#unscaled_columns\tcovered_bases,max_depth',
+                                                    'g1\t60\t8\t6.000\t5']
+
+
+SAM_RECORDS = [b'r1\t0\tctg1\t1\t30\t10M\t*\t0\t0\tAAAAAAAAAA\tIIIIIIIIII\tAS:i:0\tXM:i:1\n',
+               b'r2\t0\tctg1\t1\t30\t10M\t*\t0\t0\tAAAAAAAAAA\tIIIIIIIIII\tAS:i:-6\tXM:i:3\tNM:i:3\n',
+               b'r3\t0\tctg1\t1\t30\t10M\t*\t0\t0\tAAAAAAAAAA\tIIIIIIIIII\tAS:i:0\n',
+               b'r4\t0\tctg1\t1\t30\t10M\t*\t0\t0\tAAAAAAAAAA\tIIIIIIIIII\n',
+               b'r5\t0\tctg1\t1\t30\t5M\t*\t0\t0\tAAAAA\tIIIII\n']
+
+
+def filter_args(**kwargs):
+    args = argparse.Namespace(min_read_length=8, th_mismatches=2, telemetry=False)
+    args.__dict__.update(kwargs)
+    args.telemetry_recorder = panphlan_map.Telemetry(args)
+    return args
+
+
+def python_filter(args):
+    sam = io.BytesIO(b'@SQ\tSN:ctg1\tLN:100\n' + b''.join(SAM_RECORDS))
+    return [line.split(b'\t')[0].decode() for batch in panphlan_map.filter_sam(sam, args)
+            for line in batch if not line.startswith(b'@')]
+
+
+def test_filter_sam_records_without_tags():
+    # a missing XM:i: counts as 0 mismatches
+    assert python_filter(filter_args()) == ['r1', 'r3', 'r4']
+    assert python_filter(filter_args(th_mismatches=-1)) == ['r1', 'r2', 'r3', 'r4']
+    assert panphlan_map.samtools_filter_expression(filter_args()) == 'length(seq) >= 8 && (![XM] || [XM] <= 2)'
+
+
+def samtools_expressions():
+    try:
+        return shutil.which('samtools') is not None and panphlan_map.samtools_has_expressions()
+    except BaseException:
+        return False
+
+
+@pytest.mark.skipif(not samtools_expressions(), reason='needs samtools >= 1.12 (view -e)')
+@pytest.mark.parametrize('th_mismatches', [-1, 0, 2])
+def test_filter_pushdown_agrees_with_python_filter(tmp_path, th_mismatches):
+    args = filter_args(th_mismatches=th_mismatches)
+    sam = tmp_path / 'reads.sam'
+    sam.write_bytes(b'@SQ\tSN:ctg1\tLN:100\n' + b''.join(SAM_RECORDS))
+    out = subprocess.run(['samtools', 'view', '-e', panphlan_map.samtools_filter_expression(args), str(sam)],
+                         stdout=subprocess.PIPE, check=True).stdout
+    assert [line.split(b'\t')[0].decode() for line in out.splitlines()] == python_filter(args)
+
+
+def test_pileup_part_with_many_warnings(tmp_path, monkeypatch):
+    # more warnings than a pipe buffer before the pileup lines
+    samtools = tmp_path / 'samtools'
+    samtools.write_text('#!/bin/sh\n'
+                        'yes "[W::bam_hdr_read] warning" | head -c 1000000 >&2\n'
+                        'printf "ctg1\\t2\\tA\\t3\\t...\\tIII\\nctg1\\t3\\tA\\t1\\t.\\tI\\n"\n')
+    samtools.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmp_path) + os.pathsep + os.environ['PATH'])
+    gene_index = {'ctg1': (['g1'], numpy.array([1]), numpy.array([4]))}
+    monkeypatch.setattr(panphlan_map, 'PILEUP_GENE_INDEX', gene_index)
+    abundances, stats = panphlan_map.pileup_part(('in.bam', 'in.bed', True))
+    assert abundances == {'g1': 4}
+    assert stats == {'g1': [2, 3, 4]}
+
+
+def test_mapping_error_kills_children(tmp_path, monkeypatch):
+    # bowtie2 and the gzip decompressor would run for a long time after the filter failed
+    bowtie2 = tmp_path / 'bowtie2'
+    bowtie2.write_text('#!/bin/sh\nprintf "@HD\\tVN:1.0\\n"\nexec sleep 60\n')
+    bowtie2.chmod(0o755)
+    reads = tmp_path / 'reads.fq.gz'
+    reads.write_bytes(gzip.compress(b'@r1\nACGT\n+\nIIII\n' * 1000))
+    monkeypatch.setenv('PATH', str(tmp_path) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setattr(sys, 'argv', ['panphlan_map.py', '-i', str(reads), '--indexes', str(tmp_path / 'idx'),
+                                      '-p', str(tmp_path / 'pangenome.tsv'), '-o', str(tmp_path / 'out'), '--nproc', '4'])
+    args = panphlan_map.read_params()
+    args.input, args.indexes = [str(reads)], str(tmp_path / 'idx')
+    args.telemetry_recorder = panphlan_map.Telemetry(args)
+    started = []
+    popen = subprocess.Popen
+    monkeypatch.setattr(subprocess, 'Popen', lambda *a, **kw: started.append(popen(*a, **kw)) or started[-1])
+
+    def failing_filter(sam_stream, args):
+        raise OSError(28, 'No space left on device')
+        yield
+
+    monkeypatch.setattr(panphlan_map, 'filter_sam', failing_filter)
+    with pytest.raises(OSError):
+        panphlan_map.mapping(args)
+    assert len(started) >= 2
+    for p in started:
+        assert p.wait(timeout=10) is not None
+
+
+# genes at both ends of ctg1, overlapping genes (g3, g4, g5 on the reverse strand), ctg3 without reads
+LEGACY_PANGENOME = ('FAM1\tg1\tgenome1\tctg1\t1\t30\n'
+                    'FAM2\tg2\tgenome1\tctg1\t171\t200\n'
+                    'FAM3\tg3\tgenome1\tctg1\t50\t120\n'
+                    'FAM3\tg4\tgenome1\tctg1\t100\t140\n'
+                    'FAM4\tg5\tgenome1\tctg2\t60\t1\n'
+                    'FAM4\tg6\tgenome2\tctg2\t55\t80\n'
+                    'FAM5\tg7\tgenome2\tctg3\t1\t50\n')
+
+
+def test_array_engine_matches_legacy_coverage(tmp_path):
+    from misc import load_pangenome
+
+    pangenome_file = tmp_path / 'pangenome.tsv'
+    pangenome_file.write_text(LEGACY_PANGENOME)
+    pangenome = load_pangenome(str(pangenome_file))
+    random = numpy.random.RandomState(1)
+    pileup = tmp_path / 'pileup.csv'
+    with open(str(pileup), mode='w') as OUT:
+        for contig, length in [('ctg1', 200), ('ctg2', 90), ('ctg4', 50)]: # ctg4 has no gene
+            # half of the positions, always the first and the last one
+            positions = set(random.choice(numpy.arange(2, length), length // 2, replace=False).tolist()) | {1, length}
+            for position in sorted(positions):
+                depth = random.randint(1, 40)
+                OUT.write(contig + '\t' + str(position) + '\tA\t' + str(depth) + '\t' + '.' * depth + '\t' + 'I' * depth + '\n')
+    legacy = panphlan_map.legacy_abundances(str(pileup), panphlan_map.build_pangenome_dicts(pangenome))
+    engine = panphlan_map.pileup_abundances(str(pileup), panphlan_map.build_gene_index(pangenome))
+    assert dict(engine) == dict(legacy)
+    assert set(legacy) >= {'g1', 'g2', 'g3', 'g4', 'g5', 'g6'} and 'g7' not in legacy
+
+
+DIRECT_PANGENOME = ('FAM1\tg1\tgenome1\tctg1\t1\t20\n'
+                    'FAM2\tg2\tgenome1\tctg1\t15\t40\n'
+                    'FAM3\tg3\tgenome1\tctg2\t1\t10\n')
+
+# reference positions covered by each read in the mpileup depth: soft clips and insertions
+# take none, deletions and skipped regions count
+DIRECT_RECORDS = [('0', 'ctg2', 3, '8M', [(3, 10)]),
+                  ('0', 'ctg1', 1, '5S10M', [(1, 10)]),
+                  ('16', 'ctg1', 5, '4M2I4M', [(5, 12)]),
+                  ('0', 'ctg1', 8, '3M3D4M2S', [(8, 17)]),
+                  ('0', 'ctg1', 18, '2M5N3M', [(18, 27)]),
+                  ('4', 'ctg1', 1, '10M', []),   # unmapped
+                  ('256', 'ctg1', 1, '10M', []), # secondary
+                  ('0', 'ctg3', 1, '10M', [])]   # not in the pangenome
+
+
+def direct_sam(header):
+    lines = [b'@SQ\tSN:ctg1\tLN:50\n', b'@SQ\tSN:ctg2\tLN:10\n', b'@SQ\tSN:ctg3\tLN:10\n'] if header else []
+    for i, (flag, contig, pos, cigar, spans) in enumerate(DIRECT_RECORDS):
+        length = sum(int(n) for n, op in panphlan_map.CIGAR_OPS.findall(cigar.encode()) if op in b'MIS=X')
+        lines.append('\t'.join(['r' + str(i), flag, contig, str(pos), '30', cigar, '*', '0', '0',
+                                'A' * length, 'I' * length]).encode() + b'\n')
+    return lines
+
+
+@pytest.mark.parametrize('header', [True, False])
+def test_direct_coverage_matches_pileup(tmp_path, header):
+    from misc import load_pangenome
+
+    pangenome_file = tmp_path / 'pangenome.tsv'
+    pangenome_file.write_text(DIRECT_PANGENOME)
+    gene_index = panphlan_map.build_gene_index(load_pangenome(str(pangenome_file)))
+    coverage = panphlan_map.AlignmentCoverage(gene_index)
+    coverage.add_records(direct_sam(header))
+    direct_stats = {}
+    direct = coverage.gene_abundances(direct_stats)
+
+    depth = dict((c, numpy.zeros(51, dtype=int)) for c in ['ctg1', 'ctg2', 'ctg3'])
+    for flag, contig, pos, cigar, spans in DIRECT_RECORDS:
+        for start, end in spans:
+            depth[contig][start:end + 1] += 1
+    pileup = tmp_path / 'pileup.csv'
+    with open(str(pileup), mode='w') as OUT:
+        for contig in ['ctg1', 'ctg2', 'ctg3']:
+            for position in numpy.flatnonzero(depth[contig]).tolist():
+                d = int(depth[contig][position])
+                OUT.write(contig + '\t' + str(position) + '\tA\t' + str(d) + '\t' + '.' * d + '\t' + 'I' * d + '\n')
+    pileup_stats = {}
+    expected = panphlan_map.pileup_abundances(str(pileup), gene_index, pileup_stats)
+
+    assert list(direct.items()) == list(expected.items()) # same values in the same order
+    assert direct_stats == pileup_stats
+    assert direct == {'g1': 31, 'g2': 13, 'g3': 8}
+
+
+@pytest.mark.skipif(shutil.which('samtools') is None, reason='needs samtools')
+def test_direct_coverage_matches_samtools_mpileup(tmp_path):
+    from misc import load_pangenome
+
+    pangenome_file = tmp_path / 'pangenome.tsv'
+    pangenome_file.write_text(DIRECT_PANGENOME)
+    gene_index = panphlan_map.build_gene_index(load_pangenome(str(pangenome_file)))
+    coverage = panphlan_map.AlignmentCoverage(gene_index)
+    coverage.add_records(direct_sam(True))
+    sam, bam = tmp_path / 'reads.sam', str(tmp_path / 'reads.bam')
+    sam.write_bytes(b''.join(direct_sam(True)))
+    subprocess.run(['samtools', 'sort', '-o', bam, str(sam)], check=True)
+    pileup = subprocess.run(['samtools', 'mpileup', bam], stdout=subprocess.PIPE, check=True).stdout
+    expected = panphlan_map.stream_abundances(io.BytesIO(pileup), gene_index)
+    assert list(coverage.gene_abundances().items()) == list(expected.items())
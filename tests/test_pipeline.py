@@ -0,0 +1,101 @@
+import argparse
+import os
+import subprocess
+import sys
+
+import pytest
+
+import panphlan_profiling
+from misc import load_pangenome
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PANGENOME = ('FAM1\tg1\tgenome1\tctg1\t1\t10\n'
+             'FAM2\tg2\tgenome1\tctg1\t21\t30\n'
+             'FAM2\tg3\tgenome1\tctg2\t1\t10\n')
+
+SAM = ('@HD\tVN:1.0\tSO:unsorted\n'
+       '@SQ\tSN:ctg1\tLN:30\n'
+       '@SQ\tSN:ctg2\tLN:10\n'
+       'r1\t0\tctg1\t1\t30\t10M\t*\t0\t0\tAAAAAAAAAA\tIIIIIIIIII\tAS:i:0\n'
+       'r2\t0\tctg2\t1\t30\t10M\t*\t0\t0\tAAAAAAAAAA\tIIIIIIIIII\tAS:i:0\n')
+
+# Samtools stand-in: the alignments pass through view/sort unchanged, mpileup prints FAKE_PILE
+SAMTOOLS = '''#!/bin/sh
+if [ $# -eq 0 ]; then echo "Version: 1.10 (using htslib)" >&2; exit 1; fi
+for last; do :; done
+case "$1" in
+  view) if [ -f "$last" ]; then cat "$last"; else cat; fi ;;
+  sort) while [ $# -gt 0 ]; do if [ "$1" = "-o" ]; then out=$2; fi; shift; done; cat > "$out" ;;
+  index) touch "$last.bai" ;;
+  mpileup) cat "$FAKE_PILE" ;;
+esac
+'''
+
+
+def write(path, content, mode=0o644):
+    with open(str(path), 'w') as OUT:
+        OUT.write(content)
+    os.chmod(str(path), mode)
+    return str(path)
+
+
+@pytest.fixture
+def samtools_env(tmp_path):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    write(bin_dir / 'samtools', SAMTOOLS, 0o755)
+    pile = ''.join('ctg1\t' + str(p) + '\tA\t2\t..\tII\n' for p in range(1, 11))
+    pile += ''.join('ctg2\t' + str(p) + '\tA\t1\t.\tI\n' for p in range(1, 11))
+    env = dict(os.environ, PATH=str(bin_dir) + os.pathsep + os.environ['PATH'],
+               FAKE_PILE=write(tmp_path / 'pile.tsv', pile))
+    return env
+
+
+def test_telemetry_sidecar_is_not_a_profiling_input(tmp_path, samtools_env):
+    pangenome = write(tmp_path / 'pangenome.tsv', PANGENOME)
+    sam = write(tmp_path / 'S1.sam', SAM)
+    map_dir = tmp_path / 'map'
+    map_dir.mkdir()
+    output = str(map_dir / 'S1_map.tsv')
+    subprocess.run([sys.executable, os.path.join(REPO, 'panphlan_map.py'), '--i_sam', sam, '-p', pangenome,
+                    '-o', output, '--nproc', '1', '--telemetry'],
+                   env=samtools_env, stdin=subprocess.DEVNULL, check=True, stdout=subprocess.PIPE)
+    assert sorted(os.listdir(str(map_dir))) == ['S1_map.tsv.bz2', 'S1_map.tsv.telemetry.json']
+
+    pangenome = load_pangenome(pangenome)
+    gene_index = panphlan_profiling.GeneIndex(pangenome)
+    families = pangenome.families.tolist()
+    args = argparse.Namespace(samples=None, nproc=1, verbose=False)
+    matrix = panphlan_profiling.read_map_results(str(map_dir), gene_index, families, args)
+    assert matrix.samples == ['S1']
+    assert matrix.column('S1').tolist() == [2.0, 1.0]
+
+
+def run_map(samtools_env, *options):
+    subprocess.run([sys.executable, os.path.join(REPO, 'panphlan_map.py')] + [str(o) for o in options],
+                   env=samtools_env, stdin=subprocess.DEVNULL, check=True, stdout=subprocess.PIPE)
+
+
+def test_cached_coverage_writes_out_bam(tmp_path, samtools_env):
+    pangenome = write(tmp_path / 'pangenome.tsv', PANGENOME)
+    sam = write(tmp_path / 'S1.sam', SAM)
+    cache_dir = tmp_path / 'cache'
+    run_map(samtools_env, '--i_sam', sam, '-p', pangenome, '-o', tmp_path / 'out1', '--nproc', '1', '--cache_dir', cache_dir)
+    run_map(samtools_env, '--i_sam', sam, '-p', pangenome, '-o', tmp_path / 'out2', '--nproc', '1', '--cache_dir', cache_dir,
+            '-b', tmp_path / 'out2.bam')
+    cached_bam, = cache_dir.glob('*.sorted.bam')
+    assert (tmp_path / 'out2.bam').read_bytes() == cached_bam.read_bytes()
+    assert (tmp_path / 'out2.bz2').read_bytes() == (tmp_path / 'out1.bz2').read_bytes()
+
+
+def test_cached_bam_index_is_kept(tmp_path, samtools_env):
+    pangenome = write(tmp_path / 'pangenome.tsv', PANGENOME)
+    sam = write(tmp_path / 'S1.sam', SAM)
+    cache_dir = tmp_path / 'cache'
+    run_map(samtools_env, '--i_sam', sam, '-p', pangenome, '-o', tmp_path / 'out1', '--nproc', '1', '--cache_dir', cache_dir)
+    index, = cache_dir.glob('*.sorted.bam.bai')
+    # another coverage option reuses the cached BAM and its index
+    run_map(samtools_env, '--i_sam', sam, '-p', pangenome, '-o', tmp_path / 'out2', '--nproc', '1', '--cache_dir', cache_dir,
+            '--extra_stats')
+    assert index.exists() and len(list(cache_dir.glob('*.coverage'))) == 2
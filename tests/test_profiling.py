@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PANGENOME = ('FAM1\tg1\tgenome1\tctg1\t1\t10\n'
+             'FAM2\tg2\tgenome1\tctg1\t21\t30\n'
+             'FAM2\tg3\tgenome2\tctg2\t1\t10\n')
+
+
+@pytest.mark.parametrize('store', [False, True])
+def test_empty_input_dir(tmp_path, store):
+    pangenome = tmp_path / 'pangenome.tsv'
+    pangenome.write_text(PANGENOME)
+    (tmp_path / 'map').mkdir()
+    cmd = [sys.executable, os.path.join(REPO, 'panphlan_profiling.py'), '-i', str(tmp_path / 'map'),
+           '-p', str(pangenome), '--o_matrix', str(tmp_path / 'matrix.tsv')]
+    if store:
+        cmd += ['--store', str(tmp_path / 'store')]
+    result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    assert result.returncode == 1
+    assert 'Traceback' not in result.stderr
+    assert '[E] No sample passed the coverage threshold' in result.stderr
+
+
+def test_binary_coverage_matrix_precision(tmp_path):
+    import numpy
+    from misc import write_coverage_binary, read_coverage_binary
+
+    values = numpy.array([[0.0, 1.5], [12.345, 16383.999], [20000.001, 2.0 ** 24 + 1]])
+    output = str(tmp_path / 'covmat.bin')
+    write_coverage_binary(output, ['FAM1', 'FAM2', 'FAM3'], ['S1', 'S2'], values)
+    families, samples, data = read_coverage_binary(output)
+    assert families == ['FAM1', 'FAM2', 'FAM3'] and samples == ['S1', 'S2']
+    read = numpy.asarray(data, dtype=numpy.float64).T
+    # float32: relative error within 2**-24, the 3 decimals of the text matrix are only kept below 16384
+    assert numpy.all(numpy.abs(read - values) <= numpy.abs(values) * 2.0 ** -24)
+    assert format(read[1, 1], '.3f') == '16383.999'
+    assert format(read[2, 0], '.3f') != '20000.001'